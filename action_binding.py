@@ -0,0 +1,149 @@
+"""Per-iteration binding of action templates. Instead of deep copying every ParsedAction, ParsedGUIAction and
+ParsedMeasurementAction for every iteration and calling update_source_ip(), update_target_ip(), update_iteration()
+and friends on the copies, one template is kept per action and each iteration only holds a small binding record.
+The script is rendered from a precompiled template the first time it is read."""
+
+import copy
+
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from static_variables import *
+from mm_template import CommandTemplate
+
+# Tags an action script may contain, in the order the binding fields are listed.
+BINDING_TAGS = (TAG_SOURCE_IP, TAG_TARGET_IP, TAG_ITERATION, TAG_USER, TAG_HOSTNAME, TAG_SRC_TAP, TAG_DST_TAP)
+# The tap tags are only substituted in actions that have update_src_tap()/update_dst_tap() (not ParsedGUIAction).
+TAP_TAGS = (TAG_SRC_TAP, TAG_DST_TAP)
+
+
+class IterationBinding:
+    """The per-iteration values substituted into action scripts. A field left as None keeps its tag in the
+    script, just like not calling the matching update_...() method. Bindings are immutable once built so
+    one record can be shared by every action of an iteration; use replace() to derive a variant."""
+    __slots__ = ("iteration", "source_ip", "target_ip", "user", "hostname", "src_tap", "dst_tap", "_values")
+
+    def __init__(self, iteration: Optional[int] = None, source_ip: Optional[str] = None,
+                 target_ip: Optional[str] = None, user: Optional[str] = None, hostname: Optional[str] = None,
+                 src_tap: Optional[str] = None, dst_tap: Optional[str] = None):
+        object.__setattr__(self, "iteration", iteration)
+        object.__setattr__(self, "source_ip", source_ip)
+        object.__setattr__(self, "target_ip", target_ip)
+        object.__setattr__(self, "user", user)
+        object.__setattr__(self, "hostname", hostname)
+        object.__setattr__(self, "src_tap", src_tap)
+        object.__setattr__(self, "dst_tap", dst_tap)
+        fields = (source_ip, target_ip, None if iteration is None else str(iteration), user, hostname, src_tap,
+                  dst_tap)
+        object.__setattr__(self, "_values", {t: v for t, v in zip(BINDING_TAGS, fields) if v is not None})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("IterationBinding is immutable; use replace().")
+
+    def replace(self, **changes) -> "IterationBinding":
+        fields = {name: getattr(self, name) for name in self.__slots__ if name != "_values"}
+        fields.update(changes)
+        return IterationBinding(**fields)
+
+    def values(self) -> Dict[str, str]:
+        return self._values
+
+    def print_data(self) -> str:
+        s = "IterationBinding:\n"
+        for name in self.__slots__[:-1]:
+            s += f"\t{name}: {getattr(self, name)}\n"
+        return s
+
+
+def binding_tags(template: Any) -> Tuple[str, ...]:
+    """The tags substituted in the script of a template: those its update_...() methods would replace."""
+    if hasattr(template, "update_src_tap") and hasattr(template, "update_dst_tap"):
+        return BINDING_TAGS
+    return tuple(t for t in BINDING_TAGS if t not in TAP_TAGS)
+
+
+@lru_cache(maxsize=1024)
+def _compile(script: str, tags: Tuple[str, ...]) -> CommandTemplate:
+    """Templates with the same script share one compilation."""
+    return CommandTemplate.from_string(script, tags)
+
+
+class BoundAction:
+    """This class is a lightweight view of an action template under an IterationBinding. Reading any
+    attribute is delegated to the template, except script, which is rendered with the binding values
+    on first access and then remembered, and iteration, which comes from the binding for templates that
+    carry one (ParsedMeasurementAction). Assigning an attribute stores it in a per-iteration overlay and
+    never touches the shared template.
+
+    Code that needs a real ParsedAction object (isinstance checks, pickling onto a queue) can call
+    materialize(), which returns a shallow copy with the bound script and overlay applied."""
+    __slots__ = ("_template", "_binding", "_overlay", "_compiled")
+
+    def __init__(self, template: Any, binding: IterationBinding):
+        object.__setattr__(self, "_template", template)
+        object.__setattr__(self, "_binding", binding)
+        object.__setattr__(self, "_overlay", None)
+        object.__setattr__(self, "_compiled", None)
+
+    @property
+    def template(self) -> Any:
+        return self._template
+
+    @property
+    def binding(self) -> IterationBinding:
+        return self._binding
+
+    @property
+    def script(self) -> Optional[str]:
+        overlay = self._overlay
+        if overlay is not None and "script" in overlay:
+            return overlay["script"]
+        compiled = self._compiled_script()
+        if compiled is None:
+            return None
+        script = compiled.render(self._binding.values())
+        self._set_overlay("script", script)
+        return script
+
+    def _compiled_script(self) -> Optional[CommandTemplate]:
+        """The template script compiled against the binding tags. The script it was compiled from is kept
+        with it, so a template whose script is changed is recompiled."""
+        script = self._template.script
+        if script is None:
+            return None
+        cached = self._compiled
+        if cached is None or cached[0] is not script:
+            cached = (script, _compile(script, binding_tags(self._template)))
+            object.__setattr__(self, "_compiled", cached)
+        return cached[1]
+
+    def __getattr__(self, name):
+        overlay = self._overlay
+        if overlay is not None and name in overlay:
+            return overlay[name]
+        if name == "iteration" and self._binding.iteration is not None and hasattr(self._template, "iteration"):
+            return self._binding.iteration
+        return getattr(self._template, name)
+
+    def __setattr__(self, name, value):
+        self._set_overlay(name, value)
+
+    def _set_overlay(self, name: str, value: Any):
+        if self._overlay is None:
+            object.__setattr__(self, "_overlay", {})
+        self._overlay[name] = value
+
+    def materialize(self) -> Any:
+        action = copy.copy(self._template)
+        action.script = self.script
+        if self._binding.iteration is not None and hasattr(action, "iteration"):
+            action.iteration = self._binding.iteration
+        if self._overlay is not None:
+            for name, value in self._overlay.items():
+                setattr(action, name, value)
+        return action
+
+
+def bind_actions(templates: Iterable[Any], binding: IterationBinding) -> List[BoundAction]:
+    """Bind a list of action templates to one iteration."""
+    return [BoundAction(template, binding) for template in templates]
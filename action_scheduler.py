@@ -0,0 +1,258 @@
+"""Dependency-graph execution of the actions of an iteration. The graph is built from the run_before and run_after
+fields of ParsedAction, actions run as soon as their dependencies are done (within the ParsedStageLimit caps),
+start/end delays are kept on a timer heap instead of sleeping, and the critical path of the run is reported."""
+
+import re
+import time
+import heapq
+import queue
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from parsed_objects import ParsedAction, ParsedStageLimit
+
+# ActionRun states.
+ACTION_PENDING = "pending"
+ACTION_RUNNING = "running"
+ACTION_DONE = "done"
+ACTION_FAILED = "failed"
+ACTION_SKIPPED = "skipped"
+
+# Values of run_before/run_after that mean 'no dependency'.
+_NO_DEPENDENCY = {"", "none", "null"}
+
+
+def parse_action_ids(value: Optional[str]) -> List[str]:
+    """run_before/run_after hold one action id or a comma/space separated list of them."""
+    if value is None:
+        return []
+    return [v for v in re.split(r"[,\s]+", str(value).strip()) if v.lower() not in _NO_DEPENDENCY]
+
+
+class ActionRun:
+    """Timeline and outcome of one action in a schedule run."""
+    def __init__(self, action: ParsedAction):
+        self.action = action
+        self.state: str = ACTION_PENDING
+        self.ready_time: float = 0.0        # dependencies released (before start_delay)
+        self.start_time: float = 0.0
+        self.end_time: float = 0.0
+        self.release_time: float = 0.0      # end_time + end_delay; successors wait for this
+        self.critical_parent: Optional[str] = None
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+    def print_data(self) -> str:
+        s = "ActionRun:\n"
+        s += f"\tid: {self.action.id}\n"
+        s += f"\tstate: {self.state}\n"
+        s += f"\tstart_time: {self.start_time}\n"
+        s += f"\tend_time: {self.end_time}\n"
+        s += f"\terror: {repr(self.error)}\n"
+        return s
+
+
+class ActionGraph:
+    """The dependency graph of a set of actions. An edge A -> B means B may only start once A is done;
+    'B.run_after = A' and 'A.run_before = B' both produce it. With strict_stages every action additionally
+    depends on all actions of the previous stage, which reproduces the old stage-by-stage execution;
+    without it stages only select the concurrency cap from ParsedStageLimit.
+
+    The constructor raises ValueError for references to unknown action ids and for cycles."""
+    def __init__(self, actions: Iterable[ParsedAction], strict_stages: bool = False):
+        self.actions: Dict[str, ParsedAction] = {}
+        for action in actions:
+            if action.id in self.actions:
+                raise ValueError(f"Duplicate action id {repr(action.id)}.")
+            self.actions[action.id] = action
+        self.successors: Dict[str, Set[str]] = {a: set() for a in self.actions}
+        self.predecessors: Dict[str, Set[str]] = {a: set() for a in self.actions}
+
+        for action in self.actions.values():
+            for before in parse_action_ids(action.run_after):
+                self._add_edge(before, action.id)
+            for after in parse_action_ids(action.run_before):
+                self._add_edge(action.id, after)
+
+        if strict_stages:
+            stages = sorted({a.stage for a in self.actions.values()})
+            for previous, stage in zip(stages, stages[1:]):
+                for a in self.actions.values():
+                    if a.stage == stage:
+                        for p in self.actions.values():
+                            if p.stage == previous:
+                                self._add_edge(p.id, a.id)
+
+        self.order: List[str] = self._topological_order()
+
+    def _add_edge(self, before: str, after: str):
+        for action_id in (before, after):
+            if action_id not in self.actions:
+                raise ValueError(f"Action dependency refers to unknown action id {repr(action_id)}.")
+        self.successors[before].add(after)
+        self.predecessors[after].add(before)
+
+    def _topological_order(self) -> List[str]:
+        remaining = {a: len(p) for a, p in self.predecessors.items()}
+        ready = sorted(a for a, n in remaining.items() if n == 0)
+        order: List[str] = []
+        while ready:
+            action_id = ready.pop()
+            order.append(action_id)
+            for successor in self.successors[action_id]:
+                remaining[successor] -= 1
+                if remaining[successor] == 0:
+                    ready.append(successor)
+        if len(order) != len(self.actions):
+            cycle = sorted(a for a, n in remaining.items() if n > 0)
+            raise ValueError(f"Action dependencies contain a cycle involving: {', '.join(cycle)}.")
+        return order
+
+
+class ActionScheduler:
+    """This class executes an ActionGraph. runner(action) does the actual work (for example building the
+    SubprocessItem or SSHItem and waiting for it) and is called on a worker thread; it is responsible for
+    honouring action.timeout. The scheduler thread itself never sleeps on a delay: actions whose delay
+    has not elapsed sit on a heap ordered by their due time, and the scheduler waits for whichever comes
+    first, the next due time or the next completion.
+
+    If an action raises, the actions that depend on it are skipped and everything else carries on."""
+    def __init__(self, graph: ActionGraph, runner: Callable[[ParsedAction], Any],
+                 stage_limits: Iterable[ParsedStageLimit] = (), max_workers: int = 16):
+        self.graph = graph
+        self.runner = runner
+        self.stage_limits: Dict[int, int] = {limit.id: limit.limit for limit in stage_limits}
+        self.max_workers = max_workers
+        self.runs: Dict[str, ActionRun] = {a: ActionRun(action) for a, action in graph.actions.items()}
+
+    def run(self) -> Dict[str, ActionRun]:
+        runs = self.runs
+        waiting_deps = {a: len(p) for a, p in self.graph.predecessors.items()}
+        timers: List[tuple] = []                    # (due time, sequence, action id)
+        blocked: Dict[int, List[str]] = {}          # stage -> actions due but over the stage cap
+        running_per_stage: Dict[int, int] = {}
+        completions: "queue.Queue[str]" = queue.Queue()
+        sequence = 0
+        running = 0
+        finished = 0
+        start = time.monotonic()
+
+        def schedule(action_id: str, ready_time: float):
+            nonlocal sequence
+            run = runs[action_id]
+            run.ready_time = ready_time
+            heapq.heappush(timers, (ready_time + run.action.start_delay, sequence, action_id))
+            sequence += 1
+
+        def execute(action_id: str):
+            run = runs[action_id]
+            try:
+                run.result = self.runner(run.action)
+            except BaseException as e:
+                run.error = e
+            finally:
+                run.end_time = time.monotonic()
+                completions.put(action_id)
+
+        for action_id in self.graph.order:
+            if waiting_deps[action_id] == 0:
+                schedule(action_id, start)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="action") as pool:
+            while finished < len(runs):
+                now = time.monotonic()
+                while timers and timers[0][0] <= now:
+                    _, _, action_id = heapq.heappop(timers)
+                    blocked.setdefault(runs[action_id].action.stage, []).append(action_id)
+
+                for stage, action_ids in blocked.items():
+                    limit = self.stage_limits.get(stage, 0)
+                    while action_ids and (limit <= 0 or running_per_stage.get(stage, 0) < limit):
+                        action_id = action_ids.pop(0)
+                        run = runs[action_id]
+                        run.state = ACTION_RUNNING
+                        run.start_time = time.monotonic()
+                        running_per_stage[stage] = running_per_stage.get(stage, 0) + 1
+                        running += 1
+                        pool.submit(execute, action_id)
+
+                timeout = None
+                if timers:
+                    timeout = max(0.0, timers[0][0] - time.monotonic())
+                elif running == 0:
+                    break           # Nothing running and nothing due: only skipped actions remain.
+                try:
+                    action_id = completions.get(timeout=timeout)
+                except queue.Empty:
+                    continue
+
+                while True:
+                    run = runs[action_id]
+                    running -= 1
+                    finished += 1
+                    running_per_stage[run.action.stage] -= 1
+                    run.state = ACTION_FAILED if run.error is not None else ACTION_DONE
+                    run.release_time = run.end_time + run.action.end_delay
+                    if run.state == ACTION_FAILED:
+                        finished += self._skip_dependents(action_id)
+                    else:
+                        for successor in self.graph.successors[action_id]:
+                            if runs[successor].state == ACTION_SKIPPED:
+                                continue
+                            waiting_deps[successor] -= 1
+                            if waiting_deps[successor] == 0:
+                                self._release(successor)
+                                schedule(successor, runs[successor].ready_time)
+                    try:
+                        action_id = completions.get_nowait()
+                    except queue.Empty:
+                        break
+        return runs
+
+    def _release(self, action_id: str):
+        """All dependencies are done: the action is ready at the latest release of its predecessors, and
+        that predecessor is its parent on the critical path."""
+        run = self.runs[action_id]
+        parent = max(self.graph.predecessors[action_id], key=lambda p: self.runs[p].release_time)
+        run.critical_parent = parent
+        run.ready_time = self.runs[parent].release_time
+
+    def _skip_dependents(self, action_id: str) -> int:
+        skipped = 0
+        stack = list(self.graph.successors[action_id])
+        while stack:
+            successor = stack.pop()
+            run = self.runs[successor]
+            if run.state == ACTION_PENDING:
+                run.state = ACTION_SKIPPED
+                skipped += 1
+                stack.extend(self.graph.successors[successor])
+        return skipped
+
+    def critical_path(self) -> List[str]:
+        """The chain of actions that determined the end of the run, first action first."""
+        finished = [r for r in self.runs.values() if r.state in (ACTION_DONE, ACTION_FAILED)]
+        if not finished:
+            return []
+        run = max(finished, key=lambda r: r.release_time)
+        path = [run.action.id]
+        while run.critical_parent is not None:
+            run = self.runs[run.critical_parent]
+            path.append(run.action.id)
+        return path[::-1]
+
+    def print_report(self) -> str:
+        runs = [r for r in self.runs.values() if r.start_time]
+        origin = min((r.start_time - r.action.start_delay for r in runs), default=0.0)
+        s = "ActionScheduler report:\n"
+        for action_id in self.graph.order:
+            run = self.runs[action_id]
+            if run.start_time:
+                s += f"\t{action_id}: {run.state} start {run.start_time - origin:.3f}s " \
+                     f"end {run.end_time - origin:.3f}s\n"
+            else:
+                s += f"\t{action_id}: {run.state}\n"
+        s += f"\tcritical path: {' -> '.join(self.critical_path())}\n"
+        return s
@@ -0,0 +1,203 @@
+"""Indexed MAC/network/IP table for virtual machines and a cluster-wide reverse index from IP (and MAC) to VM.
+AddressTable replaces the plain list of (mac, net, ip) tuples in ParsedVirtualMachine.mac_net_ip and still
+behaves like that list for code that iterates or indexes it."""
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Addresses on this network are never handed out by get_any_ip_address().
+EXCLUDED_ANY_IP = "10.254"
+
+MacNetIp = Tuple[str, str, str]
+
+
+class AddressTable:
+    """This class keeps the (mac, net, ip) entries of one VM in interface order with a dictionary index by
+    MAC and by network alias. Lookups by MAC or network are O(1) and has_an_ip_address() is a counter.
+    get_any_ip_address() keeps the reverse-order preference of the original implementation (the last
+    interface with an address wins, to work around the interface disappearance bug) and caches its answer
+    until an address changes.
+
+    When a VM is registered with a ClusterAddressIndex, the table reports its address changes to the
+    index. The index reference is not pickled, so VMs still cross process queues unchanged."""
+    def __init__(self, entries: Iterable[MacNetIp] = ()):
+        self._entries: List[MacNetIp] = []
+        self._by_mac: Dict[str, int] = {}
+        self._by_net: Dict[str, int] = {}
+        self._ip_count = 0
+        self._any_ip: Optional[str] = None
+        self._any_ip_valid = False
+        self._index: Optional["ClusterAddressIndex"] = None
+        self._owner: Any = None
+        for entry in entries:
+            self.append(entry)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state["_index"] = None
+        state["_owner"] = None
+        return state
+
+    # list compatibility
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[MacNetIp]:
+        return iter(self._entries)
+
+    def __reversed__(self) -> Iterator[MacNetIp]:
+        return reversed(self._entries)
+
+    def __getitem__(self, i):
+        return self._entries[i]
+
+    def __setitem__(self, i: int, entry: MacNetIp):
+        self._replace(i, entry)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, AddressTable):
+            return self._entries == other._entries
+        return self._entries == other
+
+    def __repr__(self) -> str:
+        return f"AddressTable({self._entries!r})"
+
+    def append(self, entry: MacNetIp):
+        mac, net, ip = entry
+        i = len(self._entries)
+        self._entries.append((mac, net, ip))
+        self._by_mac.setdefault(mac, i)     # The first entry for a MAC or network wins, as in a linear scan.
+        self._by_net.setdefault(net, i)
+        if ip:
+            self._ip_count += 1
+            self._any_ip_valid = False
+            self._notify("", ip)
+
+    # lookups
+    def get_ip_on_net(self, net_alias: str) -> Optional[str]:
+        i = self._by_net.get(net_alias)
+        return None if i is None else self._entries[i][2]
+
+    def get_ip_for_mac(self, mac_address: str) -> Optional[str]:
+        i = self._by_mac.get(mac_address)
+        return None if i is None else self._entries[i][2]
+
+    def has_mac(self, mac_address: str) -> bool:
+        return mac_address in self._by_mac
+
+    def has_ip(self, ip_address: str) -> bool:
+        return bool(ip_address) and any(ip == ip_address for (mac, net, ip) in self._entries)
+
+    def has_an_ip(self) -> bool:
+        return self._ip_count > 0
+
+    def get_any_ip(self) -> Optional[str]:
+        if not self._any_ip_valid:
+            self._any_ip = None
+            for (mac, net, ip) in reversed(self._entries):
+                if ip and EXCLUDED_ANY_IP not in ip:
+                    self._any_ip = ip
+                    break
+            self._any_ip_valid = True
+        return self._any_ip
+
+    # updates
+    def set_ip_for_mac(self, ip_address: str, mac_address: str) -> bool:
+        i = self._by_mac.get(mac_address)
+        if i is None:
+            return False
+        mac, net, _ = self._entries[i]
+        self._replace(i, (mac, net, ip_address))
+        return True
+
+    def update_from_scan(self, ip_mac_pairs: Iterable[Tuple[str, str]]) -> int:
+        """Apply the (ip, mac) pairs of a netdiscover/ARP scan. Pairs for MACs this VM does not have are
+        ignored. Returns the number of interfaces that were updated."""
+        updated = 0
+        for ip, mac in ip_mac_pairs:
+            if self.set_ip_for_mac(ip, mac):
+                updated += 1
+        return updated
+
+    def reset_ips(self):
+        for i, (mac, net, ip) in enumerate(self._entries):
+            if ip:
+                self._replace(i, (mac, net, ""))
+
+    def _replace(self, i: int, entry: MacNetIp):
+        old_mac, old_net, old_ip = self._entries[i]
+        mac, net, ip = entry
+        if (mac, net) != (old_mac, old_net):
+            # Rare: an interface itself was swapped out, so rebuild the indexes.
+            self._entries[i] = (mac, net, ip)
+            self._rebuild()
+        else:
+            self._entries[i] = (mac, net, ip)
+            self._ip_count += bool(ip) - bool(old_ip)
+        if ip != old_ip:
+            self._any_ip_valid = False
+            self._notify(old_ip, ip)
+
+    def _rebuild(self):
+        self._by_mac.clear()
+        self._by_net.clear()
+        self._ip_count = 0
+        for i, (mac, net, ip) in enumerate(self._entries):
+            self._by_mac.setdefault(mac, i)
+            self._by_net.setdefault(net, i)
+            self._ip_count += bool(ip)
+
+    def _notify(self, old_ip: str, new_ip: str):
+        if self._index is not None:
+            self._index.address_changed(self._owner, old_ip, new_ip, self.has_ip(old_ip))
+
+    def _attach(self, index: "ClusterAddressIndex", owner: Any):
+        self._index = index
+        self._owner = owner
+
+
+class ClusterAddressIndex:
+    """This class is the cluster-wide reverse index. It maps every known IP address and every MAC address
+    to the VM that owns it, which is what netdiscover processing and incoming connections need to find a
+    VM without walking all of them. Register each ParsedVirtualMachine once; address updates made through
+    the VM are then reflected here automatically.
+
+    Keys are plain dictionary entries, so lookups are safe from any thread under the GIL. If the same
+    VM definition is reused by several iterations, register the per-iteration copies and key by whatever
+    owner object the caller passes in."""
+    def __init__(self):
+        self._by_ip: Dict[str, Any] = {}
+        self._by_mac: Dict[str, Any] = {}
+
+    def register(self, vm: Any, owner: Any = None):
+        owner = vm if owner is None else owner
+        table: AddressTable = vm.mac_net_ip
+        table._attach(self, owner)
+        for (mac, net, ip) in table:
+            self._by_mac[mac] = owner
+            if ip:
+                self._by_ip[ip] = owner
+
+    def unregister(self, vm: Any):
+        table: AddressTable = vm.mac_net_ip
+        owner = table._owner
+        for (mac, net, ip) in table:
+            if self._by_mac.get(mac) is owner:
+                del self._by_mac[mac]
+            if ip and self._by_ip.get(ip) is owner:
+                del self._by_ip[ip]
+        table._attach(None, None)
+
+    def lookup_ip(self, ip_address: str) -> Optional[Any]:
+        return self._by_ip.get(ip_address)
+
+    def lookup_mac(self, mac_address: str) -> Optional[Any]:
+        return self._by_mac.get(mac_address)
+
+    def address_changed(self, owner: Any, old_ip: str, new_ip: str, old_ip_still_used: bool = False):
+        if old_ip and not old_ip_still_used and self._by_ip.get(old_ip) is owner:
+            del self._by_ip[old_ip]
+        if new_ip:
+            self._by_ip[new_ip] = owner
+
+    def __len__(self) -> int:
+        return len(self._by_ip)
@@ -0,0 +1,133 @@
+"""Allocation accounting for hypervisor nodes that is safe across threads and processes. Every node gets one
+slot per simultaneous iteration (max_iterations) in shared memory, so a node can never be over-committed and
+its count can never drift negative the way a check-then-increment counter can."""
+
+import time
+import bisect
+import random
+import multiprocessing
+
+from typing import Dict, List, Optional, Tuple
+
+from parsed_objects import ParsedHypervisor
+
+# Slot states held in the shared expiry array. Any positive value is a reservation expiring at that time.
+SLOT_FREE = 0.0
+SLOT_ALLOCATED = -1.0
+
+# A token identifies one reservation/allocation: (slot index, generation of the slot when taken).
+LedgerToken = Tuple[int, int]
+
+
+class AllocationLedger:
+    """This class keeps the allocation state of the cluster in shared memory (multiprocessing.RawArray)
+    with one lock per node, so controllers allocating on different nodes never wait on each other and
+    there is no global lock. Create it in the parent process before the controllers are started and pass
+    it to them as an argument; the shared arrays and locks are inherited by the children.
+
+    A slot is either free, allocated, or reserved until an expiry time. A reservation that is not
+    committed before it expires is reclaimed by the next caller that needs the slot, so a crashed
+    controller cannot leak capacity. Each slot carries a generation number that is bumped whenever it is
+    taken, which makes a stale token (for an expired and re-used reservation) harmless.
+
+    snapshot() reads the arrays without taking any lock. It is cheap and may be a moment out of date,
+    which is fine for reporting utilisation."""
+    def __init__(self, hypervisors: List[ParsedHypervisor]):
+        self._aliases: List[str] = [hv.node_alias for hv in hypervisors]
+        self._first_slot: List[int] = []
+        self._slot_count: List[int] = []
+        total = 0
+        for hv in hypervisors:
+            self._first_slot.append(total)
+            self._slot_count.append(hv.max_iterations)
+            total += hv.max_iterations
+
+        self._node_index: Dict[str, int] = {alias: i for i, alias in enumerate(self._aliases)}
+        self._expiry = multiprocessing.RawArray('d', total)
+        self._generation = multiprocessing.RawArray('L', total)
+        self._locks = [multiprocessing.Lock() for _ in hypervisors]
+
+    def reserve(self, node_alias: str, ttl_sec: float = 30.0) -> Optional[LedgerToken]:
+        """Reserve a slot on a node for ttl_sec seconds. Returns a token or None if the node is full."""
+        return self._take(self._node_index[node_alias], time.time() + ttl_sec, block=True)
+
+    def reserve_any(self, ttl_sec: float = 30.0) -> Optional[Tuple[str, LedgerToken]]:
+        """Reserve a slot on any node with room. Nodes are tried from a random starting point and busy
+        nodes are skipped on the first pass, which keeps concurrent callers from queueing on one lock."""
+        count = len(self._aliases)
+        if count == 0:
+            return None
+        start = random.randrange(count)
+        for block in (False, True):
+            for offset in range(count):
+                node = (start + offset) % count
+                token = self._take(node, time.time() + ttl_sec, block=block)
+                if token is not None:
+                    return self._aliases[node], token
+        return None
+
+    def allocate(self, node_alias: str) -> Optional[LedgerToken]:
+        """Take a slot on a node outright. ParsedHypervisor.can_allocate_iteration() calls this once the
+        ledger has been attached to the node with attach_ledger()."""
+        return self._take(self._node_index[node_alias], SLOT_ALLOCATED, block=True)
+
+    def commit(self, token: LedgerToken) -> bool:
+        """Turn a reservation into an allocation. Returns False if the reservation expired and the slot
+        has been handed to someone else in the meantime."""
+        slot, generation = token
+        with self._locks[self._node_of_slot(slot)]:
+            if self._generation[slot] != generation or self._expiry[slot] == SLOT_FREE:
+                return False
+            self._expiry[slot] = SLOT_ALLOCATED
+            return True
+
+    def release(self, token: LedgerToken) -> bool:
+        """Free a reserved or allocated slot. Releasing twice, or releasing a stale token, is a no-op
+        that returns False."""
+        slot, generation = token
+        with self._locks[self._node_of_slot(slot)]:
+            if self._generation[slot] != generation or self._expiry[slot] == SLOT_FREE:
+                return False
+            self._expiry[slot] = SLOT_FREE
+            return True
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        """Lock-free view of utilisation per node alias."""
+        now = time.time()
+        result: Dict[str, Dict[str, int]] = {}
+        for node, alias in enumerate(self._aliases):
+            allocated = reserved = 0
+            first = self._first_slot[node]
+            for slot in range(first, first + self._slot_count[node]):
+                expiry = self._expiry[slot]
+                if expiry == SLOT_ALLOCATED:
+                    allocated += 1
+                elif expiry > now:
+                    reserved += 1
+            result[alias] = {"allocated": allocated, "reserved": reserved,
+                             "free": self._slot_count[node] - allocated - reserved,
+                             "max": self._slot_count[node]}
+        return result
+
+    def _take(self, node: int, state: float, block: bool) -> Optional[LedgerToken]:
+        """Find a free (or expired) slot on a node and put it in the given state under the node lock."""
+        lock = self._locks[node]
+        if not lock.acquire(block):
+            return None
+        try:
+            now = time.time()
+            first = self._first_slot[node]
+            for slot in range(first, first + self._slot_count[node]):
+                expiry = self._expiry[slot]
+                if expiry == SLOT_FREE or (expiry != SLOT_ALLOCATED and expiry <= now):
+                    self._generation[slot] += 1
+                    self._expiry[slot] = state
+                    return slot, self._generation[slot]
+            return None
+        finally:
+            lock.release()
+
+    def _node_of_slot(self, slot: int) -> int:
+        if not 0 <= slot < len(self._expiry):
+            raise ValueError(f"Invalid ledger slot {slot}.")
+        return bisect.bisect_right(self._first_slot, slot) - 1
@@ -0,0 +1,95 @@
+"""Opt-in cache of command results for SockClient. Probe commands such as 'ip addr' or 'uname -a' that the server
+sends over and over are only run again once their cached result has expired, and identical commands that arrive
+while one is running share its result, which saves process spawns on a VM that is busy with the experiment."""
+
+import time
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional, Tuple
+
+
+def normalize_command(command: str) -> str:
+    return " ".join(command.split())
+
+
+class CommandCache:
+    """This class caches command output per normalised command (whitespace collapsed). Only commands that
+    match a whitelisted prefix are cached: rules maps a prefix to the TTL in seconds of the results of
+    commands starting with it, matched on whole words and the longest prefix winning, so
+    {"ip addr": 5, "systemctl is-active": 2} caches 'ip addr show' but not 'ip addrlabel'. At most
+    max_entries results are kept, evicting the least recently used.
+
+    A command that does not match any rule is always run. Requests for a cacheable command that arrive
+    while the same command is running wait for that run and share its result. Only successful results
+    (exit code 0) are kept, so a probe that failed once is run again on the next request."""
+    def __init__(self, rules: Dict[str, float], max_entries: int = 256):
+        self.rules: Dict[str, float] = {normalize_command(p): ttl for p, ttl in rules.items()}
+        self.max_entries = max_entries
+        self.hits: int = 0
+        self.misses: int = 0
+        self.shared: int = 0
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def ttl_for(self, command: str) -> Optional[float]:
+        """The TTL of a normalised command, or None if it may not be cached."""
+        best = None
+        for prefix, ttl in self.rules.items():
+            if (command == prefix or command.startswith(prefix + " ")) and (best is None or len(prefix) > len(best)):
+                best = prefix
+        return None if best is None else self.rules[best]
+
+    def run(self, command: str, func: Callable[[str], Tuple[int, str]]) -> str:
+        """Output of func(command), from the cache when a fresh result is there. func returns the exit code
+        and the output of the command."""
+        key = normalize_command(command)
+        ttl = self.ttl_for(key)
+        if ttl is None:
+            return func(command)[1]
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+                self.misses += 1
+            else:
+                self.shared += 1
+        if not owner:
+            return future.result()
+
+        try:
+            exit_code, output = func(command)
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+            if exit_code == 0:
+                self._entries[key] = (time.monotonic() + ttl, output)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        future.set_result(output)
+        return output
+
+    def invalidate(self, prefix: Optional[str] = None):
+        """Drop cached results, all of them or those of commands starting with prefix."""
+        with self._lock:
+            if prefix is None:
+                self._entries.clear()
+                return
+            prefix = normalize_command(prefix)
+            for key in [k for k in self._entries if k == prefix or k.startswith(prefix + " ")]:
+                del self._entries[key]
@@ -0,0 +1,257 @@
+"""Multi-resource placement of iterations onto hypervisor nodes. ParsedHypervisor.can_allocate_iteration() only
+counts iterations; the allocator in this module also accounts for the cores, ram and disk each node offers
+against the cpus, memory and disk demanded by the virtual machines of an iteration."""
+
+import math
+import bisect
+import threading
+
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from parsed_objects import ParsedHypervisor, ParsedVirtualMachine
+
+# Placement strategies.
+STRATEGY_FIRST_FIT_DECREASING = "first_fit_decreasing"
+STRATEGY_BEST_FIT = "best_fit"
+STRATEGY_SPREAD = "spread"
+
+
+class IterationDemand:
+    """The resources an iteration needs from the node it is placed on. The units have to match the
+    units used for the hypervisor in the config file (cores, and typically MB of ram as used by minimega
+    for 'vm config memory')."""
+    def __init__(self, cpus: int = 0, memory: int = 0, disk: int = 0):
+        self.cpus: int = int(cpus)
+        self.memory: int = int(memory)
+        self.disk: int = int(disk)
+
+    @classmethod
+    def from_vms(cls, vms: Iterable[ParsedVirtualMachine],
+                 disk_sizer: Optional[Callable[[ParsedVirtualMachine], int]] = None) -> "IterationDemand":
+        """Sum the demands of the virtual machines of an iteration. The VM only knows the file name of its
+        disk, so the disk demand is left to disk_sizer (for example a lookup of the image size when the
+        VM is not launched with drive snapshots). Without one, disk is not accounted for."""
+        demand = cls()
+        for vm in vms:
+            demand.cpus += int(vm.cpus)
+            demand.memory += int(vm.memory)
+            if disk_sizer is not None:
+                demand.disk += int(disk_sizer(vm))
+        return demand
+
+    def get_string(self) -> str:
+        return f"IterationDemand::{self.cpus}, {self.memory}, {self.disk}"
+
+
+class _NodeState:
+    """Free capacity of one node. A capacity of 0 in the config means 'not specified' and that resource
+    is not limited. Resources the node already records as allocated (dict_allocated) are not free."""
+    def __init__(self, index: int, node: ParsedHypervisor, cpu_ratio: float, ram_ratio: float):
+        self.index = index
+        self.node = node
+        allocated = node.get_allocated_stats()
+        self.free_cpu: float = node.cores * cpu_ratio - allocated["cpu"] if node.cores > 0 else math.inf
+        self.free_ram: float = node.ram * ram_ratio - allocated["ram"] if node.ram > 0 else math.inf
+        self.free_disk: float = node.disk - allocated["disk"] if node.disk > 0 else math.inf
+        self.free_slots: int = node.max_iterations - node.get_current_allocations()
+
+    def fits(self, demand: IterationDemand) -> bool:
+        return (self.free_slots > 0 and demand.cpus <= self.free_cpu and demand.memory <= self.free_ram
+                and demand.disk <= self.free_disk)
+
+
+class _MaxTree:
+    """Segment tree holding the maximum free ram over ranges of nodes in config order. It finds the
+    left-most node with enough ram in O(log n), which is what first-fit needs."""
+    def __init__(self, values: List[float]):
+        self._size = 1
+        while self._size < max(1, len(values)):
+            self._size *= 2
+        self._tree: List[float] = [-math.inf] * (2 * self._size)
+        for i, value in enumerate(values):
+            self._tree[self._size + i] = value
+        for i in range(self._size - 1, 0, -1):
+            self._tree[i] = max(self._tree[2 * i], self._tree[2 * i + 1])
+
+    def update(self, index: int, value: float):
+        i = self._size + index
+        self._tree[i] = value
+        i //= 2
+        while i:
+            self._tree[i] = max(self._tree[2 * i], self._tree[2 * i + 1])
+            i //= 2
+
+    def find_first(self, minimum: float, start: int = 0) -> int:
+        """Return the lowest index >= start whose value is >= minimum, or -1."""
+        return self._find(1, 0, self._size, minimum, start)
+
+    def _find(self, i: int, lo: int, hi: int, minimum: float, start: int) -> int:
+        if hi <= start or self._tree[i] < minimum:
+            return -1
+        if hi - lo == 1:
+            return lo
+        mid = (lo + hi) // 2
+        found = self._find(2 * i, lo, mid, minimum, start)
+        if found == -1:
+            found = self._find(2 * i + 1, mid, hi, minimum, start)
+        return found
+
+
+class HypervisorAllocator:
+    """This class places iterations on hypervisor nodes. Free ram is kept both in a sorted index (for
+    best-fit and spread) and in a segment tree over config order (for first-fit), so locating the first
+    candidate node is O(log n); the remaining resources are then checked on that candidate.
+
+    Strategies:
+    first_fit_decreasing -- the first node in config order that fits. place_batch() sorts the batch by
+                            decreasing memory first, which packs nodes tightly and leaves whole nodes free.
+    best_fit             -- the node with the least free ram that still fits.
+    spread               -- the node with the most free ram, which balances load over the cluster.
+
+    Custom strategies can be added with register_strategy(). allocate() and release() are atomic: either
+    all of an iteration's resources are taken from one node or nothing changes, and place_batch() places
+    either the whole batch or none of it. The allocator starts from what the nodes already record as
+    allocated and keeps the iteration count and dict_allocated of each ParsedHypervisor up to date
+    through their own methods, so it should be the only thing allocating on the nodes it manages."""
+    def __init__(self, hypervisors: List[ParsedHypervisor], strategy: str = STRATEGY_BEST_FIT,
+                 cpu_ratio: float = 1.0, ram_ratio: float = 1.0):
+        self._lock = threading.Lock()
+        self._nodes: List[_NodeState] = [_NodeState(i, hv, cpu_ratio, ram_ratio)
+                                         for i, hv in enumerate(hypervisors)]
+        self._by_alias: Dict[str, _NodeState] = {n.node.node_alias: n for n in self._nodes}
+        self._by_free_ram: List[Tuple[float, int]] = sorted((n.free_ram, n.index) for n in self._nodes)
+        self._ram_tree = _MaxTree([n.free_ram for n in self._nodes])
+        self._allocations: Dict[int, Tuple[_NodeState, IterationDemand]] = {}
+        self._strategies: Dict[str, Callable[[IterationDemand], Optional[_NodeState]]] = {
+            STRATEGY_FIRST_FIT_DECREASING: self._first_fit,
+            STRATEGY_BEST_FIT: self._best_fit,
+            STRATEGY_SPREAD: self._spread,
+        }
+        self.strategy: str = strategy
+        if strategy not in self._strategies:
+            raise ValueError(f"Unknown placement strategy {repr(strategy)}.")
+
+    def register_strategy(self, name: str, select: Callable[[List[ParsedHypervisor], IterationDemand],
+                                                            Optional[ParsedHypervisor]]):
+        """Register a custom strategy. select() is given the nodes that can take the demand, in config
+        order, and returns the one to use or None."""
+        def _custom(demand: IterationDemand) -> Optional[_NodeState]:
+            candidates = [n.node for n in self._nodes if n.fits(demand)]
+            chosen = select(candidates, demand) if candidates else None
+            return None if chosen is None else self._by_alias[chosen.node_alias]
+        self._strategies[name] = _custom
+
+    def allocate(self, iteration: int, demand: IterationDemand,
+                 strategy: Optional[str] = None) -> Optional[ParsedHypervisor]:
+        """Place an iteration and take its resources. Returns the node or None if nothing fits."""
+        with self._lock:
+            return self._allocate(iteration, demand, strategy)
+
+    def place_batch(self, demands: Dict[int, IterationDemand],
+                    strategy: Optional[str] = None) -> Dict[int, Optional[ParsedHypervisor]]:
+        """Place several iterations at once, largest memory demand first. The batch is placed as a whole:
+        if any iteration does not fit, the ones already placed are released again and every iteration is
+        returned with None, holding no resources."""
+        order = sorted(demands.items(), key=lambda kv: (kv[1].memory, kv[1].cpus, kv[1].disk), reverse=True)
+        placed: Dict[int, Optional[ParsedHypervisor]] = {}
+        with self._lock:
+            try:
+                for iteration, demand in order:
+                    node = self._allocate(iteration, demand, strategy)
+                    if node is None:
+                        break
+                    placed[iteration] = node
+                else:
+                    return placed
+            finally:
+                if len(placed) < len(order):
+                    for iteration in placed:
+                        self._release(iteration)
+        return {iteration: None for iteration, _ in order}
+
+    def release(self, iteration: int) -> Optional[ParsedHypervisor]:
+        """Give back the resources of an iteration. Releasing an unknown iteration is a no-op."""
+        with self._lock:
+            return self._release(iteration)
+
+    def get_node_for_iteration(self, iteration: int) -> Optional[ParsedHypervisor]:
+        with self._lock:
+            entry = self._allocations.get(iteration)
+            return None if entry is None else entry[0].node
+
+    def get_free_resources(self) -> Dict[str, Dict[str, float]]:
+        """Free capacity per node alias; math.inf means the resource is not limited."""
+        with self._lock:
+            return {n.node.node_alias: {"cpu": n.free_cpu, "ram": n.free_ram, "disk": n.free_disk,
+                                        "iterations": n.free_slots} for n in self._nodes}
+
+    def _allocate(self, iteration: int, demand: IterationDemand, strategy: Optional[str]) -> Optional[ParsedHypervisor]:
+        """allocate() with the lock held."""
+        if iteration in self._allocations:
+            raise ValueError(f"Iteration {iteration} is already allocated.")
+        select = self._strategies[strategy or self.strategy]
+        while True:
+            state = select(demand)
+            if state is None:
+                return None
+            if state.node.can_allocate_iteration():
+                break
+            # The node's iteration count was raised behind our back; stop offering it.
+            state.free_slots = 0
+        self._take(state, demand, 1)
+        self._allocations[iteration] = (state, demand)
+        return state.node
+
+    def _release(self, iteration: int) -> Optional[ParsedHypervisor]:
+        """release() with the lock held."""
+        entry = self._allocations.pop(iteration, None)
+        if entry is None:
+            return None
+        state, demand = entry
+        self._take(state, demand, -1)
+        return state.node
+
+    def _take(self, state: _NodeState, demand: IterationDemand, sign: int):
+        """Move resources between a node and an iteration (sign 1 takes, -1 gives back) and keep the
+        indexes and the ParsedHypervisor bookkeeping in step. On take the node's iteration count has
+        already been raised by can_allocate_iteration(). Called with the lock held."""
+        position = bisect.bisect_left(self._by_free_ram, (state.free_ram, state.index))
+        del self._by_free_ram[position]
+
+        state.free_cpu -= sign * demand.cpus
+        state.free_ram -= sign * demand.memory
+        state.free_disk -= sign * demand.disk
+        state.free_slots -= sign
+
+        bisect.insort(self._by_free_ram, (state.free_ram, state.index))
+        self._ram_tree.update(state.index, state.free_ram)
+
+        if sign > 0:
+            state.node.add_allocated_resources(demand.cpus, demand.memory, demand.disk)
+        else:
+            state.node.decrement_current_allocations()
+            state.node.remove_allocated_resources(demand.cpus, demand.memory, demand.disk)
+
+    def _first_fit(self, demand: IterationDemand) -> Optional[_NodeState]:
+        index = self._ram_tree.find_first(demand.memory)
+        while index != -1:
+            if self._nodes[index].fits(demand):
+                return self._nodes[index]
+            index = self._ram_tree.find_first(demand.memory, index + 1)
+        return None
+
+    def _best_fit(self, demand: IterationDemand) -> Optional[_NodeState]:
+        position = bisect.bisect_left(self._by_free_ram, (demand.memory, -1))
+        for i in range(position, len(self._by_free_ram)):
+            state = self._nodes[self._by_free_ram[i][1]]
+            if state.fits(demand):
+                return state
+        return None
+
+    def _spread(self, demand: IterationDemand) -> Optional[_NodeState]:
+        position = bisect.bisect_left(self._by_free_ram, (demand.memory, -1))
+        for i in range(len(self._by_free_ram) - 1, position - 1, -1):
+            state = self._nodes[self._by_free_ram[i][1]]
+            if state.fits(demand):
+                return state
+        return None
@@ -1,5 +1,5 @@
 import time
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Union
 from parsed_objects import ParsedHypervisor
 
 # NOTE: when adding new class, add to Union[...] of QueueItem constructor to help IDE typing
@@ -160,7 +160,8 @@ class MinimegaItem:
     """This class is the QueueItem.item class that communicates command string and functions to call in
     MinimegaController."""
     def __init__(self, for_node: Optional[ParsedHypervisor], mm_command: Optional[str], namespace: str,
-                 func_to_call: Optional[str], return_item: bool = False):
+                 func_to_call: Optional[str], return_item: bool = False, mm_commands: Optional[List[str]] = None,
+                 stop_on_error: bool = True):
         self.for_node: Optional[ParsedHypervisor] = for_node
         self.namespace: str = namespace
         self.mm_command: Optional[str] = mm_command
@@ -169,6 +170,12 @@ class MinimegaItem:
         self.result: [{}] = None
         self.output: str = ""
         self.exit_code: int = -1
+        # batched form: the commands are run in order in one session, each getting an entry of
+        # {"command", "exit_code", "output"} in command_results. With stop_on_error the commands after the
+        # first failure are not run and have no entry.
+        self.mm_commands: Optional[List[str]] = mm_commands
+        self.stop_on_error: bool = stop_on_error
+        self.command_results: List[Dict] = []
         self.minimega_started: bool = False    # can probably get rid of all of these as well (TLT)
         self.networks_started: bool = False
         self.all_vms_quit: bool = False
@@ -179,6 +186,8 @@ class MinimegaItem:
         s += f"\t_for_node: {self.for_node}\n"
         s += f"\t_namespace: {self.namespace}\n"
         s += f"\t_command: {self.mm_command}\n"
+        s += f"\t_commands: {self.mm_commands}\n"
+        s += f"\t_stop_on_error: {self.stop_on_error}\n"
         s += f"\t_func_to_call: {self.func_to_call}\n"
         s += f"\t_return_item: {self.return_item}\n"
         s += f"\t_result: {self.result}\n"
@@ -202,6 +211,8 @@ class SnapshotItem:
         self.output: str = ""
         self.exit_code: int = -1
 
+        self.failed_vms: List[str] = []     # filled in by SnapshotEngine so a retry only redoes these
+
     def print_data(self) -> str:
         return "NOT DEFINED"
 
@@ -243,6 +254,28 @@ class NetdiscoverItem:
         self.exit_code: int = -1
 
 
+class IpAssignmentItem:
+    """Event emitted by NetdiscoverStreamParser as soon as a scanned MAC is matched to a VM interface."""
+    def __init__(self, vm_name: str, mac_address: str, ip_address: str, for_node: str = "", iteration: int = -1):
+        self.vm_name: str = vm_name
+        self.mac_address: str = mac_address
+        self.ip_address: str = ip_address
+        self.for_node: str = for_node
+        self.iteration: int = iteration
+        self.discovered_time: float = time.time()
+
+    def print_data(self) -> str:
+        """Use this method for spilling the contents of an instance."""
+        s = "IpAssignmentItem:\n"
+        s += f"\tvm_name: {self.vm_name}\n"
+        s += f"\tmac_address: {self.mac_address}\n"
+        s += f"\tip_address: {self.ip_address}\n"
+        s += f"\tfor_node: {self.for_node}\n"
+        s += f"\titeration: {self.iteration}\n"
+        s += f"\tdiscovered_time: {self.discovered_time}\n"
+        return s
+
+
 class SubprocessItem:
     def __init__(self, for_node: str = "undefined", argument_list: List[str] = None,
                  command_str: str = "", action: str = "", context: str = "", shell: bool = False):
@@ -388,7 +421,7 @@ class QueueItem:
                                    NetdiscoverItem, SubprocessItem, SSHItem, PowerShellItem, MeasurementItem,
                                    GUIItem, GUIAgentItem, TestbedRequestItem, OutputItem, StatusItem,
                                    IterationRequestItem, ResourceReleaseItem, DnsmasqItem, ControllerRequestItem,
-                                   None],
+                                   IpAssignmentItem, None],
                  to_name: str, from_name: str, to_iteration: int = -1, from_iteration: int = -1,
                  pass_to_q_out: bool = False, pass_to_q_in: bool = False):
 
@@ -0,0 +1,152 @@
+"""Stall detection and sampling profiling for event loop threads such as the SockServer reactor. LoopWatchdog times
+every pass of the loop and every call made from it, and when one runs past its threshold logs it together with a
+stack sample taken while it is still running, so the handler behind a latency spike can be found afterwards.
+SamplingProfiler periodically samples thread stacks and writes them in the collapsed format flame graph tools
+read."""
+
+import os
+import sys
+import time
+import threading
+import traceback
+
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def collapse_stack(frame) -> str:
+    """The stack of a frame in collapsed form, outermost call first: 'a.py:main;b.py:run;c.py:handler'."""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class LoopWatchdog:
+    """This class watches one loop thread. The loop calls loop_started()/loop_finished() around each pass
+    (leaving out any deliberate pause) and begin(label)/end() around each call it wants attributed, for
+    example process_events() of one connection.
+
+    A monitor thread looks at the running pass and call every check_sec. When a call has been running for
+    more than call_threshold_sec (or a pass for more than loop_threshold_sec) its stack is sampled once
+    and logged while it is still stuck; when it ends its total duration is logged as well. Everything is
+    written through log, which is print unless given."""
+    def __init__(self, call_threshold_sec: float = 0.1, loop_threshold_sec: float = 0.5,
+                 check_sec: Optional[float] = None, log: Callable[[str], None] = print):
+        self.call_threshold_sec = call_threshold_sec
+        self.loop_threshold_sec = loop_threshold_sec
+        self.check_sec = check_sec if check_sec is not None else min(call_threshold_sec, loop_threshold_sec) / 2
+        self.log = log
+        self.stalls: int = 0
+        self.max_call_sec: float = 0.0
+        self.max_loop_sec: float = 0.0
+        self._thread_id: Optional[int] = None
+        # (label, start) of the running call and pass; replaced whole so the monitor never sees half an update
+        self._call: Optional[Tuple[str, float]] = None
+        self._loop: Optional[Tuple[str, float]] = None
+        self._sampled: Dict[Tuple[str, float], bool] = {}
+        self._stop = threading.Event()
+        self._monitor: Optional[threading.Thread] = None
+
+    def attach(self):
+        """Called from the loop thread before it starts looping."""
+        self._thread_id = threading.get_ident()
+        if self._monitor is None:
+            self._monitor = threading.Thread(target=self._watch, daemon=True, name="loop-watchdog")
+            self._monitor.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def loop_started(self):
+        self._loop = ("loop pass", time.monotonic())
+
+    def loop_finished(self):
+        entry, self._loop = self._loop, None
+        if entry is not None:
+            elapsed = time.monotonic() - entry[1]
+            self.max_loop_sec = max(self.max_loop_sec, elapsed)
+            self._finished(entry, elapsed, self.loop_threshold_sec)
+
+    def begin(self, label: str):
+        self._call = (label, time.monotonic())
+
+    def end(self):
+        entry, self._call = self._call, None
+        if entry is not None:
+            elapsed = time.monotonic() - entry[1]
+            self.max_call_sec = max(self.max_call_sec, elapsed)
+            self._finished(entry, elapsed, self.call_threshold_sec)
+
+    def _finished(self, entry: Tuple[str, float], elapsed: float, threshold: float):
+        sampled = self._sampled.pop(entry, False)
+        if elapsed > threshold:
+            self.stalls += 1
+            if not sampled:
+                self.log(f"LoopWatchdog: {entry[0]} took {elapsed * 1e3:.1f} ms")
+            else:
+                self.log(f"LoopWatchdog: {entry[0]} finished after {elapsed * 1e3:.1f} ms")
+
+    def _watch(self):
+        while not self._stop.wait(self.check_sec):
+            now = time.monotonic()
+            for entry, threshold in ((self._call, self.call_threshold_sec), (self._loop, self.loop_threshold_sec)):
+                if entry is None or entry in self._sampled or now - entry[1] <= threshold:
+                    continue
+                self._sampled[entry] = True
+                frame = sys._current_frames().get(self._thread_id)
+                stack = "".join(traceback.format_stack(frame)) if frame is not None else "(no frame)\n"
+                self.log(f"LoopWatchdog: {entry[0]} running for {(now - entry[1]) * 1e3:.1f} ms, stack:\n{stack}")
+                if entry is not self._call and entry is not self._loop:
+                    self._sampled.pop(entry, None)   # it ended while we were sampling
+                # the call is more specific than the pass it is part of, one sample is enough
+                break
+
+
+class SamplingProfiler:
+    """This class samples the stacks of threads every interval_sec from a background thread and counts
+    them. threads limits sampling to the given thread idents; by default every thread except the
+    profiler's own is sampled. write() saves the counts as collapsed stacks, one 'stack count' line each,
+    ready for flamegraph.pl or speedscope.
+
+    The sampled threads are never interrupted; the cost is one sys._current_frames() call and a stack walk
+    per sample in the profiler thread, so intervals of a few milliseconds are fine for production."""
+    def __init__(self, interval_sec: float = 0.005, threads: Optional[Iterable[int]] = None):
+        self.interval_sec = interval_sec
+        self.threads = set(threads) if threads is not None else None
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True, name="sampling-profiler")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def collapsed(self) -> List[str]:
+        return [f"{stack} {count}" for stack, count in self.samples.most_common()]
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval_sec):
+            for ident, frame in sys._current_frames().items():
+                if ident == own or (self.threads is not None and ident not in self.threads):
+                    continue
+                self.samples[collapse_stack(frame)] += 1
@@ -0,0 +1,287 @@
+"""Measurement ingestion and storage. Measurement output is parsed into typed samples and appended to a columnar
+store on disk (one set of array-backed column files per series) instead of being kept in memory as strings.
+Series can be queried by iteration range, source and target, and downsampled into time buckets."""
+
+import os
+import re
+import json
+import time
+import threading
+
+from array import array
+from typing import Callable, Dict, List, Optional, Tuple
+
+from items import MeasurementItem
+from parsed_objects import ParsedMeasurement
+
+# A parser turns the text output of a measurement into (metric, value) pairs.
+MeasurementParser = Callable[[str], List[Tuple[str, float]]]
+
+_KEY_VALUE = re.compile(r"([A-Za-z_][\w\-./]*)\s*[:=]\s*(-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)")
+_NUMBER = re.compile(r"-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?")
+_PING_RTT = re.compile(r"min/avg/max/(?:mdev|stddev) = ([\d.]+)/([\d.]+)/([\d.]+)/([\d.]+)")
+_PING_LOSS = re.compile(r"([\d.]+)% packet loss")
+
+_parsers: Dict[str, MeasurementParser] = {}
+
+
+def register_parser(m_type: str, parser: MeasurementParser):
+    """Register the parser for a measurement type (the m_type of MeasurementItem / type of ParsedMeasurement)."""
+    _parsers[m_type] = parser
+
+
+def parse_key_values(text: str) -> List[Tuple[str, float]]:
+    """Default parser: every 'name: number' or 'name=number' becomes a metric. Output without any named
+    numbers falls back to the bare numbers as value, value_1, value_2, ..."""
+    pairs = [(k, float(v)) for k, v in _KEY_VALUE.findall(text)]
+    if pairs:
+        return pairs
+    return [("value" if i == 0 else f"value_{i}", float(v)) for i, v in enumerate(_NUMBER.findall(text))]
+
+
+def parse_ping(text: str) -> List[Tuple[str, float]]:
+    pairs: List[Tuple[str, float]] = []
+    match = _PING_RTT.search(text)
+    if match:
+        pairs += list(zip(("rtt_min", "rtt_avg", "rtt_max", "rtt_mdev"), map(float, match.groups())))
+    match = _PING_LOSS.search(text)
+    if match:
+        pairs.append(("packet_loss", float(match.group(1))))
+    return pairs
+
+
+register_parser("ping", parse_ping)
+
+
+class SeriesKey:
+    """Identifies one series: measurement type, source, target and metric name."""
+    __slots__ = ("m_type", "source", "target", "metric")
+
+    def __init__(self, m_type: str, source: str, target: str, metric: str):
+        self.m_type = m_type
+        self.source = source
+        self.target = target
+        self.metric = metric
+
+    def as_tuple(self) -> Tuple[str, str, str, str]:
+        return self.m_type, self.source, self.target, self.metric
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, SeriesKey) and self.as_tuple() == other.as_tuple()
+
+    def __hash__(self) -> int:
+        return hash(self.as_tuple())
+
+    def dirname(self) -> str:
+        """A readable directory name. Different keys can map to the same one, so the store keeps the key
+        itself in the directory (see _Series.KEY_FILE) and adds a suffix on a clash."""
+        return "__".join(re.sub(r"[^\w.\-]", "_", part or "-") for part in self.as_tuple())
+
+    def get_string(self) -> str:
+        return "Series::" + ", ".join(self.as_tuple())
+
+
+class _Series:
+    """The column files of one series. Samples are buffered and appended to ts.f64, iter.i64 and
+    value.f64 a chunk at a time; chunks.i64 records (first row, end row, min iteration, max iteration) per
+    chunk so iteration range queries only read the chunks that can match. key.json holds the SeriesKey the
+    directory belongs to.
+
+    The chunk entry is written after the column data and is the commit record of the chunk: on open, the
+    columns are cut back to the end of the last complete entry, so a crash in the middle of a flush loses
+    that chunk but never leaves the columns misaligned."""
+    COLUMNS = (("ts", "d"), ("iter", "q"), ("value", "d"))
+    ENTRY = 4       # int64s per chunks.i64 entry
+    KEY_FILE = "key.json"
+
+    def __init__(self, path: str, chunk_size: int, key: Optional[SeriesKey] = None):
+        self.path = path
+        self.chunk_size = chunk_size
+        os.makedirs(path, exist_ok=True)
+        if key is not None:
+            with open(os.path.join(path, self.KEY_FILE), "w") as f:
+                json.dump(list(key.as_tuple()), f)
+        self.buffer = {name: array(code) for name, code in self.COLUMNS}
+        self.chunks = array("q")
+        self._recover()
+
+    def _recover(self):
+        """Drop a torn chunk entry and any column data that no complete entry covers."""
+        chunk_file = os.path.join(self.path, "chunks.i64")
+        if os.path.exists(chunk_file):
+            with open(chunk_file, "rb") as f:
+                data = f.read()
+            entry_size = self.ENTRY * self.chunks.itemsize
+            committed = len(data) - len(data) % entry_size
+            self.chunks.frombytes(data[:committed])
+            if committed != len(data):
+                os.truncate(chunk_file, committed)
+        self.rows = self.chunks[1 - self.ENTRY] if self.chunks else 0     # end row of the last chunk
+        for name, code in self.COLUMNS:
+            column_file = self._file(name)
+            size = self.rows * array(code).itemsize
+            if os.path.exists(column_file) and os.path.getsize(column_file) != size:
+                os.truncate(column_file, size)
+
+    @classmethod
+    def read_key(cls, path: str) -> Optional[SeriesKey]:
+        """The key stored in a series directory. Directories written before key files existed fall back
+        to their name, which is only reliable when no part contained '__' or was sanitised."""
+        key_file = os.path.join(path, cls.KEY_FILE)
+        if os.path.exists(key_file):
+            with open(key_file) as f:
+                return SeriesKey(*json.load(f))
+        parts = os.path.basename(path).split("__")
+        if len(parts) != 4:
+            return None
+        return SeriesKey(*("" if p == "-" else p for p in parts))
+
+    def _file(self, name: str) -> str:
+        ext = "i64" if name == "iter" else "f64"
+        return os.path.join(self.path, f"{name}.{ext}")
+
+    def append(self, timestamp: float, iteration: int, value: float):
+        self.buffer["ts"].append(timestamp)
+        self.buffer["iter"].append(iteration)
+        self.buffer["value"].append(value)
+        if len(self.buffer["value"]) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        count = len(self.buffer["value"])
+        if count == 0:
+            return
+        iterations = self.buffer["iter"]
+        for name, code in self.COLUMNS:
+            with open(self._file(name), "ab") as f:
+                self.buffer[name].tofile(f)
+        entry = array("q", (self.rows, self.rows + count, min(iterations), max(iterations)))
+        with open(os.path.join(self.path, "chunks.i64"), "ab") as f:
+            entry.tofile(f)
+        self.chunks.extend(entry)
+        self.rows += count
+        self.buffer = {name: array(code) for name, code in self.COLUMNS}
+
+    def read(self, first_iteration: Optional[int], last_iteration: Optional[int]) -> Dict[str, array]:
+        """Read the rows within the iteration range, chunk by chunk, plus whatever is still buffered."""
+        lo = -2 ** 63 if first_iteration is None else first_iteration
+        hi = 2 ** 63 - 1 if last_iteration is None else last_iteration
+        out = {name: array(code) for name, code in self.COLUMNS}
+        for c in range(0, len(self.chunks), self.ENTRY):
+            start, end, min_it, max_it = self.chunks[c:c + self.ENTRY]
+            if max_it < lo or min_it > hi:
+                continue
+            columns = {}
+            for name, code in self.COLUMNS:
+                column = array(code)
+                with open(self._file(name), "rb") as f:
+                    f.seek(start * column.itemsize)
+                    column.fromfile(f, end - start)
+                columns[name] = column
+            self._select(columns, lo, hi, out)
+        self._select(self.buffer, lo, hi, out)
+        return out
+
+    @staticmethod
+    def _select(columns: Dict[str, array], lo: int, hi: int, out: Dict[str, array]):
+        iterations = columns["iter"]
+        for i in range(len(iterations)):
+            if lo <= iterations[i] <= hi:
+                for name in out:
+                    out[name].append(columns[name][i])
+
+
+class MeasurementStore:
+    """This class is the append-only measurement store rooted at a directory. ingest() parses the output of
+    a measurement with the parser registered for its type and appends one sample per metric. Samples are
+    buffered per series and written in chunks of chunk_size rows; call flush() (or close()) to force the
+    buffers out. An existing store directory is reopened and appended to.
+
+    Query results are dictionaries of arrays ('ts', 'iter', 'value'), which stay compact for long
+    campaigns."""
+    def __init__(self, root: str, chunk_size: int = 4096):
+        self.root = root
+        self.chunk_size = chunk_size
+        self._series: Dict[SeriesKey, _Series] = {}
+        self._dirnames = set()
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if not os.path.isdir(path):
+                continue
+            key = _Series.read_key(path)
+            if key is not None and key not in self._series:
+                self._series[key] = _Series(path, chunk_size)
+                self._dirnames.add(name)
+
+    def append(self, key: SeriesKey, value: float, iteration: int = -1, timestamp: Optional[float] = None):
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = _Series(os.path.join(self.root, self._new_dirname(key)), self.chunk_size, key)
+                self._series[key] = series
+            series.append(time.time() if timestamp is None else timestamp, iteration, value)
+
+    def _new_dirname(self, key: SeriesKey) -> str:
+        name = base = key.dirname()
+        n = 1
+        while name in self._dirnames or os.path.exists(os.path.join(self.root, name)):
+            name = f"{base}~{n}"
+            n += 1
+        self._dirnames.add(name)
+        return name
+
+    def ingest(self, m_type: str, source: str, target: str, output: str, iteration: int = -1,
+               timestamp: Optional[float] = None) -> int:
+        """Parse measurement output and store its samples. Returns the number of samples stored."""
+        parser = _parsers.get(m_type, parse_key_values)
+        pairs = parser(output)
+        timestamp = time.time() if timestamp is None else timestamp
+        for metric, value in pairs:
+            self.append(SeriesKey(m_type, source, target, metric), value, iteration, timestamp)
+        return len(pairs)
+
+    def ingest_item(self, item: MeasurementItem, source: str, output: str, iteration: int = -1) -> int:
+        return self.ingest(item.m_type, source, item.target, output, iteration)
+
+    def ingest_measurement(self, measurement: ParsedMeasurement, output: str, iteration: int = -1) -> int:
+        return self.ingest(measurement.type, measurement.source_name, measurement.target_name, output, iteration)
+
+    def series(self, m_type: Optional[str] = None, source: Optional[str] = None, target: Optional[str] = None,
+               metric: Optional[str] = None) -> List[SeriesKey]:
+        """Series matching the given filters; None matches anything."""
+        with self._lock:
+            keys = list(self._series)
+        return [k for k in keys if (m_type is None or k.m_type == m_type) and (source is None or k.source == source)
+                and (target is None or k.target == target) and (metric is None or k.metric == metric)]
+
+    def query(self, key: SeriesKey, first_iteration: Optional[int] = None,
+              last_iteration: Optional[int] = None) -> Dict[str, array]:
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                return {name: array(code) for name, code in _Series.COLUMNS}
+            return series.read(first_iteration, last_iteration)
+
+    def downsample(self, key: SeriesKey, bucket_sec: float, first_iteration: Optional[int] = None,
+                   last_iteration: Optional[int] = None) -> List[Tuple[float, int, float, float, float]]:
+        """Aggregate a series into time buckets of bucket_sec seconds. Returns one
+        (bucket start, count, min, mean, max) tuple per non-empty bucket, in time order."""
+        data = self.query(key, first_iteration, last_iteration)
+        buckets: Dict[int, List[float]] = {}
+        for ts, value in zip(data["ts"], data["value"]):
+            b = buckets.setdefault(int(ts // bucket_sec), [0, float("inf"), 0.0, float("-inf")])
+            b[0] += 1
+            b[1] = min(b[1], value)
+            b[2] += value
+            b[3] = max(b[3], value)
+        return [(b * bucket_sec, int(n), lo, total / n, hi) for b, (n, lo, total, hi) in sorted(buckets.items())]
+
+    def flush(self):
+        with self._lock:
+            for series in self._series.values():
+                series.flush()
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,231 @@
+"""Batched execution of MinimegaItems. An item carrying mm_commands (for example the get_mm_commands() list of a VM
+or network) is run in order over one persistent minimega connection per namespace instead of one round trip per
+command, and batches for different namespaces are run concurrently."""
+
+import os
+import json
+import socket
+import threading
+import subprocess
+
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+from items import MinimegaItem
+
+MINIMEGA_SOCKET = "/tmp/minimega/minimega"
+
+
+class MinimegaSession(ABC):
+    """Interface of a connection to minimega bound to one namespace. A session is only used by one
+    thread at a time."""
+    def __init__(self, namespace: str):
+        self.namespace: str = namespace
+
+    @abstractmethod
+    def run(self, command: str) -> Tuple[int, str]:
+        pass
+
+    def close(self):
+        pass
+
+    def _namespaced(self, command: str) -> str:
+        if not self.namespace or command.startswith("namespace "):
+            return command
+        return f"namespace {self.namespace} {command}"
+
+
+class MinimegaSocketSession(MinimegaSession):
+    """Talks to the minimega daemon over its unix domain socket, the same way 'minimega -e' does, but keeps
+    the connection open between commands. A request is a JSON object with the command and the daemon
+    answers with one or more JSON responses, the last having More set to false."""
+    def __init__(self, namespace: str, path: str = MINIMEGA_SOCKET, timeout: Optional[float] = None):
+        super().__init__(namespace)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(path)
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+
+    def run(self, command: str) -> Tuple[int, str]:
+        self._sock.sendall(json.dumps({"Command": self._namespaced(command)}).encode("utf-8"))
+        exit_code, output = 0, []
+        while True:
+            response = self._read_response()
+            for resp in response.get("Resp") or []:
+                if resp.get("Error"):
+                    exit_code = 1
+                    output.append(f"{resp.get('Host', '')}: {resp['Error']}\n")
+            if response.get("Rendered"):
+                output.append(response["Rendered"].rstrip("\n") + "\n")
+            if not response.get("More"):
+                return exit_code, "".join(output)
+
+    def _read_response(self) -> Dict:
+        while True:
+            text = self._buffer.lstrip()
+            if text:
+                try:
+                    response, end = self._decoder.raw_decode(text)
+                    self._buffer = text[end:]
+                    return response
+                except ValueError:
+                    pass
+            data = self._sock.recv(65536)
+            if not data:
+                raise ConnectionError("minimega closed the connection.")
+            self._buffer = text + data.decode("utf-8", errors="replace")
+
+    def close(self):
+        self._sock.close()
+
+
+class MinimegaCliSession(MinimegaSession):
+    """Fallback that runs each command with 'minimega -e', for when the daemon socket is not reachable
+    from this process."""
+    def run(self, command: str) -> Tuple[int, str]:
+        proc = subprocess.run(["minimega", "-e", self._namespaced(command)], stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+        return proc.returncode, proc.stdout.decode("utf-8", errors="replace")
+
+
+def default_session_factory(namespace: str) -> MinimegaSession:
+    if os.path.exists(MINIMEGA_SOCKET):
+        return MinimegaSocketSession(namespace)
+    return MinimegaCliSession(namespace)
+
+
+def run_batch(item: MinimegaItem, session: MinimegaSession) -> MinimegaItem:
+    """Run the commands of an item in order on one session and fill in command_results, output and
+    exit_code (the exit code of the first failed command, 0 if all succeeded). A command that returns
+    a non-zero exit code ends the batch only with stop_on_error; a session that raises always ends it,
+    since the connection is then in an unknown state. An item with only
+    mm_command set is run as a batch of one; an item without any command (a func_to_call item, which
+    MinimegaController handles itself) is rejected with ValueError."""
+    _run_commands(item, session)
+    return item
+
+
+def batch_commands(item: MinimegaItem) -> List[str]:
+    """The commands a batch of the item runs. Raises ValueError for an item that has none."""
+    if item.mm_commands is not None:
+        return item.mm_commands
+    if item.mm_command is not None:
+        return [item.mm_command]
+    raise ValueError(f"MinimegaItem for {repr(item.namespace)} has no mm_command or mm_commands to batch "
+                     f"(func_to_call={repr(item.func_to_call)}).")
+
+
+def _run_commands(item: MinimegaItem, session: MinimegaSession) -> bool:
+    """The body of run_batch(); returns False if the session raised and should not be reused."""
+    healthy = True
+    commands = batch_commands(item)
+    item.command_results = []
+    item.exit_code = 0
+    output = []
+    for command in commands:
+        try:
+            exit_code, text = session.run(command)
+        except Exception as e:
+            item.command_results.append({"command": command, "exit_code": -1, "output": repr(e)})
+            output.append(repr(e))
+            if item.exit_code == 0:
+                item.exit_code = -1
+            healthy = False
+            break
+        item.command_results.append({"command": command, "exit_code": exit_code, "output": text})
+        output.append(text)
+        if exit_code != 0:
+            if item.exit_code == 0:
+                item.exit_code = exit_code
+            if item.stop_on_error:
+                break
+    item.output = "".join(output)
+    return healthy
+
+
+class MinimegaBatchRunner:
+    """This class runs batched MinimegaItems. Batches submitted for the same namespace run one after the
+    other in submission order on that namespace's session, so a later batch can rely on an earlier one
+    (networks before the VMs that use them). Batches for different namespaces are independent and run in
+    parallel, up to max_parallel at a time.
+
+    Sessions are created with session_factory(namespace) on first use and kept until shutdown(). A session
+    whose command raised is closed and replaced for the next batch.
+
+    Sessions talk to the minimega daemon of this host, so only items whose for_node is None or has a
+    hostname in local_hosts are accepted; items for other nodes have to be sent to that node."""
+    def __init__(self, session_factory: Callable[[str], MinimegaSession] = default_session_factory,
+                 max_parallel: int = 8, local_hosts: Iterable[str] = ("localhost", "127.0.0.1")):
+        self._factory = session_factory
+        self.local_hosts = set(local_hosts)
+        self._executor = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="mm-batch")
+        self._lanes: Dict[str, Deque[Tuple[MinimegaItem, Future]]] = {}
+        self._sessions: Dict[str, MinimegaSession] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, item: MinimegaItem) -> Future:
+        """Queue a batch. The future resolves to the same item with its results filled in. Items without
+        commands (func_to_call items) and items for a remote node are rejected here with ValueError rather
+        than queued."""
+        batch_commands(item)
+        if item.for_node is not None and item.for_node.hostname not in self.local_hosts:
+            raise ValueError(f"MinimegaItem for node {repr(item.for_node.node_alias)} "
+                             f"({item.for_node.hostname}) cannot run on this host's minimega.")
+        future: Future = Future()
+        with self._lock:
+            lane = self._lanes.get(item.namespace)
+            if lane is None:
+                lane = self._lanes[item.namespace] = deque()
+                self._executor.submit(self._drain, item.namespace)
+            lane.append((item, future))
+        return future
+
+    def run(self, item: MinimegaItem) -> MinimegaItem:
+        return self.submit(item).result()
+
+    def run_all(self, items: List[MinimegaItem]) -> List[MinimegaItem]:
+        futures = [self.submit(item) for item in items]
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+        with self._lock:
+            sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            try:
+                session.close()
+            except Exception as e:
+                print(f"MinimegaBatchRunner: error closing session for {session.namespace}: {repr(e)}")
+
+    def _drain(self, namespace: str):
+        while True:
+            with self._lock:
+                lane = self._lanes[namespace]
+                if not lane:
+                    del self._lanes[namespace]
+                    return
+                item, future = lane.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self._run_item(namespace, item))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def _run_item(self, namespace: str, item: MinimegaItem) -> MinimegaItem:
+        session = self._sessions.get(namespace)
+        if session is None:
+            session = self._factory(namespace)
+            with self._lock:
+                self._sessions[namespace] = session
+        if not _run_commands(item, session):
+            with self._lock:
+                self._sessions.pop(namespace, None)
+            try:
+                session.close()
+            except Exception:
+                pass
+        return item
@@ -0,0 +1,80 @@
+"""Precompiled command templates. A template is split once into literal text and tag segments so that
+rendering it for an iteration is a single join instead of a str.replace() pass per tag."""
+
+import re
+
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, List, Optional, Sequence, Tuple
+
+
+class CommandTemplate:
+    """This class holds one command string compiled against a set of tags. Every part of the command can
+    be compiled against its own set of tags, which is how ParsedNetwork only substitutes the iteration in
+    the bridge and tap name but the octets anywhere in the line. Tags without a value in render() are left
+    in the output unchanged, the same as not calling str.replace() for them."""
+    def __init__(self, parts: Sequence[Tuple[str, Iterable[str]]]):
+        self._segments: List[str] = []
+        self._is_tag: List[bool] = []
+        for text, tags in parts:
+            self._compile(text, tuple(tags))
+        self.tags: frozenset = frozenset(s for s, t in zip(self._segments, self._is_tag) if t)
+
+    @classmethod
+    def from_string(cls, text: str, tags: Iterable[str]) -> "CommandTemplate":
+        return cls([(text, tags)])
+
+    def _compile(self, text: str, tags: Tuple[str, ...]):
+        tags = tuple(t for t in tags if t)
+        if not tags or text == "":
+            self._add(text, False)
+            return
+        # Longest tags first so a tag that is a prefix of another one cannot split it.
+        pattern = re.compile("|".join(re.escape(t) for t in sorted(tags, key=len, reverse=True)))
+        position = 0
+        for match in pattern.finditer(text):
+            self._add(text[position:match.start()], False)
+            self._add(match.group(0), True)
+            position = match.end()
+        self._add(text[position:], False)
+
+    def _add(self, segment: str, is_tag: bool):
+        if segment == "":
+            return
+        if not is_tag and self._segments and not self._is_tag[-1]:
+            self._segments[-1] += segment      # Merge neighbouring literals.
+        else:
+            self._segments.append(segment)
+            self._is_tag.append(is_tag)
+
+    def render(self, values: Optional[Dict[str, str]] = None) -> str:
+        if not self.tags or not values:
+            return "".join(self._segments)
+        return "".join(values.get(s, s) if t else s for s, t in zip(self._segments, self._is_tag))
+
+
+class RenderCache:
+    """Small LRU cache of rendered command lists. The key is whatever identifies a rendering (iteration,
+    octets, ...) and the owner object clears the cache when the fields the templates were built from change."""
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Hashable, Tuple[str, ...]]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Tuple[str, ...]]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: Hashable, commands: Iterable[str]) -> Tuple[str, ...]:
+        entry = tuple(commands)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,140 @@
+"""Streaming netdiscover parser. Instead of collecting the whole scan into NetdiscoverItem.output and assigning
+IP addresses when the scan ends, every line is parsed as it arrives and a discovered MAC is mapped to its VM
+through set_ip_address_for_mac() right away, so an iteration can start acting on a VM as soon as it has an
+address."""
+
+import os
+import re
+import signal
+import threading
+import subprocess
+
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from items import IpAssignmentItem, NetdiscoverItem
+from parsed_objects import ParsedVirtualMachine
+
+# Matches the host lines of 'netdiscover -P' (and arp-scan style) output: IP first, then the MAC.
+_HOST_LINE = re.compile(r"^\s*(\d{1,3}(?:\.\d{1,3}){3})\s+((?:[0-9A-Fa-f]{2}[:-]){5}[0-9A-Fa-f]{2})\b")
+
+
+def parse_host_line(line: str) -> Optional[Tuple[str, str]]:
+    """Return (ip, mac) for a host line, or None for headers, separators and anything else. The MAC is
+    normalised to lower case with colons."""
+    match = _HOST_LINE.match(line)
+    if match is None:
+        return None
+    return match.group(1), match.group(2).lower().replace("-", ":")
+
+
+class NetdiscoverStreamParser:
+    """This class consumes netdiscover output incrementally. feed() accepts arbitrary chunks (partial lines
+    are kept until the rest arrives) and returns the IpAssignmentItem events for the lines completed by
+    that chunk. Each event is also handed to on_assignment if one was given, which is typically a put()
+    of a QueueItem onto the iteration's queue.
+
+    A MAC that reappears with the same address in a later scan pass does not produce a new event; a
+    changed address does."""
+    def __init__(self, vms: Iterable[ParsedVirtualMachine], for_node: str = "", iteration: int = -1,
+                 on_assignment: Optional[Callable[[IpAssignmentItem], None]] = None):
+        self.for_node = for_node
+        self.iteration = iteration
+        self.on_assignment = on_assignment
+        self._partial = ""
+        self._assigned: Dict[str, str] = {}
+        self._by_mac: Dict[str, Tuple[ParsedVirtualMachine, str]] = {}
+        for vm in vms:
+            for (mac, net, ip) in vm.mac_net_ip:
+                self._by_mac.setdefault(mac.lower(), (vm, mac))
+
+    def feed(self, data: str) -> List[IpAssignmentItem]:
+        data = self._partial + data
+        lines = data.split("\n")
+        self._partial = lines.pop()
+        events: List[IpAssignmentItem] = []
+        for line in lines:
+            event = self.feed_line(line)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def close(self) -> List[IpAssignmentItem]:
+        """Parse whatever is left of an unterminated last line."""
+        remainder, self._partial = self._partial, ""
+        event = self.feed_line(remainder) if remainder else None
+        return [event] if event is not None else []
+
+    def feed_line(self, line: str) -> Optional[IpAssignmentItem]:
+        host = parse_host_line(line)
+        if host is None:
+            return None
+        ip, mac = host
+        if self._assigned.get(mac) == ip:
+            return None
+        entry = self._by_mac.get(mac)
+        if entry is None:
+            return None
+        vm, vm_mac = entry
+        vm.set_ip_address_for_mac(ip, vm_mac)
+        self._assigned[mac] = ip
+
+        event = IpAssignmentItem(vm_name=vm.name, mac_address=vm_mac, ip_address=ip, for_node=self.for_node,
+                                 iteration=self.iteration)
+        if self.on_assignment is not None:
+            self.on_assignment(event)
+        return event
+
+    def all_assigned(self) -> bool:
+        """True once every known interface has been seen by a scan."""
+        return len(self._assigned) == len(self._by_mac)
+
+
+def run_netdiscover(item: NetdiscoverItem, parser: NetdiscoverStreamParser,
+                    timeout: Optional[float] = None, stop_when_all_assigned: bool = False) -> NetdiscoverItem:
+    """Run netdiscover for a NetdiscoverItem and stream its output through the parser line by line. The
+    full output is still collected in item.output. With stop_when_all_assigned the scan is ended as soon
+    as every interface the parser knows about has an address; that counts as success (exit_code 0), while
+    a scan cut short by the timeout keeps the exit status of the signal that ended it."""
+    proc = subprocess.Popen(item.arguments_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            bufsize=1, universal_newlines=True, start_new_session=True)
+
+    def _stop(sig=signal.SIGTERM):
+        # Signal the whole process group so helpers started by the scan (netdiscover under sudo) cannot
+        # keep running or keep stdout open.
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    # The timer ends the scan even when netdiscover goes quiet and no line arrives to check a deadline on.
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, _stop)
+        timer.daemon = True
+        timer.start()
+    output: List[str] = []
+    stopped_early = False
+    try:
+        for line in proc.stdout:
+            output.append(line)
+            parser.feed(line)
+            if stop_when_all_assigned and parser.all_assigned():
+                stopped_early = True
+                break
+        parser.close()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if proc.poll() is None:
+            _stop()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            _stop(signal.SIGKILL)
+            proc.wait()
+        proc.stdout.close()
+
+    item.output += "".join(output)
+    item.exit_code = 0 if stopped_early else proc.returncode
+    item.all_scans_complete += 1
+    return item
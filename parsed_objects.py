@@ -1,9 +1,13 @@
 
+import threading
+
 from copy import deepcopy
 from datetime import datetime
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
 
 from static_variables import *
+from mm_template import CommandTemplate, RenderCache
+from address_table import AddressTable
 
 
 # TODO: update config files for key filename instead of password and then remove password parsing entirely
@@ -21,6 +25,11 @@ class ParsedHypervisor:
         self.nic_name: str = nic_name
 
         self._current_allocations = 0
+        # The check-then-increment of the allocation count runs under this lock, and with an
+        # AllocationLedger attached (attach_ledger()) the ledger decides, across processes.
+        self._allocation_lock = threading.Lock()
+        self._ledger = None
+        self._ledger_tokens: List[Tuple[int, int]] = []
 
         self.cores: int
         if cores != "":
@@ -63,17 +72,63 @@ class ParsedHypervisor:
     def get_allocated_stats(self) -> Dict[str, int]:
         return self.dict_allocated
 
+    def attach_ledger(self, ledger):
+        """Back the allocation count with an AllocationLedger shared by all controllers, so two processes
+        can never both take the last slot of this node. The ledger is not sent along with a pickled copy;
+        a child process attaches the ledger it inherited to its own copies."""
+        with self._allocation_lock:
+            self._ledger = ledger
+
     def can_allocate_iteration(self) -> bool:
         """This method checks if the current iterations value is less that the maximum simultaneous
-        iterations and returns True or False accordingly. It is called by ResourceController."""
-        if self._current_allocations < self.max_iterations:
-            self._current_allocations += 1
-            return True
-        else:
-            return False
+        iterations and returns True or False accordingly. It is called by ResourceController. The check
+        and the increment are one atomic step."""
+        with self._allocation_lock:
+            if self._ledger is not None:
+                token = self._ledger.allocate(self.node_alias)
+                if token is None:
+                    return False
+                self._ledger_tokens.append(token)
+                self._current_allocations += 1
+                return True
+            if self._current_allocations < self.max_iterations:
+                self._current_allocations += 1
+                return True
+            else:
+                return False
 
     def decrement_current_allocations(self):
-        self._current_allocations -= 1
+        """Give back an iteration taken with can_allocate_iteration(). A release without a matching
+        allocation is a bookkeeping error and raises ValueError rather than being absorbed."""
+        with self._allocation_lock:
+            if self._current_allocations <= 0:
+                raise ValueError(f"Hypervisor {self.node_alias}: release without a matching allocation.")
+            self._current_allocations -= 1
+            if self._ledger is not None and self._ledger_tokens:
+                self._ledger.release(self._ledger_tokens.pop())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_allocation_lock"]
+        state["_ledger"] = None
+        state["_ledger_tokens"] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._allocation_lock = threading.Lock()
+
+    def add_allocated_resources(self, cpu: int, ram: int, disk: int):
+        """Record resources handed to an iteration placed on this node. It is called by HypervisorAllocator
+        which also takes care of the iteration count."""
+        self.dict_allocated["cpu"] += cpu
+        self.dict_allocated["ram"] += ram
+        self.dict_allocated["disk"] += disk
+
+    def remove_allocated_resources(self, cpu: int, ram: int, disk: int):
+        self.dict_allocated["cpu"] -= cpu
+        self.dict_allocated["ram"] -= ram
+        self.dict_allocated["disk"] -= disk
 
 
 class ParsedCyberNode:
@@ -97,6 +152,10 @@ class ParsedNetwork:
     # class variable--not instance
     tap_iterator = 0
 
+    # fields the minimega command templates are compiled from
+    _MM_FIELDS = frozenset(("alias", "bridge", "tap_name", "tap_ip", "tap_netmask", "dhcp_start", "dhcp_end",
+                            "config_file"))
+
     def __init__(self, switch_name: str, alias: str, bridge: str, tap_name: Optional[str], tap_ip: str, tap_netmask: str,
                  dhcp_start: str = "", dhcp_end: str = "", config_file: str = ""):
 
@@ -145,41 +204,78 @@ class ParsedNetwork:
     def get_iface(self, iter) -> str:
         return self.interface_name.replace(TAG_ITERATION, str(iter))
 
-    def get_mm_commands(self, iter: int, b_ctl: bool=False, octet3="", octet4="") -> List[str]:
-        commands = []
-        # b_ctl: bool = STR_CONTROL_INTERFACE in self.alias
-
-        # NOTE: no need to specify namespace because the iteration controller
-        # will be using a minimega connection object which is namespace specific
-        t = "tap create " + self.alias + " bridge " + self.bridge.replace(TAG_ITERATION, str(iter)) +\
-            " ip " + self.tap_ip + "/" + self.tap_netmask
-
+    def __setattr__(self, name, value):
+        """Drop the compiled command templates whenever a field they were built from changes."""
+        object.__setattr__(self, name, value)
+        if name in ParsedNetwork._MM_FIELDS:
+            self.__dict__.pop("_mm_templates", None)
+            self.__dict__.pop("_mm_cache", None)
+
+    def _compile_mm_templates(self) -> List[CommandTemplate]:
+        """Compile the tap and dnsmasq commands once. The iteration is only substituted in the bridge and
+        tap name while the octets are substituted anywhere in the line, exactly as the str.replace() calls
+        of the original implementation did."""
+        tags_iter = (TAG_ITERATION, TAG_OCTET_3, TAG_BASE_PLUS1)
+        tags_ctl = (TAG_OCTET_3, TAG_BASE_PLUS1)
+
+        parts = [("tap create " + self.alias + " bridge ", tags_ctl),
+                 (self.bridge, tags_iter),
+                 (" ip " + self.tap_ip + "/" + self.tap_netmask, tags_ctl)]
         if self.tap_name is not None:
-            t = t + " " + self.tap_name.replace(TAG_ITERATION, str(iter))
+            parts.append((" " + self.tap_name, tags_iter))
+        templates = [CommandTemplate(parts)]
 
-        if b_ctl:
-            t = t.replace(TAG_OCTET_3, octet3)
-            t = t.replace(TAG_BASE_PLUS1, octet4)
+        if (not self.dhcp_start == "") and (not self.dhcp_end == ""):
+            parts = [("dnsmasq start " + self.tap_ip + " " + self.dhcp_start + " " + self.dhcp_end,
+                      (TAG_OCTET_3, TAG_BASE_PLUS1, TAG_BASE_PLUS2))]
+            if (self.config_file is not None) and (self.config_file != ""):
+                parts.append((" " + self.config_file, ()))
+            templates.append(CommandTemplate(parts))
 
-        commands.append(t)
+        return templates
 
-        if (not self.dhcp_start == "") and (not self.dhcp_end == ""):
-            d = "dnsmasq start " + self.tap_ip + " " + self.dhcp_start + " " + self.dhcp_end
+    def get_mm_commands(self, iter: int, b_ctl: bool=False, octet3="", octet4="") -> List[str]:
+        # NOTE: no need to specify namespace because the iteration controller
+        # will be using a minimega connection object which is namespace specific
 
+        # b_ctl: bool = STR_CONTROL_INTERFACE in self.alias
+        key = (iter, b_ctl, octet3, octet4) if b_ctl else (iter, False)
+        cache: RenderCache = self.__dict__.get("_mm_cache")
+        if cache is None:
+            cache = RenderCache()
+            self.__dict__["_mm_cache"] = cache
+        commands = cache.get(key)
+
+        if commands is None:
+            templates: List[CommandTemplate] = self.__dict__.get("_mm_templates")
+            if templates is None:
+                templates = self._compile_mm_templates()
+                self.__dict__["_mm_templates"] = templates
+
+            values = {TAG_ITERATION: str(iter)}
             if b_ctl:
-                d = d.replace(TAG_OCTET_3, octet3)
-                d = d.replace(TAG_BASE_PLUS1, octet4)
-                d = d.replace(TAG_BASE_PLUS2, str(int(octet4)+1))
+                values[TAG_OCTET_3] = octet3
+                values[TAG_BASE_PLUS1] = octet4
+                if len(templates) > 1:
+                    values[TAG_BASE_PLUS2] = str(int(octet4) + 1)
 
-            if (self.config_file is not None) and (self.config_file != ""):
-                d += " " + self.config_file
-            commands.append(d)
-            
-        return commands
+            # The iteration is never substituted in the dnsmasq line.
+            commands = [templates[0].render(values)]
+            if len(templates) > 1:
+                values.pop(TAG_ITERATION)
+                commands.append(templates[1].render(values))
+            commands = cache.put(key, commands)
+
+        return list(commands)
 
 
 # encapsulates virtual machine details and generates launch commands
 class ParsedVirtualMachine:
+
+    # fields the minimega commands are generated from
+    _MM_FIELDS = frozenset(("name", "cpu_arch", "cpus", "memory", "disk", "cdroms", "nets", "drive_snapshot",
+                            "state_snapshot", "mm_passthrough"))
+
     def __init__(self, name: str, cpu_arch: str, cpus: int, memory: int, disk: str, cdroms: List[str], nets: List[str],
                  operating_system: str="", drive_snapshot: str="true", analyze: bool = False,
                  state_snapshot: str="", mm_passthrough: Dict[str, Any]=None):
@@ -202,7 +298,7 @@ class ParsedVirtualMachine:
         """ip_address should be set by parser if static or detection from minimega/netdiscover."""
         self.ip_address = ""
 
-        self.mac_net_ip: (str, str, str) = []
+        self.mac_net_ip: AddressTable = AddressTable()     # (mac, net, ip) tuples indexed by mac and net
 
         for n in self.nets:
             try:
@@ -258,7 +354,26 @@ class ParsedVirtualMachine:
 
         return resources
 
+    def __setattr__(self, name, value):
+        """Drop the cached minimega commands whenever a field they are generated from is replaced. Call
+        invalidate_mm_commands() after changing one of the lists or the passthrough dict in place."""
+        object.__setattr__(self, name, value)
+        if name in ParsedVirtualMachine._MM_FIELDS:
+            self.__dict__.pop("_mm_commands", None)
+
+    def invalidate_mm_commands(self) -> None:
+        self.__dict__.pop("_mm_commands", None)
+
     def get_mm_commands(self) -> List[str]:
+        """The command list only depends on the parsed fields, so it is generated once and a copy of the
+        cached list is handed out on every following call."""
+        commands = self.__dict__.get("_mm_commands")
+        if commands is None:
+            commands = tuple(self._generate_mm_commands())
+            self.__dict__["_mm_commands"] = commands
+        return list(commands)
+
+    def _generate_mm_commands(self) -> List[str]:
 
         # NOTE: keep these in order or spend a few more hours debugging ARM launches
 
@@ -446,13 +561,7 @@ class ParsedVirtualMachine:
 
     def reset_ip_addresses(self) -> None:
         self.ip_address = ""
-
-        for i in range(len(self.mac_net_ip)):
-            (mac, net, ip) = self.mac_net_ip[i]
-            new_tup = (mac, net, "")
-            self.mac_net_ip[i] = new_tup
-            # (alias, ip) = self.mac_net_ip[mac]
-            # self.mac_net_ip[mac] = (alias, "")
+        self.mac_net_ip.reset_ips()
 
     def set_ip_address(self, ip: str) -> None:
         self.ip_address = ip
@@ -468,65 +577,29 @@ class ParsedVirtualMachine:
 
     def get_any_ip_address(self) -> Optional[str]:
 
-        # for mac in self.mac_net_ip:
-        #     (alias, ip) = self.mac_net_ip[mac]
-        #
-        #     if (ip is not None) and (ip != ""):
-        #         return ip
-
-        reverse_list = self.mac_net_ip[::-1]    # looking for IP in reverse order to solve interface disappearance bug
-
-        """This print statement was causing an a acquire_lock dead lock. Why? Is it because logging is writing
-        both to the screen and to a file and the conflict was writing to the screen? TLT does not know..."""
-        # print(f"Reverse list: {reverse_list}")
+        """The address table looks for an IP in reverse order to solve the interface disappearance bug and
+        caches the answer until an address changes.
 
-        for i in range(len(reverse_list)):
-            # print(f"Reverse network {i} = {reverse_list[i]}")
-            (mac, net, ip) = reverse_list[i]
-
-            if (ip is not None) and (ip != "") and "10.254" not in ip:
-                return ip
-
-        return None
+        A print statement of the reverse list was causing an a acquire_lock dead lock. Why? Is it because
+        logging is writing both to the screen and to a file and the conflict was writing to the screen? TLT
+        does not know..."""
+        return self.mac_net_ip.get_any_ip()
 
     def get_ip_address_on_net(self, net_alias: str) -> Optional[str]:
-
-        for (mac, net, ip) in self.mac_net_ip:
-            if net == net_alias:
-                return ip
-
-        # for mac in self.mac_net_ip:
-        #     (alias, ip) = self.mac_net_ip[mac]
-        #     if alias == net_alias:
-        #         return ip
-
-        return None
+        return self.mac_net_ip.get_ip_on_net(net_alias)
 
     def set_ip_address_for_mac(self, ip_address: str, mac_address: str) -> str:
-        for i in range(len(self.mac_net_ip)):
-            (mac, net, ip) = self.mac_net_ip[i]
-            if mac == mac_address:
-                new_tup = (mac, net, ip_address)
-                self.mac_net_ip[i] = new_tup
-                return "Success"
-            else:
-                continue
+        if self.mac_net_ip.set_ip_for_mac(ip_address, mac_address):
+            return "Success"
         return f"ERROR: Could not load tuple for mac: {mac_address}"
 
-    def has_an_ip_address(self) -> bool:
-        has_one = False
-
-        for (mac, net, ip) in self.mac_net_ip:
-            if (ip is not None) and (ip != ""):
-                has_one = True
-                break
+    def update_ip_addresses_from_scan(self, ip_mac_pairs: List[Tuple[str, str]]) -> int:
+        """Bulk update from the (ip, mac) pairs of a netdiscover scan. Returns the number of interfaces
+        of this VM that were updated."""
+        return self.mac_net_ip.update_from_scan(ip_mac_pairs)
 
-        # for mac in self.mac_net_ip:
-        #     (alias, ip) = self.mac_net_ip[mac]
-        #     if (ip is not None) and (ip != ""):
-        #         has_one = True
-
-        return has_one
+    def has_an_ip_address(self) -> bool:
+        return self.mac_net_ip.has_an_ip()
 
     def has_a_management_ip_address(self) -> bool:
 
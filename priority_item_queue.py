@@ -0,0 +1,208 @@
+"""Priority-aware queue for QueueItem traffic. Control and stage items are handed out ahead of measurement
+and output items so that a flood of OutputItem traffic cannot hold up a kill/reset request or a stage
+transition. Items of the same class are handed out round-robin across iterations, and items that have
+been waiting for a while are aged upward so output is never starved."""
+
+import time
+import threading
+
+from collections import deque, OrderedDict
+from queue import Empty, Full
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from items import *
+
+# Priority classes; lower values are served first.
+PRIORITY_CONTROL = 0
+PRIORITY_STAGE = 1
+PRIORITY_MEASUREMENT = 2
+PRIORITY_OUTPUT = 3
+
+# Items not listed here are scheduled with the measurement class which sits between stage traffic and
+# plain output.
+PRIORITY_BY_ITEM_TYPE: Dict[type, int] = {
+    AgentControlItem: PRIORITY_CONTROL,
+    StageItem: PRIORITY_STAGE,
+    MeasurementItem: PRIORITY_MEASUREMENT,
+    OutputItem: PRIORITY_OUTPUT,
+    LoggingItem: PRIORITY_OUTPUT,
+}
+PRIORITY_DEFAULT = PRIORITY_MEASUREMENT
+
+
+def get_item_priority(queue_item: Any) -> int:
+    """Return the priority class of a QueueItem based on the type of the item it carries. Anything that
+    is not a QueueItem is treated as default priority."""
+    item = getattr(queue_item, "item", None)
+    return PRIORITY_BY_ITEM_TYPE.get(type(item), PRIORITY_DEFAULT)
+
+
+def get_item_iteration(queue_item: Any) -> int:
+    """Return the iteration a QueueItem belongs to. The destination iteration wins, then the source
+    iteration, then any iteration carried by the inner item. -1 means 'not iteration specific'."""
+    iteration = getattr(queue_item, "to_iteration", -1)
+    if iteration == -1:
+        iteration = getattr(queue_item, "from_iteration", -1)
+    if iteration == -1:
+        item = getattr(queue_item, "item", None)
+        iteration = getattr(item, "iteration", getattr(item, "new_iteration", -1))
+    return iteration
+
+
+class _PriorityClass:
+    """The pending items of one priority class, kept as one FIFO per iteration. The iterations are
+    rotated so each iteration gets a turn before any iteration gets a second one."""
+    def __init__(self):
+        self.lanes: "OrderedDict[int, Deque[Tuple[float, Any]]]" = OrderedDict()
+        self.size = 0
+
+    def push(self, iteration: int, enqueue_time: float, queue_item: Any):
+        lane = self.lanes.get(iteration)
+        if lane is None:
+            lane = deque()
+            self.lanes[iteration] = lane
+        lane.append((enqueue_time, queue_item))
+        self.size += 1
+
+    def oldest_time(self) -> float:
+        return min(lane[0][0] for lane in self.lanes.values())
+
+    def pop(self, oldest: bool = False) -> Any:
+        """The next item in round-robin order, or with oldest the item that has been waiting longest (the
+        one the class's aging score was based on)."""
+        if oldest:
+            iteration, lane = min(self.lanes.items(), key=lambda entry: entry[1][0][0])
+        else:
+            iteration, lane = next(iter(self.lanes.items()))
+        _, queue_item = lane.popleft()
+        if lane:
+            self.lanes.move_to_end(iteration)   # Next iteration gets the next turn.
+        else:
+            del self.lanes[iteration]
+        self.size -= 1
+        return queue_item
+
+
+class PriorityItemQueue:
+    """This class is a drop-in replacement for queue.Queue on the in-process (thread to thread) queues that
+    carry QueueItem. It exposes put(), get(), put_nowait(), get_nowait(), qsize(), empty(), full(),
+    task_done() and join() with the same semantics.
+
+    It can not replace a multiprocessing.Queue or a manager queue: the items and the locks live in this
+    process, so a copy handed to a child process (for example through Process args) is a separate,
+    unconnected queue. Queues between the controller and its worker processes stay multiprocessing
+    queues; a PriorityItemQueue can sit behind one, filled by the thread that drains it.
+
+    The class to serve next is the one with the lowest effective priority, which is its class value
+    minus one for every aging_sec seconds its oldest item has been waiting. With the default of 2 seconds
+    an output item that has been waiting 6 seconds competes on equal terms with a fresh control item.
+    A class that is only served because of aging hands out that oldest item, not its round-robin turn."""
+    def __init__(self, maxsize: int = 0, aging_sec: float = 2.0):
+        self.maxsize = maxsize
+        self.aging_sec = aging_sec
+        self._classes: List[_PriorityClass] = [_PriorityClass() for _ in range(PRIORITY_OUTPUT + 1)]
+        self._size = 0
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+        self._all_tasks_done = threading.Condition(self._mutex)
+        self._unfinished_tasks = 0
+
+    def qsize(self) -> int:
+        with self._mutex:
+            return self._size
+
+    def empty(self) -> bool:
+        with self._mutex:
+            return self._size == 0
+
+    def full(self) -> bool:
+        with self._mutex:
+            return 0 < self.maxsize <= self._size
+
+    def put(self, queue_item: Any, block: bool = True, timeout: Optional[float] = None):
+        with self._not_full:
+            if 0 < self.maxsize:
+                if not block:
+                    if self._size >= self.maxsize:
+                        raise Full
+                elif timeout is None:
+                    while self._size >= self.maxsize:
+                        self._not_full.wait()
+                else:
+                    end_time = time.monotonic() + timeout
+                    while self._size >= self.maxsize:
+                        remaining = end_time - time.monotonic()
+                        if remaining <= 0.0:
+                            raise Full
+                        self._not_full.wait(remaining)
+            priority = get_item_priority(queue_item)
+            self._classes[priority].push(get_item_iteration(queue_item), time.monotonic(), queue_item)
+            self._size += 1
+            self._unfinished_tasks += 1
+            self._not_empty.notify()
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Any:
+        with self._not_empty:
+            if not block:
+                if self._size == 0:
+                    raise Empty
+            elif timeout is None:
+                while self._size == 0:
+                    self._not_empty.wait()
+            else:
+                end_time = time.monotonic() + timeout
+                while self._size == 0:
+                    remaining = end_time - time.monotonic()
+                    if remaining <= 0.0:
+                        raise Empty
+                    self._not_empty.wait(remaining)
+            priority_class, aged = self._select_class()
+            queue_item = priority_class.pop(oldest=aged)
+            self._size -= 1
+            self._not_full.notify()
+            return queue_item
+
+    def task_done(self):
+        """Mark an item taken with get() as processed, as queue.Queue.task_done() does."""
+        with self._all_tasks_done:
+            unfinished = self._unfinished_tasks - 1
+            if unfinished < 0:
+                raise ValueError("task_done() called too many times")
+            if unfinished == 0:
+                self._all_tasks_done.notify_all()
+            self._unfinished_tasks = unfinished
+
+    def join(self):
+        """Block until every item put on the queue has been got and marked with task_done()."""
+        with self._all_tasks_done:
+            while self._unfinished_tasks:
+                self._all_tasks_done.wait()
+
+    def put_nowait(self, queue_item: Any):
+        self.put(queue_item, block=False)
+
+    def get_nowait(self) -> Any:
+        return self.get(block=False)
+
+    def _select_class(self) -> Tuple[_PriorityClass, bool]:
+        """Pick the priority class to serve next, taking aging into account, and say whether it only won
+        because of aging (a class with a better priority value has items too). Called with the mutex held
+        and only when the queue is not empty."""
+        now = time.monotonic()
+        best: Optional[_PriorityClass] = None
+        best_priority = first_priority = -1
+        best_score = 0.0
+        for priority, priority_class in enumerate(self._classes):
+            if priority_class.size == 0:
+                continue
+            if first_priority == -1:
+                first_priority = priority
+            score = priority
+            if self.aging_sec > 0:
+                score -= (now - priority_class.oldest_time()) / self.aging_sec
+            if best is None or score < best_score:
+                best = priority_class
+                best_priority = priority
+                best_score = score
+        return best, best_priority != first_priority
@@ -0,0 +1,191 @@
+"""Caching of resource availability. ResourceIndex runs on a node and answers ResourceCheckItem requests from
+cached file metadata. ResourceAvailabilityCache runs on the controller side and keeps track of what each node
+is already known to have, so the same multi-GB images are not checked again for every iteration."""
+
+import os
+import time
+import hashlib
+import threading
+
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from items import ResourceCheckItem
+from parsed_objects import ParsedVirtualMachine
+
+
+def collect_resources(vms: Iterable[ParsedVirtualMachine]) -> List[str]:
+    """Union of get_resources() over a set of VMs in first-seen order. Many VMs (and every iteration)
+    share the same images, so this is usually much shorter than the concatenated lists."""
+    seen: Dict[str, None] = {}
+    for vm in vms:
+        for resource in vm.get_resources():
+            seen.setdefault(resource, None)
+    return list(seen)
+
+
+class ResourceRecord:
+    """What is known about one file. The (size, mtime_ns, inode) triple is the validator; as long as it
+    does not change the cached digest is trusted."""
+    def __init__(self, path: str):
+        self.path: str = path
+        self.exists: bool = False
+        self.size: int = -1
+        self.mtime_ns: int = -1
+        self.inode: int = -1
+        self.digest: Optional[str] = None
+        self.checked_time: float = 0.0
+
+    def validator(self) -> Tuple[int, int, int]:
+        return self.size, self.mtime_ns, self.inode
+
+    def print_data(self) -> str:
+        s = "ResourceRecord:\n"
+        s += f"\tpath: {self.path}\n"
+        s += f"\texists: {self.exists}\n"
+        s += f"\tsize: {self.size}\n"
+        s += f"\tmtime_ns: {self.mtime_ns}\n"
+        s += f"\tdigest: {self.digest}\n"
+        return s
+
+
+class ResourceIndex:
+    """This class is the per-node resource index. A record is re-validated with os.stat() once it is
+    older than recheck_sec (0 means on every lookup, which is cheap) and the content hash, if one is
+    asked for, is only recomputed when size, mtime or inode changed. Files with identical content are
+    grouped by digest so duplicate images under different names can be found.
+
+    The index is safe to share between the threads of the node agent."""
+    def __init__(self, recheck_sec: float = 0.0, hash_algorithm: str = "sha256", hash_chunk_size: int = 1 << 20):
+        self.recheck_sec = recheck_sec
+        self.hash_algorithm = hash_algorithm
+        self.hash_chunk_size = hash_chunk_size
+        self._records: Dict[str, ResourceRecord] = {}
+        self._by_digest: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, path: str, with_digest: bool = False) -> ResourceRecord:
+        with self._lock:
+            record = self._records.get(path)
+            if record is None:
+                record = ResourceRecord(path)
+                self._records[path] = record
+            if record.checked_time == 0.0 or time.time() - record.checked_time >= self.recheck_sec:
+                self._revalidate(record)
+
+        if with_digest and record.exists and record.digest is None:
+            validator = record.validator()
+            digest = self._hash_file(path)
+            with self._lock:
+                if record.validator() == validator:     # Unchanged while hashing.
+                    record.digest = digest
+                    self._by_digest.setdefault(digest, set()).add(path)
+        return record
+
+    def is_available(self, path: str) -> bool:
+        return self.lookup(path).exists
+
+    def check(self, item: ResourceCheckItem) -> ResourceCheckItem:
+        """Answer a ResourceCheckItem from the index. Duplicates in files_to_check are only looked up once."""
+        unavailable: List[str] = []
+        for path in dict.fromkeys(item.files_to_check):
+            if not self.is_available(path):
+                unavailable.append(path)
+        item.unavailable_files_list = unavailable
+        return item
+
+    def get_duplicates(self, path: str) -> List[str]:
+        """Other files known to have the same content as path."""
+        record = self.lookup(path, with_digest=True)
+        if record.digest is None:
+            return []
+        with self._lock:
+            return sorted(p for p in self._by_digest.get(record.digest, ()) if p != path)
+
+    def invalidate(self, path: Optional[str] = None):
+        """Forget one path, or everything. Call this after copying a resource onto the node."""
+        with self._lock:
+            paths = list(self._records) if path is None else [path]
+            for p in paths:
+                record = self._records.pop(p, None)
+                if record is not None:
+                    self._forget_digest(record)
+
+    def _revalidate(self, record: ResourceRecord):
+        """Refresh a record from os.stat(). Called with the lock held."""
+        try:
+            st = os.stat(record.path)
+        except OSError:
+            exists, validator = False, (-1, -1, -1)
+        else:
+            exists, validator = True, (st.st_size, st.st_mtime_ns, st.st_ino)
+
+        if not exists or validator != record.validator():
+            self._forget_digest(record)
+            record.digest = None
+        record.exists = exists
+        record.size, record.mtime_ns, record.inode = validator
+        record.checked_time = time.time()
+
+    def _forget_digest(self, record: ResourceRecord):
+        if record.digest is not None:
+            paths = self._by_digest.get(record.digest)
+            if paths is not None:
+                paths.discard(record.path)
+                if not paths:
+                    del self._by_digest[record.digest]
+
+    def _hash_file(self, path: str) -> str:
+        h = hashlib.new(self.hash_algorithm)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(self.hash_chunk_size), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+
+class ResourceAvailabilityCache:
+    """This class is the controller side of the cache. It remembers per node which resources were
+    reported available and for how long that answer is trusted (ttl_sec). build_check_item() then only
+    asks a node about the files it has not confirmed recently, and returns None when there is nothing to
+    ask, so repeated iterations with the same VMs do not generate any ResourceCheckItem traffic at all.
+    Missing files are never cached; they are asked about again every time."""
+    def __init__(self, ttl_sec: float = 600.0):
+        self.ttl_sec = ttl_sec
+        self._available: Dict[str, Dict[str, float]] = {}      # node -> path -> confirmed time
+        self._lock = threading.Lock()
+
+    def files_to_check(self, node: str, files: Iterable[str]) -> List[str]:
+        now = time.time()
+        with self._lock:
+            known = self._available.get(node, {})
+            return [f for f in dict.fromkeys(files) if now - known.get(f, -self.ttl_sec - 1.0) > self.ttl_sec]
+
+    def build_check_item(self, node: str, vms: Iterable[ParsedVirtualMachine]) -> Optional[ResourceCheckItem]:
+        files = self.files_to_check(node, collect_resources(vms))
+        return ResourceCheckItem(for_node=node, files_to_check=files) if files else None
+
+    def record_result(self, item: ResourceCheckItem):
+        """Store the answer of a completed ResourceCheckItem."""
+        now = time.time()
+        unavailable = set(item.unavailable_files_list)
+        with self._lock:
+            known = self._available.setdefault(item.for_node, {})
+            for f in item.files_to_check:
+                if f in unavailable:
+                    known.pop(f, None)
+                else:
+                    known[f] = now
+
+    def mark_available(self, node: str, files: Iterable[str]):
+        """Record files that were just staged onto a node."""
+        now = time.time()
+        with self._lock:
+            known = self._available.setdefault(node, {})
+            for f in files:
+                known[f] = now
+
+    def invalidate(self, node: Optional[str] = None):
+        with self._lock:
+            if node is None:
+                self._available.clear()
+            else:
+                self._available.pop(node, None)
@@ -0,0 +1,220 @@
+"""Parallel staging of VM resources onto hypervisor nodes. The stager works out which nodes lack which of the
+files returned by get_resources(), copies them with bounded concurrency, and can prefetch the resources of the
+iterations queued next while the current ones are running."""
+
+import os
+import json
+import errno
+import shlex
+import shutil
+import threading
+import subprocess
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from parsed_objects import ParsedHypervisor, ParsedVirtualMachine
+from resource_index import ResourceAvailabilityCache, collect_resources
+
+# Signature of the function that answers "which of these files does this node lack?"
+MissingFilesFunc = Callable[[ParsedHypervisor, List[str]], List[str]]
+
+
+class StageResult:
+    """Outcome of copying one file to one node."""
+    def __init__(self, node_alias: str, path: str):
+        self.node_alias: str = node_alias
+        self.path: str = path
+        self.method: str = ""       # "hardlink", "local", or "rsync"
+        self.output: str = ""
+        self.exit_code: int = -1
+
+    def print_data(self) -> str:
+        s = "StageResult:\n"
+        s += f"\tnode_alias: {self.node_alias}\n"
+        s += f"\tpath: {self.path}\n"
+        s += f"\tmethod: {self.method}\n"
+        s += f"\toutput: {self.output}\n"
+        s += f"\texit_code: {self.exit_code}\n"
+        return s
+
+
+def copy_sparse(src: str, dst: str, chunk_size: int = 1 << 22) -> None:
+    """Copy a file preserving holes and resuming a previous partial copy. Only the data regions of the
+    source are read (SEEK_DATA/SEEK_HOLE). The copy goes to dst.partial, which is renamed into place when
+    complete, so a leftover dst.partial from an interrupted attempt is continued where it stopped.
+    dst.partial.src records the size and mtime of the source the partial copy was taken from; if the
+    source has changed since, the copy starts over instead of splicing two versions together."""
+    partial = dst + ".partial"
+    sidecar = partial + ".src"
+    src_stat = os.stat(src)
+    size = src_stat.st_size
+    source_id = {"size": size, "mtime_ns": src_stat.st_mtime_ns}
+    done = 0
+    if os.path.exists(partial):
+        try:
+            with open(sidecar) as f:
+                if json.load(f) == source_id:
+                    done = os.path.getsize(partial)
+        except (OSError, ValueError):
+            pass        # No usable record of the source: the partial copy cannot be trusted.
+    if not done:
+        with open(sidecar, "w") as f:
+            json.dump(source_id, f)
+
+    with open(src, "rb") as fin, open(partial, "r+b" if done else "wb") as fout:
+        offset = done
+        while offset < size:
+            try:
+                data_start = os.lseek(fin.fileno(), offset, os.SEEK_DATA)
+                data_end = os.lseek(fin.fileno(), data_start, os.SEEK_HOLE)
+            except AttributeError:
+                data_start, data_end = offset, size     # No SEEK_DATA on this platform, copy densely.
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break       # Only a hole is left; truncate() below extends the file over it.
+                if e.errno != errno.EINVAL:
+                    raise
+                data_start, data_end = offset, size     # No hole support in this file system, copy densely.
+            while data_start < data_end:
+                length = min(chunk_size, data_end - data_start)
+                fin.seek(data_start)
+                fout.seek(data_start)
+                fout.write(fin.read(length))
+                data_start += length
+            offset = data_end
+        fout.truncate(size)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(partial, dst)
+    os.remove(sidecar)
+
+
+class ResourceStager:
+    """This class stages resources onto nodes. missing_files() is supplied by the caller (typically a
+    ResourceCheckItem round trip or a ResourceIndex on the node) and is skipped for files the
+    ResourceAvailabilityCache already confirmed.
+
+    Every file is copied from source_root on the controller to the same path on the node. Local nodes
+    (hostname in local_hosts) get a hardlink when source and destination share a file system and a sparse,
+    resumable copy otherwise. Remote nodes are copied with rsync over ssh using the node credentials, with
+    --sparse and --partial so an interrupted transfer resumes rather than restarts; an rsync that runs
+    longer than copy_timeout seconds is killed and reported as failed. max_parallel bounds the total
+    number of copies and max_per_node the copies to a single node."""
+    def __init__(self, missing_files: MissingFilesFunc, source_root: str = "/",
+                 availability: Optional[ResourceAvailabilityCache] = None, max_parallel: int = 8,
+                 max_per_node: int = 2, local_hosts: Iterable[str] = ("localhost", "127.0.0.1"),
+                 copy_timeout: Optional[float] = 3600.0):
+        self._missing_files = missing_files
+        self.source_root = source_root
+        self.availability = availability if availability is not None else ResourceAvailabilityCache()
+        self.local_hosts = set(local_hosts)
+        self.max_per_node = max_per_node
+        self.copy_timeout = copy_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="stager")
+        # Prefetches wait on copies, so they run outside the copy pool to keep them from starving it.
+        self._prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self._node_slots: Dict[str, threading.Semaphore] = {}
+        self._in_flight: Dict[Tuple[str, str], Future] = {}
+        self._lock = threading.Lock()
+
+    def plan(self, placements: Dict[ParsedHypervisor, Iterable[ParsedVirtualMachine]]) -> Dict[str, List[str]]:
+        """Work out which files each node lacks for the VMs scheduled on it."""
+        plan: Dict[str, List[str]] = {}
+        for node, vms in placements.items():
+            candidates = self.availability.files_to_check(node.node_alias, collect_resources(vms))
+            missing = self._missing_files(node, candidates) if candidates else []
+            missing_set = set(missing)
+            self.availability.mark_available(node.node_alias, [f for f in candidates if f not in missing_set])
+            if missing:
+                plan[node.node_alias] = missing
+        return plan
+
+    def stage(self, placements: Dict[ParsedHypervisor, Iterable[ParsedVirtualMachine]]) -> List[Future]:
+        """Start copying everything the placements need. Returns one future per copy; each resolves to a
+        StageResult. Copies that are already running (for example from a prefetch) are shared."""
+        nodes = {node.node_alias: node for node in placements}
+        futures: List[Future] = []
+        for alias, files in self.plan(placements).items():
+            for path in files:
+                futures.append(self._submit(nodes[alias], path))
+        return futures
+
+    def stage_and_wait(self,
+                       placements: Dict[ParsedHypervisor, Iterable[ParsedVirtualMachine]]) -> List[StageResult]:
+        return [f.result() for f in self.stage(placements)]
+
+    def prefetch(self, upcoming: Dict[ParsedHypervisor, Iterable[ParsedVirtualMachine]]) -> Future:
+        """Stage the resources for iterations queued next in the background. The returned future resolves
+        to the list of StageResult once everything is copied."""
+        return self._prefetcher.submit(self.stage_and_wait, upcoming)
+
+    def shutdown(self, wait: bool = True):
+        self._prefetcher.shutdown(wait=wait)
+        self._executor.shutdown(wait=wait)
+
+    def _submit(self, node: ParsedHypervisor, path: str) -> Future:
+        key = (node.node_alias, path)
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is None:
+                future = self._executor.submit(self._copy, node, path)
+                self._in_flight[key] = future
+                future.add_done_callback(lambda f, k=key: self._done(k, f))
+            return future
+
+    def _done(self, key: Tuple[str, str], future: Future):
+        with self._lock:
+            self._in_flight.pop(key, None)
+        result: StageResult = future.result() if future.exception() is None else None
+        if result is not None and result.exit_code == 0:
+            self.availability.mark_available(result.node_alias, [result.path])
+
+    def _copy(self, node: ParsedHypervisor, path: str) -> StageResult:
+        with self._lock:
+            slots = self._node_slots.setdefault(node.node_alias, threading.Semaphore(self.max_per_node))
+        result = StageResult(node.node_alias, path)
+        source = os.path.join(self.source_root, path.lstrip("/"))
+        with slots:
+            try:
+                if node.hostname in self.local_hosts:
+                    self._copy_local(source, path, result)
+                else:
+                    self._copy_remote(node, source, path, result)
+            except Exception as e:
+                result.output += repr(e)
+                result.exit_code = 1
+        return result
+
+    def _copy_local(self, source: str, path: str, result: StageResult):
+        if os.path.abspath(source) == os.path.abspath(path):
+            result.method, result.exit_code = "local", 0
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        try:
+            os.link(source, path)
+            result.method = "hardlink"
+        except OSError:
+            # Different file system, or links not allowed: fall back to a sparse resumable copy.
+            copy_sparse(source, path)
+            shutil.copystat(source, path)
+            result.method = "local"
+        result.exit_code = 0
+
+    def _copy_remote(self, node: ParsedHypervisor, source: str, path: str, result: StageResult):
+        hostname, port, username, key_file = node.get_credentials()
+        remote_dir = os.path.dirname(path) or "."
+        cmd = ["rsync", "--sparse", "--partial", "--times",
+               "-e", f"ssh -p {port} -i {shlex.quote(key_file)} -o BatchMode=yes",
+               f"--rsync-path=mkdir -p {shlex.quote(remote_dir)} && rsync",
+               source, f"{username}@{hostname}:{path}"]
+        result.method = "rsync"
+        try:
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=self.copy_timeout)
+        except subprocess.TimeoutExpired as e:
+            result.output = (e.output or b"").decode("utf-8", errors="replace")
+            result.output += f"rsync timed out after {self.copy_timeout} seconds"
+            result.exit_code = 1
+            return
+        result.output = proc.stdout.decode("utf-8", errors="replace")
+        result.exit_code = proc.returncode
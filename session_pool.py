@@ -0,0 +1,291 @@
+"""Pool of persistent remote-shell sessions for SSHItem and PowerShellItem. Sessions are kept authenticated and
+warm per (host_or_ip, port, username) and commands run on multiplexed channels of an existing session, so the
+connection set-up and authentication are paid once instead of once per command."""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from items import PowerShellItem, SSHItem
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+SessionKey = Tuple[str, int, str]
+
+
+class RemoteSession(ABC):
+    """Interface of a pooled session. run() may be called from several threads at once up to the
+    channel limit of the pool; every call gets its own channel."""
+    def __init__(self, key: SessionKey):
+        self.key: SessionKey = key
+        self.created_time: float = time.monotonic()
+        self.last_used: float = self.created_time
+        self.active_channels: int = 0
+
+    @abstractmethod
+    def run(self, command: str, timeout: Optional[float] = None) -> Tuple[int, str]:
+        pass
+
+    @abstractmethod
+    def is_alive(self) -> bool:
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+
+class ParamikoSession(RemoteSession):
+    """One authenticated SSH transport; each command is an exec channel on it. Used when paramiko is
+    installed, and required for password authentication."""
+    def __init__(self, key: SessionKey, password: str = "", key_file: Optional[str] = None,
+                 connect_timeout: float = 10.0, keepalive_sec: int = 30):
+        super().__init__(key)
+        host, port, username = key
+        self._client = paramiko.SSHClient()
+        self._client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self._client.connect(host, port=port, username=username, password=password or None,
+                             key_filename=key_file, timeout=connect_timeout, allow_agent=key_file is None,
+                             look_for_keys=key_file is None)
+        self._client.get_transport().set_keepalive(keepalive_sec)
+
+    def run(self, command: str, timeout: Optional[float] = None) -> Tuple[int, str]:
+        channel = self._client.get_transport().open_session(timeout=timeout)
+        try:
+            channel.settimeout(timeout)
+            channel.set_combine_stderr(True)
+            channel.exec_command(command)
+            chunks: List[bytes] = []
+            while True:
+                data = channel.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+            return channel.recv_exit_status(), b"".join(chunks).decode("utf-8", errors="replace")
+        finally:
+            channel.close()
+
+    def is_alive(self) -> bool:
+        transport = self._client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        self._client.close()
+
+
+class OpenSSHSession(RemoteSession):
+    """A ControlMaster connection of the system ssh client; commands run as multiplexed channels over the
+    master's control socket. Only key based authentication is possible this way."""
+    def __init__(self, key: SessionKey, key_file: Optional[str] = None, connect_timeout: float = 10.0):
+        super().__init__(key)
+        host, port, username = key
+        self._dir = tempfile.mkdtemp(prefix="sshpool-")
+        self._control_path = os.path.join(self._dir, "control")
+        self._base = ["ssh", "-p", str(port), "-o", "BatchMode=yes",
+                      "-o", f"ConnectTimeout={int(connect_timeout)}",
+                      "-o", f"ControlPath={self._control_path}", "-o", "ServerAliveInterval=30"]
+        if key_file:
+            self._base += ["-i", key_file]
+        self._target = f"{username}@{host}"
+        proc = subprocess.run(self._base + ["-o", "ControlMaster=yes", "-o", "ControlPersist=yes", "-N", "-f",
+                                            self._target], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if proc.returncode != 0:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            raise ConnectionError(f"ssh master to {self._target} failed: "
+                                  f"{proc.stdout.decode('utf-8', errors='replace').strip()}")
+
+    def run(self, command: str, timeout: Optional[float] = None) -> Tuple[int, str]:
+        proc = subprocess.run(self._base + [self._target, command], stdin=subprocess.DEVNULL,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout)
+        return proc.returncode, proc.stdout.decode("utf-8", errors="replace")
+
+    def is_alive(self) -> bool:
+        proc = subprocess.run(self._base + ["-O", "check", self._target], stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+        return proc.returncode == 0
+
+    def close(self):
+        subprocess.run(self._base + ["-O", "exit", self._target], stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+
+def default_session_factory(key: SessionKey, password: str, key_file: Optional[str]) -> RemoteSession:
+    """paramiko when it is installed, otherwise the system ssh client with a control master."""
+    if paramiko is not None:
+        return ParamikoSession(key, password=password, key_file=key_file)
+    if password:
+        raise ConnectionError("Password authentication needs paramiko; install it or use a key file.")
+    return OpenSSHSession(key, key_file=key_file)
+
+
+def build_powershell_command(item: PowerShellItem) -> str:
+    """PowerShellItem commands run through PowerShell on a host reached over SSH. A command_type of
+    'cmd' runs the command through cmd.exe instead."""
+    if item.command_type == "cmd":
+        return f"cmd /c {item.command}"
+    encoded = item.command.replace('"', '\\"')
+    return f'powershell -NoProfile -NonInteractive -Command "{encoded}"'
+
+
+class SessionPool:
+    """This class pools sessions keyed by (host_or_ip, port, username). A command is run on an existing
+    session with a free channel (up to max_channels per session); a new session is only opened when all
+    of them are busy and the host is under max_sessions_per_host. When the host is at its limit an idle
+    session of another (port, username) on it is closed to make room; only if there is none the caller
+    waits.
+
+    Sessions idle for longer than idle_timeout_sec are closed, and a session is health checked before it
+    is reused if it has not been used for health_check_sec. Both happen on acquire, so no housekeeping
+    thread is needed; call evict_idle() periodically if the pool can go quiet for long stretches."""
+    def __init__(self, max_sessions_per_host: int = 4, max_channels: int = 8, idle_timeout_sec: float = 300.0,
+                 health_check_sec: float = 60.0,
+                 session_factory: Callable[[SessionKey, str, Optional[str]], RemoteSession] = default_session_factory,
+                 key_file: Optional[str] = None):
+        self.max_sessions_per_host = max_sessions_per_host
+        self.max_channels = max_channels
+        self.idle_timeout_sec = idle_timeout_sec
+        self.health_check_sec = health_check_sec
+        self.key_file = key_file
+        self._factory = session_factory
+        self._sessions: Dict[SessionKey, List[RemoteSession]] = {}
+        self._opening: Dict[str, int] = {}
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def run(self, host_or_ip: str, port: int, username: str, password: str, command: str,
+            timeout: Optional[float] = None) -> Tuple[int, str]:
+        key = (host_or_ip, int(port), username)
+        session = self._acquire(key, password)
+        try:
+            return session.run(command, timeout)
+        except Exception:
+            # A failed command does not have to mean a broken session; only drop it if it is dead.
+            if not session.is_alive():
+                self._discard(session)
+            raise
+        finally:
+            self._release(session)
+
+    def run_item(self, item: Union[SSHItem, PowerShellItem], timeout: Optional[float] = None):
+        """Run an SSHItem or PowerShellItem and fill in its output and exit_code."""
+        command = build_powershell_command(item) if isinstance(item, PowerShellItem) else item.command
+        try:
+            item.exit_code, item.output = self.run(item.host_or_ip, item.port, item.username, item.password,
+                                                   command, timeout)
+        except Exception as e:
+            item.exit_code, item.output = -1, repr(e)
+        return item
+
+    def evict_idle(self):
+        now = time.monotonic()
+        stale: List[RemoteSession] = []
+        with self._condition:
+            for key, sessions in self._sessions.items():
+                for session in list(sessions):
+                    if session.active_channels == 0 and now - session.last_used > self.idle_timeout_sec:
+                        sessions.remove(session)
+                        stale.append(session)
+            self._condition.notify_all()
+        for session in stale:
+            self._close_quietly(session)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            sessions = [s for group in self._sessions.values() for s in group]
+            self._sessions.clear()
+            self._condition.notify_all()
+        for session in sessions:
+            self._close_quietly(session)
+
+    def _host_sessions(self, host: str) -> int:
+        """Open plus opening sessions to a host, over all ports and users. Called with the lock held."""
+        open_count = sum(len(s) for k, s in self._sessions.items() if k[0] == host)
+        return open_count + self._opening.get(host, 0)
+
+    def _idle_on_host(self, key: SessionKey) -> Optional[RemoteSession]:
+        """The least recently used idle session to the host of key under another key. Called with the lock
+        held."""
+        idle = [s for k, group in self._sessions.items() if k[0] == key[0] and k != key
+                for s in group if s.active_channels == 0]
+        return min(idle, key=lambda s: s.last_used) if idle else None
+
+    def _acquire(self, key: SessionKey, password: str) -> RemoteSession:
+        self.evict_idle()
+        while True:
+            unhealthy: Optional[RemoteSession] = None
+            victim: Optional[RemoteSession] = None
+            with self._condition:
+                while True:
+                    if self._closed:
+                        raise RuntimeError("SessionPool is closed.")
+                    sessions = self._sessions.setdefault(key, [])
+                    free = [s for s in sessions if s.active_channels < self.max_channels]
+                    if free:
+                        session = min(free, key=lambda s: s.active_channels)
+                        session.active_channels += 1
+                        break
+                    victim = None
+                    if self._host_sessions(key[0]) >= self.max_sessions_per_host:
+                        victim = self._idle_on_host(key)
+                        if victim is not None:
+                            self._sessions[victim.key].remove(victim)
+                    if victim is not None or self._host_sessions(key[0]) < self.max_sessions_per_host:
+                        session = None
+                        self._opening[key[0]] = self._opening.get(key[0], 0) + 1
+                        break
+                    self._condition.wait()
+
+            if session is None:
+                if victim is not None:
+                    self._close_quietly(victim)
+                return self._open(key, password)
+
+            if time.monotonic() - session.last_used > self.health_check_sec and not session.is_alive():
+                unhealthy = session
+            if unhealthy is None:
+                return session
+            self._discard(unhealthy)
+
+    def _open(self, key: SessionKey, password: str) -> RemoteSession:
+        session = None
+        try:
+            session = self._factory(key, password, self.key_file)
+            session.active_channels = 1
+            return session
+        finally:
+            with self._condition:
+                self._opening[key[0]] -= 1
+                if session is not None:
+                    self._sessions.setdefault(key, []).append(session)
+                self._condition.notify_all()
+
+    def _release(self, session: RemoteSession):
+        with self._condition:
+            session.active_channels -= 1
+            session.last_used = time.monotonic()
+            self._condition.notify_all()
+
+    def _discard(self, session: RemoteSession):
+        with self._condition:
+            sessions = self._sessions.get(session.key, [])
+            if session in sessions:
+                sessions.remove(session)
+            self._condition.notify_all()
+        self._close_quietly(session)
+
+    def _close_quietly(self, session: RemoteSession):
+        try:
+            session.close()
+        except Exception as e:
+            print(f"SessionPool: error closing session to {session.key}: {repr(e)}")
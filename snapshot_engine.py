@@ -0,0 +1,167 @@
+"""Parallel VM snapshotting for SnapshotItem. Each VM of the item is saved on its own, concurrently up to the
+disk I/O budget of the node it runs on, with a result and progress report per VM. A retry only redoes the VMs
+that failed, and a save function that can write incremental (overlay) snapshots is given the previous save of
+the VM to build on."""
+
+import time
+import threading
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from items import SnapshotItem
+
+# save_func(namespace, vm_name, save_name, base_name) -> (exit_code, output, incremental)
+SaveFunc = Callable[[str, str, str, Optional[str]], Tuple[int, str, bool]]
+
+
+def minimega_save(namespace: str, vm_name: str, save_name: str, base_name: Optional[str]) -> Tuple[int, str, bool]:
+    """Save the running state of a VM with 'vm migrate', which is what 'vm config migrate' (the
+    state_snapshot of ParsedVirtualMachine) restores from. minimega always writes the full state, so
+    base_name is not used and the snapshot is never incremental."""
+    cmd = ["minimega", "-e", f"namespace {namespace} vm migrate {vm_name} {save_name}"]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return proc.returncode, proc.stdout.decode("utf-8", errors="replace"), False
+
+
+class VmSnapshotResult:
+    """Outcome of saving one VM."""
+    def __init__(self, vm_name: str, save_name: str):
+        self.vm_name: str = vm_name
+        self.save_name: str = save_name
+        self.exit_code: int = -1
+        self.output: str = ""
+        self.attempts: int = 0
+        self.incremental: bool = False
+        self.elapsed_sec: float = 0.0
+
+    def print_data(self) -> str:
+        s = "VmSnapshotResult:\n"
+        s += f"\tvm_name: {self.vm_name}\n"
+        s += f"\tsave_name: {self.save_name}\n"
+        s += f"\texit_code: {self.exit_code}\n"
+        s += f"\tattempts: {self.attempts}\n"
+        s += f"\tincremental: {self.incremental}\n"
+        s += f"\telapsed_sec: {self.elapsed_sec}\n"
+        return s
+
+
+class SnapshotEngine:
+    """This class snapshots the VMs of a SnapshotItem concurrently. node_of_vm maps a VM name to the node
+    it runs on and io_budget gives the number of simultaneous saves a node's disks can take (default_budget
+    for nodes that are not listed), so a node with a slow disk is not swamped while the others sit idle.
+
+    progress(result) is called as every VM finishes. When all VMs are done the usual SnapshotItem fields
+    are filled in (save_names, output, exit_code, snapshots_complete) and failed_vms lists the VMs to
+    retry; calling snapshot() again with the same item only redoes those.
+
+    The engine remembers the last successful save of each VM and passes it to save_func as base_name,
+    so a save function that supports overlays (for example a qcow2 overlay on top of the previous save)
+    can write incremental snapshots."""
+    def __init__(self, save_func: SaveFunc = minimega_save, node_of_vm: Callable[[str], str] = lambda vm: "",
+                 io_budget: Optional[Dict[str, int]] = None, default_budget: int = 2, max_workers: int = 32,
+                 progress: Optional[Callable[[VmSnapshotResult], None]] = None):
+        self.save_func = save_func
+        self.node_of_vm = node_of_vm
+        self.io_budget: Dict[str, int] = dict(io_budget or {})
+        self.default_budget = default_budget
+        self.progress = progress
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="snapshot")
+        self._node_slots: Dict[str, threading.Semaphore] = {}
+        self._last_save: Dict[Tuple[str, str], str] = {}
+        self._lock = threading.Lock()
+
+    def snapshot(self, item: SnapshotItem, retries: int = 0) -> SnapshotItem:
+        """Save every VM of the item (or only its failed_vms when the item has been through snapshot()
+        before), retrying a failed VM up to retries more times before giving up on it. Everything needed
+        for a later retry is kept on the item itself, so a copy that came back through a queue works."""
+        if not item.save_time_str:
+            item.save_time_str = datetime.now().strftime("%Y%m%d_%H%M%S")
+        retrying = bool(item.save_names or item.failed_vms)
+        todo = list(item.failed_vms) if retrying else list(item.vm_list)
+
+        results: Dict[str, VmSnapshotResult] = {}
+        futures = [self._executor.submit(self._save_vm, item, vm_name, results, retries) for vm_name in todo]
+        for future in futures:
+            future.result()
+
+        self._fill_item(item, results, retrying)
+        return item
+
+    @staticmethod
+    def save_name(item: SnapshotItem, vm_name: str) -> str:
+        return f"{item.namespace}_{vm_name}_{item.save_time_str}"
+
+    def get_results(self, item: SnapshotItem) -> Dict[str, VmSnapshotResult]:
+        """The state of every VM of the item as recorded on it: exit_code 0 for a saved VM, 1 for one in
+        failed_vms and -1 for one that has not been attempted. Timing and attempt counts are only known to
+        the progress callback."""
+        saved = set(item.save_names)
+        results = {}
+        for vm_name in item.vm_list:
+            result = VmSnapshotResult(vm_name, self.save_name(item, vm_name))
+            if result.save_name in saved:
+                result.exit_code = 0
+            elif vm_name in item.failed_vms:
+                result.exit_code = 1
+            results[vm_name] = result
+        return results
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    def _slots(self, node: str) -> threading.Semaphore:
+        with self._lock:
+            slots = self._node_slots.get(node)
+            if slots is None:
+                slots = threading.Semaphore(self.io_budget.get(node, self.default_budget))
+                self._node_slots[node] = slots
+            return slots
+
+    def _save_vm(self, item: SnapshotItem, vm_name: str, results: Dict[str, VmSnapshotResult], retries: int):
+        save_name = self.save_name(item, vm_name)
+        result = VmSnapshotResult(vm_name, save_name)
+        base_name = self._last_save.get((item.namespace, vm_name))
+
+        with self._slots(self.node_of_vm(vm_name)):
+            for _ in range(retries + 1):
+                result.attempts += 1
+                start = time.monotonic()
+                try:
+                    result.exit_code, result.output, result.incremental = self.save_func(
+                        item.namespace, vm_name, save_name, base_name)
+                except Exception as e:
+                    result.exit_code, result.output, result.incremental = -1, repr(e), False
+                result.elapsed_sec = time.monotonic() - start
+                if result.exit_code == 0:
+                    break
+
+        with self._lock:
+            results[vm_name] = result
+            if result.exit_code == 0:
+                self._last_save[(item.namespace, vm_name)] = save_name
+        if self.progress is not None:
+            self.progress(result)
+
+    def _fill_item(self, item: SnapshotItem, results: Dict[str, VmSnapshotResult], retrying: bool):
+        """Merge the results of this run with what the item already records: a VM that was not redone
+        keeps its earlier outcome."""
+        saved_before = set(item.save_names)
+        save_names, failed_vms = [], []
+        for vm_name in item.vm_list:
+            result = results.get(vm_name)
+            name = self.save_name(item, vm_name)
+            saved = result.exit_code == 0 if result is not None else name in saved_before
+            if saved:
+                save_names.append(name)
+            else:
+                failed_vms.append(vm_name)
+        ordered = [results[vm] for vm in item.vm_list if vm in results]
+        item.save_names = save_names
+        item.failed_vms = failed_vms
+        output = "".join(f"{r.vm_name}: {r.output.rstrip()}\n" for r in ordered)
+        item.output = item.output + output if retrying else output
+        item.exit_code = next((r.exit_code for r in ordered if r.exit_code != 0), 1 if failed_vms else 0)
+        item.snapshots_complete = not item.failed_vms
@@ -7,37 +7,53 @@ import time
 import socket
 import threading
 import traceback
-from typing import Union
+from typing import List, Optional, Union
 
 from sock_message import *
+from sock_transport import Transport, transport_for
+from sock_recorder import Recorder
+from command_cache import CommandCache
+from sock_spool import RecentResults
 
 
 class SockClient:
     """This class is the socket client that serves as the communication endpoint that will be deployed to
     select VM's. It's purpose is to receive instructions from SockServe for actions to execute on the VM
-    and then to report back to SockServe the output from that action."""
-    def __init__(self, host: str, port: int, iteration: int, context: str, testing: bool = False):
+    and then to report back to SockServe the output from that action. As with SockServer, 'unix:/path' as
+    host connects over a Unix domain socket and any other Transport can be passed in. Give a Recorder (see
+    sock_recorder) to capture all traffic. A CommandCache (see command_cache) lets repeated probe commands
+    from the server be answered from recent results instead of being run again."""
+    def __init__(self, host: str, port: int, iteration: int, context: str, testing: bool = False,
+                 accept: Optional[List[str]] = None, transport: Optional[Transport] = None,
+                 recorder: Optional[Recorder] = None, command_cache: Optional[CommandCache] = None):
         self._host: str = host
         self._port: int = port
+        self._transport: Transport = transport if transport is not None else transport_for(host, port)
         self._iteration = iteration
         self._context = context
         self._testing = testing
+        self._accept: Optional[List[str]] = accept   # content-types offered to the server, see sock_codec
+        self._recorder: Optional[Recorder] = recorder
+        self._command_cache: Optional[CommandCache] = command_cache
+        # Kept across reconnects: the server replays unacknowledged commands to the new connection.
+        self._recent_results = RecentResults()
         self._sel: selectors = selectors.DefaultSelector()
         self.sock_object: Union[SockMessage, None] = None
 
     def start_connection(self):
         """This method is called from the main function. It's purpose is to establish a socket connection
         to SockServe that running as part of the testbed code."""
-        server_addr = (self._host, self._port)
-        print("Starting connection to", server_addr)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setblocking(False)
-        sock.connect_ex(server_addr)
+        print("Starting connection to", self._transport.address)
+        sock, server_addr = self._transport.connect()
         events = selectors.EVENT_READ | selectors.EVENT_WRITE
         self.sock_object = SockMessage(selector=self._sel, sock=sock,
                                        addr=server_addr,
                                        iteration=self._iteration,
-                                       context=self._context)
+                                       context=self._context,
+                                       accept=self._accept,
+                                       recorder=self._recorder)
+        self.sock_object.command_cache = self._command_cache
+        self.sock_object.recent_results = self._recent_results
         self._sel.register(sock, events, data=self.sock_object)
         # Run the event loop in a thread when testing.
         if self._testing:
@@ -66,6 +82,8 @@ class SockClient:
             print("Caught keyboard interrupt, exiting")
         finally:
             self._sel.close()
+            if self._recorder is not None:
+                self._recorder.close()
 
 
 def main_test():
@@ -0,0 +1,113 @@
+"""Content codecs for SockMessage, keyed by the content-type of the JSON header. The JSON codec uses orjson when it
+is installed and the standard library otherwise. Applications can register further codecs, and the two ends of a
+connection agree on which of them to use through the 'accept' key of the JSON header."""
+
+import json
+import math
+import pickle
+
+from typing import Any, Dict, List, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CONTENT_TYPE_JSON = "text/json"
+CONTENT_TYPE_PICKLE = "application/x-python-pickle"
+
+
+class Codec:
+    """Encodes a message content object to bytes and back for one content-type."""
+    content_type: str = ""
+
+    def encode(self, obj: Any, encoding: str) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, data: bytes, encoding: str) -> Any:
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    """JSON with bytes.decode() and json.loads() straight on the received bytes. orjson is used for
+    utf-8 when available since it encodes directly to utf-8 bytes. It is stricter than the json module
+    (integers beyond 64 bits, NaN and infinity), so whatever it refuses, or would encode differently, goes
+    through the json module instead and both paths accept and produce the same messages."""
+    content_type = CONTENT_TYPE_JSON
+
+    def encode(self, obj: Any, encoding: str) -> bytes:
+        if orjson is not None and encoding.lower() in ("utf-8", "utf8") and not _has_non_finite(obj):
+            try:
+                return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+            except (TypeError, orjson.JSONEncodeError):
+                pass
+        return json.dumps(obj, ensure_ascii=False).encode(encoding)
+
+    def decode(self, data: bytes, encoding: str) -> Any:
+        if orjson is not None and encoding.lower() in ("utf-8", "utf8"):
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                pass    # NaN, Infinity or big integers written by the json module; a real error is raised below
+        return json.loads(data.decode(encoding))
+
+
+def _has_non_finite(obj: Any) -> bool:
+    """True if a float that orjson would turn into null (NaN or infinity) is anywhere in obj."""
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, float):
+            if not math.isfinite(value):
+                return True
+        elif isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+    return False
+
+
+class PickleCodec(Codec):
+    """Sends Python objects (for example queue items) as they are. Not registered by default, see
+    enable_pickle_codec()."""
+    content_type = CONTENT_TYPE_PICKLE
+
+    def encode(self, obj: Any, encoding: str) -> bytes:
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data: bytes, encoding: str) -> Any:
+        return pickle.loads(data)
+
+
+JSON_CODEC = JsonCodec()
+
+_codecs: Dict[str, Codec] = {CONTENT_TYPE_JSON: JSON_CODEC}
+
+
+def register_codec(codec: Codec):
+    _codecs[codec.content_type] = codec
+
+
+def enable_pickle_codec():
+    """Opt in to the pickle codec. Only call this when both ends of every connection are trusted: unpickling
+    runs arbitrary code, so a peer that may send pickled content can take over this process."""
+    register_codec(PickleCodec())
+
+
+def get_codec(content_type: str) -> Optional[Codec]:
+    return _codecs.get(content_type)
+
+
+def registered_content_types() -> List[str]:
+    return list(_codecs)
+
+
+def negotiate(preferred: Optional[List[str]], peer_accept: Optional[List[str]], requested: str) -> str:
+    """Pick the content-type to send with. The first of our preferred types that the peer accepts and that
+    has a registered codec wins; otherwise the requested type is kept. A peer that never sent 'accept'
+    is assumed to accept only JSON."""
+    if preferred and peer_accept:
+        for content_type in preferred:
+            if content_type in peer_accept and content_type in _codecs:
+                return content_type
+    return requested
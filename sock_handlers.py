@@ -0,0 +1,122 @@
+"""Registry of SockMessage action handlers. Handlers are registered per (role, action) and say how they are run:
+inline on the event loop thread, on a thread pool or on a process pool. Only inline handlers run on the reactor
+thread, so slow work (running commands, reading files, measurements) never holds up socket I/O."""
+
+import threading
+import traceback
+
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+ROLE_SERVER = "server"
+ROLE_CLIENT = "client"
+
+MODE_INLINE = "inline"
+MODE_THREAD = "thread"
+MODE_PROCESS = "process"
+
+
+class Handler(NamedTuple):
+    func: Callable
+    mode: str
+
+
+class HandlerRegistry:
+    """This class maps (role, action) to a handler.
+
+    Inline and thread handlers are called as func(sock_message, content) and process handlers as
+    func(content), since a SockMessage cannot be sent to another process; a process handler must be a
+    module level function. Whatever a handler returns that is not None is a message (as built by
+    create_message()) to send back on the same connection. Replies of thread and process handlers are
+    handed to the connection with post_message(), which is safe to call from any thread.
+
+    When a handler raises, the peer must not be left waiting for an answer: error_reply(sock_message,
+    content, error) builds the message sent back instead, and if it is not set or returns None the
+    connection is closed (by its event loop, see SockMessage.request_close())."""
+    def __init__(self, max_threads: int = 8, max_processes: int = 2):
+        self.max_threads = max_threads
+        self.max_processes = max_processes
+        self._handlers: Dict[Tuple[str, str], Handler] = {}
+        self._threads: Optional[ThreadPoolExecutor] = None
+        self._processes: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.error_reply: Optional[Callable[[Any, Dict, BaseException], Optional[Dict]]] = None
+
+    def register(self, role: str, action: str, func: Callable, mode: str = MODE_INLINE):
+        if mode not in (MODE_INLINE, MODE_THREAD, MODE_PROCESS):
+            raise ValueError(f"Invalid handler mode {repr(mode)}.")
+        self._handlers[(role, action)] = Handler(func, mode)
+
+    def unregister(self, role: str, action: str):
+        self._handlers.pop((role, action), None)
+
+    def get(self, role: str, action: str) -> Optional[Handler]:
+        return self._handlers.get((role, action))
+
+    def dispatch(self, role: str, sock_message: Any, content: Dict) -> bool:
+        """Run the handler of the action in content. Returns False if there is no handler for it."""
+        handler = self._handlers.get((role, content.get("action", "undefined")))
+        if handler is None:
+            return False
+        if handler.mode == MODE_INLINE:
+            try:
+                reply = handler.func(sock_message, content)
+            except Exception as e:
+                self._failed(sock_message, content, e)
+                return True
+            if reply is not None:
+                sock_message.post_message(reply)
+            return True
+        if handler.mode == MODE_THREAD:
+            future = self._thread_pool().submit(handler.func, sock_message, content)
+        else:
+            future = self._process_pool().submit(handler.func, content)
+        future.add_done_callback(lambda f: self._deliver(sock_message, content, f))
+        return True
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            threads, self._threads = self._threads, None
+            processes, self._processes = self._processes, None
+        if threads is not None:
+            threads.shutdown(wait=wait)
+        if processes is not None:
+            processes.shutdown(wait=wait)
+
+    def _thread_pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._threads is None:
+                self._threads = ThreadPoolExecutor(max_workers=self.max_threads, thread_name_prefix="sock-handler")
+            return self._threads
+
+    def _process_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._processes is None:
+                self._processes = ProcessPoolExecutor(max_workers=self.max_processes)
+            return self._processes
+
+    def _deliver(self, sock_message: Any, content: Dict, future: Future):
+        try:
+            reply = future.result()
+        except Exception as e:
+            self._failed(sock_message, content, e)
+            return
+        if reply is not None:
+            sock_message.post_message(reply)
+
+    def _failed(self, sock_message: Any, content: Dict, error: BaseException):
+        print(f"Handler for {repr(content.get('action'))} from {sock_message.addr} failed:\n"
+              f"{''.join(traceback.format_exception(type(error), error, error.__traceback__))}")
+        reply = self.error_reply(sock_message, content, error) if self.error_reply is not None else None
+        if reply is not None:
+            sock_message.post_message(reply)
+        else:
+            sock_message.request_close()
+
+
+# The registry SockMessage uses unless it is given its own.
+default_registry = HandlerRegistry()
+
+
+def register_handler(role: str, action: str, func: Callable, mode: str = MODE_INLINE):
+    default_registry.register(role, action, func, mode)
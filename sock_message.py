@@ -1,14 +1,23 @@
 """This code was adapted from a Real Python tutorial on Python socket programming.
 It is available on Github (TLT)."""
 
-import io
 import sys
-import json
 import struct
 import selectors
 import subprocess
 
-from typing import List
+from collections import deque
+from typing import TYPE_CHECKING, Callable, Deque, List, Optional, Tuple
+
+from sock_codec import CONTENT_TYPE_JSON, JSON_CODEC, get_codec, negotiate
+from sock_handlers import (MODE_INLINE, MODE_THREAD, ROLE_CLIENT, ROLE_SERVER, HandlerRegistry, default_registry,
+                           register_handler)
+
+if TYPE_CHECKING:
+    # Recording, spooling and command caching are optional; their modules are only imported where used.
+    from sock_recorder import Recorder
+    from sock_spool import OutboundSpool, RecentResults
+    from command_cache import CommandCache
 
 # Socket communication command and context strings.
 SOCK_SET_ITERATION = "set_iteration"
@@ -18,18 +27,29 @@ SOCK_CONTEXT_MEASUREMENTS = "measurements"
 SOCK_COMMAND = "command"
 SOCK_COMMAND_RESPONSE = "command response"
 
+# Upper bound on the number of buffers handed to a single sendmsg() call (IOV_MAX is 1024 on Linux).
+MAX_SEND_SEGMENTS = 1024
 
-def create_message(action, value: str, iteration: int = -1, context: str = SOCK_STATUS):
+
+def create_message(action, value: str, iteration: int = -1, context: str = SOCK_STATUS,
+                   message_id: Optional[str] = None, ack: Optional[str] = None):
     """This is a static that is used to create a message to be sent either from SockServe or from
     ClientServe. The content dictionary can be modified as necessary to accommodate changing functionality
-    requirements. I would not change anything else for fear of breaking messaging protocol (TLT)."""
+    requirements. I would not change anything else for fear of breaking messaging protocol (TLT).
+    message_id identifies a spooled command (see sock_spool) and ack names the command a response answers;
+    both are left out of the content when not given."""
+    content = dict(action=action,
+                   iteration=iteration,
+                   context=context,
+                   value=value)
+    if message_id is not None:
+        content["message_id"] = message_id
+    if ack is not None:
+        content["ack"] = ack
     return dict(
         type="text/json",
         encoding="utf-8",
-        content=dict(action=action,
-                     iteration=iteration,
-                     context=context,
-                     value=value),
+        content=content,
     )
 
 
@@ -55,16 +75,43 @@ class SockMessage:
     All the SockServer connections to a client and all the clients connections to SockServer have an private
     instance of this class. Be careful when modifying any of the methods that begin with "_". (TLT)"""
     def __init__(self, selector, sock, addr, context: str = None, iteration: int = -1,
-                 server_instance: bool = False):
+                 server_instance: bool = False, accept: Optional[List[str]] = None,
+                 handlers: Optional[HandlerRegistry] = None, recorder: Optional["Recorder"] = None):
         self._selector = selector
         self._sock = sock
         self.addr = addr
         self._server_instance = server_instance
         self._recv_buffer = b""
-        self._send_buffer = b""
+        self._send_segments: Deque[memoryview] = deque()
         self._message_out_queued = False
         self._jsonheader_len = None
 
+        # Content-types this end can decode, most preferred first, advertised to the peer in the 'accept'
+        # key of every JSON header. None keeps the plain JSON protocol. peer_accept is what the peer sent.
+        self.accept: Optional[List[str]] = accept
+        self.peer_accept: Optional[List[str]] = None
+
+        # Actions are dispatched through a handler registry (see sock_handlers). Messages posted from other
+        # threads wait in _pending_out until the event loop moves them into message_out; deque appends and
+        # pops are atomic, so no lock is needed.
+        self._handlers: HandlerRegistry = handlers if handlers is not None else default_registry
+        self._pending_out: Deque[dict] = deque()
+        self._close_requested = False
+
+        # Optional traffic capture (see sock_recorder); every complete frame in or out is recorded.
+        self._recorder: Optional["Recorder"] = recorder
+        self._record_id: int = recorder.open_connection(addr) if recorder is not None else 0
+        self._jsonheader_bytes = b""
+
+        # The spool of the SockServer this connection belongs to, if it keeps one (see sock_spool).
+        self.spool: Optional["OutboundSpool"] = None
+        # The command result cache of the SockClient this connection belongs to, if enabled.
+        self.command_cache: Optional["CommandCache"] = None
+        # The SockClient's record of recently run command IDs, so a command the server replays is not run twice.
+        self.recent_results: Optional["RecentResults"] = None
+        # Called with this connection once it has been closed, so its owner can stop sending to it.
+        self.on_close: Optional[Callable[["SockMessage"], None]] = None
+
         self.jsonheader = None
         self.context: str = context
         self.iteration: int = iteration
@@ -114,65 +161,81 @@ class SockMessage:
 #               raise RuntimeError("Peer closed.")
 
     def _write(self):
-        """This method, if the send buffer is not empty, writes as many bytes to the socket as the socket will
-        allow. Note that socket.send() returns the number on bytes written and that is leveraged to truncate the
-        send buffer at the front end by the bytes written. If the transmission is incomplete for whatever reason,
-        this method will be called again as soon as the socket is writeable and we simply pick up where we left
-        off. Beautiful! Note that if the send buffer is empty at the end of this operation, we call initialize()
-        to reset the world. (TLT)"""
-        if self._send_buffer:
-            print("Sending", repr(self._send_buffer), "to", self.addr)
+        """This method, if there are segments waiting to be sent, writes as many bytes to the socket as the
+        socket will allow. The pieces of a message (the fixed length header, the JSON header and the content)
+        are kept as separate segments and handed to the kernel in one sendmsg() call, so the content is never
+        copied into a combined buffer. Fully sent segments are dropped from the front of the deque and a
+        partially sent one is replaced by a memoryview of its remainder, which does not copy either. If the
+        transmission is incomplete, this method will be called again as soon as the socket is writeable and
+        we simply pick up where we left off. When everything has been sent we call initialize_output()."""
+        if self._send_segments:
             try:
                 # Should be ready to write
-                sent = self._sock.send(self._send_buffer)
+                if hasattr(self._sock, "sendmsg"):
+                    segments = self._send_segments
+                    count = min(len(segments), MAX_SEND_SEGMENTS)
+                    sent = self._sock.sendmsg([segments[i] for i in range(count)])
+                else:
+                    sent = self._sock.send(self._send_segments[0])
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
             else:
-                self._send_buffer = self._send_buffer[sent:]
-                if self._send_buffer == b"":
+                print("Sent", sent, "bytes to", self.addr)
+                self._advance_send_segments(sent)
+                if not self._send_segments:
                     self.initialize_output()
 
+    def _advance_send_segments(self, sent: int):
+        """Drop the first sent bytes from the segments waiting to be sent."""
+        segments = self._send_segments
+        while sent:
+            first = segments[0]
+            if sent >= len(first):
+                sent -= len(first)
+                segments.popleft()
+            else:
+                segments[0] = first[sent:]
+                sent = 0
+
     def _json_encode(self, obj, encoding):
         """Apply the specified encoding to the JSON dictionary and shoot it back. Called by create_message_out()
-        and queue_message_out()."""
-        return json.dumps(obj, ensure_ascii=False).encode(encoding)
+        and queue_message_out(). The work is done by the JSON codec of sock_codec."""
+        return JSON_CODEC.encode(obj, encoding)
 
     def _json_decode(self, json_bytes, encoding):
-        """This method decodes the JSON bytes with the specified encoding. I have not studied the operation of
-        io.TextIOWrapper(). This method is called by process_jsonheader() and process_message_in() (TLT)."""
-        tiow = io.TextIOWrapper(io.BytesIO(json_bytes), encoding=encoding, newline="")
-        obj = json.load(tiow)
-        tiow.close()
-        return obj
-
-    def _create_message_out(self, *, content_bytes, content_type, content_encoding):
+        """This method decodes the JSON bytes with the specified encoding. This method is called by
+        process_jsonheader() and process_message_in()."""
+        return JSON_CODEC.decode(json_bytes, encoding)
+
+    def _create_message_out(self, *, content_bytes, content_type, content_encoding) -> Tuple[bytes, bytes, bytes]:
         """This method creates the JSON header, encodes it by calling _json_encode(), creates the fixed
         length beginning header, and finally, the content header. Note that it returns the stack as a
-        'message'."""
+        'message' of three segments which are sent as they are, without joining them."""
         jsonheader = {
             "byteorder": sys.byteorder,
             "content-type": content_type,
             "content-encoding": content_encoding,
             "content-length": len(content_bytes),
         }
+        if self.accept:
+            jsonheader["accept"] = self.accept
         jsonheader_bytes = self._json_encode(jsonheader, "utf-8")
         message_hdr = struct.pack(">H", len(jsonheader_bytes))
-        message = message_hdr + jsonheader_bytes + content_bytes
-        return message
+        return message_hdr, jsonheader_bytes, content_bytes
 
     def _process_message_in_json_content(self):
         """This method is called by process_message_in(). At this point, we have deconstructed the message
-        and, after determining whether this is a server instance or a client instance of SockMessage, branch
-        processing server actions or processing client actions."""
+        and hand it to the handler registered for the action and for our role (server instance or client
+        instance of SockMessage). Actions without a handler are just logged."""
         content = self.message_in
         message = content.get("value", "undefined")
 
         if self._server_instance:
-            self._process_server_action()
+            self._handlers.dispatch(ROLE_SERVER, self, content)
             print(f"Received Client message from iteration {self.iteration}:\n{message}")
         else:
-            self._process_client_action()
+            self._handlers.dispatch(ROLE_CLIENT, self, content)
             print(f"Received Server message from iteration {self.iteration}:\n{message}")
 
     def _process_message_in_binary_content(self):
@@ -184,33 +247,53 @@ class SockMessage:
     def process_events(self, mask):
         """This method is the entry point for SockMessage. The event loops in both SockServer and SockClient
         come in through the same door and this is it. Note that if message_out is None, then there is no
-        point in worrying about a write operation. However, for a read operation, we have to actually do a
-        read before we know if anything is there to deal with (TLT)."""
+        point in worrying about a write operation unless a message has been posted. However, for a read
+        operation, we have to actually do a read before we know if anything is there to deal with (TLT)."""
+        if self._close_requested:
+            self.close()
+            return
         if mask & selectors.EVENT_READ:
             self.read()
-        if mask & selectors.EVENT_WRITE and self.message_out is not None:
-            self.write()
+        if mask & selectors.EVENT_WRITE:
+            if self.message_out is None and self._pending_out:
+                self.message_out = self._pending_out.popleft()
+            if self.message_out is not None:
+                self.write()
+
+    def post_message(self, message: dict):
+        """Queue a message (as built by create_message()) to be sent after the ones already waiting. Safe to
+        call from any thread, unlike assigning message_out, which only the event loop thread should do."""
+        self._pending_out.append(message)
+
+    def request_close(self):
+        """Have the event loop close this connection the next time it gets to it. Safe to call from any
+        thread, unlike close()."""
+        self._close_requested = True
 
     def read(self):
         """This method is called by process_events() on a read operation. The first thing we do is to actually
         read the socket calling _read(). If there is anything there to read, the receive buffer will be
         appended with the contents. If the read buffer is nothing, then we are through! Otherwise, we have some
-        message headers to process."""
+        message headers to process. A single read can bring in several messages when the peer sends quickly,
+        so we keep going until the buffer only holds an incomplete message; otherwise the rest would sit in
+        the buffer until the peer happens to send again."""
         self._read()
 
-        if not self._recv_buffer:
-            return
-
-        if self._jsonheader_len is None:
-            self.process_protoheader()
+        while self._recv_buffer:
+            if self._jsonheader_len is None:
+                self.process_protoheader()
+                if self._jsonheader_len is None:
+                    break
 
-        if self._jsonheader_len is not None:
             if self.jsonheader is None:
                 self.process_jsonheader()
+                if self.jsonheader is None:
+                    break
 
-        if self.jsonheader:
             if self.message_in is None:
                 self.process_message_in()
+                if self.jsonheader is not None:
+                    break
 
     def write(self):
         """This method is called by process_events(). Remember that we do not even come here unless
@@ -226,6 +309,8 @@ class SockMessage:
         """This method is very well though out and it came with the Real Python source code, as much of this
         did. It does a superb job of shutting everything down (TLT)."""
         print("Closing connection to", self.addr)
+        if self._recorder is not None:
+            self._recorder.close_connection(self._record_id)
         try:
             self._selector.unregister(self._sock)
         except Exception as e:
@@ -244,17 +329,26 @@ class SockMessage:
         finally:
             # Delete reference to socket object for garbage collection
             self._sock = None
+        if self.on_close is not None:
+            self.on_close(self)
+
+    @property
+    def closed(self) -> bool:
+        return self._sock is None
 
     def queue_message_out(self):
         """This method is so cool! It is called by write() if the message has not already been "queued".
         It builds the communication stack by calling all those methods that build all the components. And
-        when it is through, the send buffer has the complete message stored in it."""
+        when it is through, the segments of the complete message are waiting to be sent."""
         content = self.message_out["content"]
         content_type = self.message_out["type"]
         content_encoding = self.message_out["encoding"]
-        if content_type == "text/json":
+        if content_type == CONTENT_TYPE_JSON:
+            content_type = negotiate(self.accept, self.peer_accept, content_type)
+        codec = get_codec(content_type)
+        if codec is not None:
             req = {
-                "content_bytes": self._json_encode(content, content_encoding),
+                "content_bytes": codec.encode(content, content_encoding),
                 "content_type": content_type,
                 "content_encoding": content_encoding,
             }
@@ -264,8 +358,13 @@ class SockMessage:
                 "content_type": content_type,
                 "content_encoding": content_encoding,
             }
-        message = self._create_message_out(**req)
-        self._send_buffer += message
+        segments = self._create_message_out(**req)
+        if self._recorder is not None:
+            from sock_recorder import REC_OUT
+            self._recorder.record(self._record_id, REC_OUT, segments)
+        for segment in segments:
+            if segment:
+                self._send_segments.append(memoryview(segment))
         self._message_out_queued = True
 
     def process_protoheader(self):
@@ -282,7 +381,8 @@ class SockMessage:
         the required keys are there otherwise, it raises a ValueError."""
         hdrlen = self._jsonheader_len
         if len(self._recv_buffer) >= hdrlen:
-            self.jsonheader = self._json_decode(self._recv_buffer[:hdrlen], "utf-8")
+            self._jsonheader_bytes = self._recv_buffer[:hdrlen]
+            self.jsonheader = self._json_decode(self._jsonheader_bytes, "utf-8")
             self._recv_buffer = self._recv_buffer[hdrlen:]
             for reqhdr in (
                     "byteorder",
@@ -292,22 +392,34 @@ class SockMessage:
             ):
                 if reqhdr not in self.jsonheader:
                     raise ValueError(f'Missing required header "{reqhdr}".')
+            if "accept" in self.jsonheader:
+                self.peer_accept = self.jsonheader["accept"]
 
     def process_message_in(self):
         """This method is called from read(). This method is actually the wrapper method for the call
         to _process_message_in_json_content() and )process_message_in_binary_content(). It calls either
-        of these methods based on the content-type. Finally, it calls the initialize() method when the
-        processing operation is complete."""
+        of these methods based on whether a codec is registered for the content-type and the content decodes
+        to a dictionary (any JSON value or pickled object may not). Finally, it calls the
+        initialize() method when the processing operation is complete."""
         content_len = self.jsonheader["content-length"]
         if not len(self._recv_buffer) >= content_len:
             return
         data = self._recv_buffer[:content_len]
         self._recv_buffer = self._recv_buffer[content_len:]
-        if self.jsonheader["content-type"] == "text/json":
+        if self._recorder is not None:
+            from sock_recorder import REC_IN
+            self._recorder.record(self._record_id, REC_IN,
+                                  (struct.pack(">H", len(self._jsonheader_bytes)), self._jsonheader_bytes, data))
+        codec = get_codec(self.jsonheader["content-type"])
+        if codec is not None:
             encoding = self.jsonheader["content-encoding"]
-            self.message_in = self._json_decode(data, encoding)
+            self.message_in = codec.decode(data, encoding)
             print("Message received", repr(self.message_in), "from", self.addr)
-            self._process_message_in_json_content()
+            if isinstance(self.message_in, dict):
+                self._process_message_in_json_content()
+            else:
+                # Decoded fine, but not a message dictionary the handlers could dispatch on.
+                self._process_message_in_binary_content()
         else:
             # Binary or unknown content-type
             self.message_in = data
@@ -315,33 +427,67 @@ class SockMessage:
             self._process_message_in_binary_content()
         self.initialize_input()
 
-    def _process_server_action(self):
-        """This method is called by _process_message_in_json_content() when the inbound message was sent
-        to the server instance of SockMessage. We are checking the value of action to determine if we
-        have any processing to do."""
-        content = self.message_in
-        action = content.get("action", "undefined")
-
-        if action == SOCK_SET_ITERATION:
-            context = content.get("context", "undefined")
-            iteration = content.get("iteration", -1)
-            if  self.iteration == -1:
-                self.iteration = iteration
-                self.context = context
-
-    def _process_client_action(self):
-        """This method is called by _process_message_in_json_content() when the inbound message was sent
-        to the client instance of SockMessage. We are checking the value of action to determine if we
-        have any processing to do."""
-        content = self.message_in
-        action = content.get("action", "undefined")
-
-        """If we have been issued a command from the server, we execute that command in a subprocess
-        capturing the output so that it can be sent back to the server with create_message()."""
-        if action == SOCK_COMMAND:
-            value = content.get("value", "undefined")
-            cmd: List[str] = value.split()
-            output = subprocess.check_output(cmd).decode('utf-8')
-            self.message_out = create_message(action=SOCK_COMMAND_RESPONSE,
-                                              value=output, context=self.context,
-                                              iteration=self.iteration)
\ No newline at end of file
+
+def handle_set_iteration(sock_message: SockMessage, content: dict):
+    """Server side, inline: the first SOCK_SET_ITERATION of a connection tells us which iteration and
+    context the client belongs to. With a spool, the commands of that client that were never acknowledged
+    (sent before a restart or to an earlier connection) are queued again."""
+    if sock_message.iteration == -1:
+        sock_message.iteration = content.get("iteration", -1)
+        sock_message.context = content.get("context", "undefined")
+        if sock_message.spool is not None:
+            for message in sock_message.spool.pending_for(sock_message.iteration, sock_message.context):
+                sock_message.post_message(message)
+
+
+def handle_command_response(sock_message: SockMessage, content: dict):
+    """Server side, inline: a response acknowledges the spooled command it answers."""
+    ack = content.get("ack")
+    if ack is not None and sock_message.spool is not None and not sock_message.spool.ack(ack):
+        print(f"Duplicate response to command {ack} from iteration {sock_message.iteration}")
+
+
+def handle_command(sock_message: SockMessage, content: dict):
+    """Client side, thread pool: we have been issued a command from the server, so we execute that command
+    in a subprocess capturing the output so that it can be sent back to the server. A command that exits
+    with an error still sends back whatever it printed. A command carrying a message ID we have already
+    run gets the output of that run, and with a command cache a recent result may be reused."""
+    value = content.get("value", "undefined")
+    message_id = content.get("message_id")
+    cache = sock_message.command_cache
+    if cache is not None:
+        run = lambda: cache.run(value, _run_command)
+    else:
+        run = lambda: _run_command(value)[1]
+    recent = sock_message.recent_results
+    output = recent.run(message_id, run) if recent is not None else run()
+    return create_message(action=SOCK_COMMAND_RESPONSE, value=output, context=sock_message.context,
+                          iteration=sock_message.iteration, ack=message_id)
+
+
+def _run_command(value: str) -> Tuple[int, str]:
+    """Exit code and output of a command. A command that cannot be started at all (not found, not executable,
+    empty) gets exit code -1 and an error line as its output, so the server still gets a response."""
+    cmd: List[str] = value.split()
+    try:
+        return 0, subprocess.check_output(cmd).decode('utf-8')
+    except subprocess.CalledProcessError as e:
+        return e.returncode, e.output.decode('utf-8', errors='replace')
+    except Exception as e:
+        return -1, f"error: could not run {repr(value)}: {repr(e)}"
+
+
+def handler_error_reply(sock_message: SockMessage, content: dict, error: BaseException) -> Optional[dict]:
+    """Reply of the default registry when a handler raised. A failed command is answered with a command
+    response carrying the error, so a spooled command is acknowledged instead of being replayed forever;
+    for anything else there is nothing sensible to send and the connection is closed."""
+    if content.get("action") != SOCK_COMMAND:
+        return None
+    return create_message(action=SOCK_COMMAND_RESPONSE, value=f"error: {repr(error)}", context=sock_message.context,
+                          iteration=sock_message.iteration, ack=content.get("message_id"))
+
+
+register_handler(ROLE_SERVER, SOCK_SET_ITERATION, handle_set_iteration, MODE_INLINE)
+register_handler(ROLE_SERVER, SOCK_COMMAND_RESPONSE, handle_command_response, MODE_INLINE)
+register_handler(ROLE_CLIENT, SOCK_COMMAND, handle_command, MODE_THREAD)
+default_registry.error_reply = handler_error_reply
@@ -0,0 +1,116 @@
+"""Capture of SockMessage traffic. A Recorder attached to a SockServer or SockClient writes every framed message
+(the 2-byte header, JSON header and content exactly as they were on the wire) with a timestamp, the connection it
+belongs to and its direction to a compact binary file, which sock_replay can play back against a server."""
+
+import struct
+import threading
+import time
+
+from typing import Iterator, List, NamedTuple, Optional, Sequence
+
+MAGIC = b"SMREC1\n"
+
+ROLE_SERVER = "server"
+ROLE_CLIENT = "client"
+
+# Record kinds. OPEN carries the peer address as text, CLOSE carries nothing.
+REC_IN = 0
+REC_OUT = 1
+REC_OPEN = 2
+REC_CLOSE = 3
+
+# timestamp, kind, connection id, payload length
+_RECORD = struct.Struct(">dBII")
+
+
+class Record(NamedTuple):
+    timestamp: float
+    kind: int
+    conn_id: int
+    data: bytes
+
+
+class Recorder:
+    """This class appends records to a capture file. role says which end recorded the traffic, so a
+    replay knows which direction went to the server. Writes are buffered; call flush() or close() to
+    make sure everything is on disk. Safe to use from several threads."""
+    def __init__(self, path: str, role: str, buffering: int = 1 << 20):
+        self.path = path
+        self.role = role
+        self._file = open(path, "wb", buffering=buffering)
+        role_bytes = role.encode("utf-8")
+        self._file.write(MAGIC + struct.pack(">B", len(role_bytes)) + role_bytes)
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def open_connection(self, addr) -> int:
+        with self._lock:
+            self._next_id += 1
+            conn_id = self._next_id
+            self._write(REC_OPEN, conn_id, (str(addr),))
+        return conn_id
+
+    def close_connection(self, conn_id: int):
+        with self._lock:
+            self._write(REC_CLOSE, conn_id, ())
+
+    def record(self, conn_id: int, kind: int, segments: Sequence):
+        """Record one framed message given as the segments it was sent or received in."""
+        with self._lock:
+            self._write(kind, conn_id, segments)
+
+    def flush(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def _write(self, kind: int, conn_id: int, segments: Sequence):
+        if self._file.closed:
+            return
+        data = [s.encode("utf-8") if isinstance(s, str) else s for s in segments]
+        self._file.write(_RECORD.pack(time.time(), kind, conn_id, sum(len(d) for d in data)))
+        for d in data:
+            self._file.write(d)
+
+
+def read_recording(path: str) -> "RecordingReader":
+    return RecordingReader(path)
+
+
+class RecordingReader:
+    """Iterates over the records of a capture file. A file cut short by a crash ends at the last
+    complete record."""
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a SockMessage recording.")
+            role_len = f.read(1)[0]
+            self.role: str = f.read(role_len).decode("utf-8")
+            self._offset = f.tell()
+
+    def __iter__(self) -> Iterator[Record]:
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            while True:
+                header = f.read(_RECORD.size)
+                if len(header) < _RECORD.size:
+                    return
+                timestamp, kind, conn_id, length = _RECORD.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    return
+                yield Record(timestamp, kind, conn_id, data)
+
+    def records(self) -> List[Record]:
+        return list(self)
+
+
+def to_server_kind(role: Optional[str]) -> int:
+    """The record kind of messages that went from a client to the server in a recording made by role."""
+    return REC_IN if role == ROLE_SERVER else REC_OUT
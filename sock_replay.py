@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+"""Replay of recorded SockMessage traffic (see sock_recorder) against a SockServer. Every recorded connection is
+opened again, optionally several times over, and the frames its client sent are sent with the recorded timing,
+N times faster, or as fast as possible. Throughput and the latency of the frames that were answered in the
+recording are reported, so server changes can be benchmarked against a real campaign without any VMs."""
+
+import sys
+import time
+import heapq
+import struct
+import selectors
+
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from sock_codec import JSON_CODEC
+from sock_recorder import REC_CLOSE, REC_IN, REC_OPEN, REC_OUT, read_recording, to_server_kind
+from sock_transport import Transport, transport_for
+
+
+class RecordedConnection:
+    """The client to server frames of one recorded connection. Each frame has its offset from the start
+    of the recording and whether the server answered it before the client sent anything else."""
+    def __init__(self, conn_id: int, addr: str):
+        self.conn_id = conn_id
+        self.addr = addr
+        self.frames: List[Tuple[float, bytes, bool]] = []
+
+
+def load_connections(path: str) -> List[RecordedConnection]:
+    reader = read_recording(path)
+    to_server = to_server_kind(reader.role)
+    connections: Dict[int, RecordedConnection] = {}
+    start: Optional[float] = None
+    for record in reader:
+        if start is None:
+            start = record.timestamp
+        if record.kind == REC_OPEN:
+            connections[record.conn_id] = RecordedConnection(record.conn_id, record.data.decode("utf-8"))
+            continue
+        conn = connections.get(record.conn_id)
+        if conn is None or record.kind == REC_CLOSE:
+            continue
+        if record.kind == to_server:
+            conn.frames.append((record.timestamp - start, record.data, False))
+        elif conn.frames and record.kind in (REC_IN, REC_OUT):
+            offset, frame, _ = conn.frames[-1]
+            conn.frames[-1] = (offset, frame, True)
+    return [c for c in connections.values() if c.frames]
+
+
+class ReplayStats:
+    def __init__(self):
+        self.connections: int = 0
+        self.errors: int = 0
+        self.sent_messages: int = 0
+        self.sent_bytes: int = 0
+        self.received_messages: int = 0
+        self.received_bytes: int = 0
+        self.latencies: List[float] = []
+        self.elapsed_sec: float = 0.0
+
+    def percentile(self, p: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+
+    def print_data(self) -> str:
+        elapsed = self.elapsed_sec or 1e-9
+        s = "ReplayStats:\n"
+        s += f"\tconnections: {self.connections} ({self.errors} errors)\n"
+        s += f"\telapsed_sec: {self.elapsed_sec:.3f}\n"
+        s += f"\tsent: {self.sent_messages} messages, {self.sent_bytes} bytes " \
+             f"({self.sent_messages / elapsed:.1f} msg/s, {self.sent_bytes / elapsed / 1e6:.2f} MB/s)\n"
+        s += f"\treceived: {self.received_messages} messages, {self.received_bytes} bytes\n"
+        if self.latencies:
+            s += f"\tlatency_ms: p50 {self.percentile(50) * 1e3:.2f}, p90 {self.percentile(90) * 1e3:.2f}, " \
+                 f"p99 {self.percentile(99) * 1e3:.2f}, max {max(self.latencies) * 1e3:.2f}\n"
+        return s
+
+
+class _ReplayConn:
+    def __init__(self, recorded: RecordedConnection, sock, addr):
+        self.recorded = recorded
+        self.sock = sock
+        self.addr = addr
+        self.next_frame = 0
+        self.out: Deque[Tuple[memoryview, bool]] = deque()
+        self.recv_buffer = bytearray()
+        self.awaiting: Deque[float] = deque()
+        self.closed = False
+
+
+class SockReplayer:
+    """This class replays recorded connections against the server reached through transport. speed is
+    the time scale (1.0 real time, 10.0 ten times faster, 0 as fast as possible) and copies opens every
+    recorded connection that many times. All connections are driven from one selector loop.
+
+    A frame's latency runs from the moment it has been written completely to the arrival of the next
+    frame from the server on the same connection, and is only taken for frames the server answered in
+    the recording. After the last frame has been sent, answers are awaited for up to drain_sec."""
+    def __init__(self, connections: List[RecordedConnection], transport: Transport, speed: float = 1.0,
+                 copies: int = 1, drain_sec: float = 5.0):
+        self.connections = connections
+        self.transport = transport
+        self.speed = speed
+        self.copies = copies
+        self.drain_sec = drain_sec
+        self.stats = ReplayStats()
+        self._sel = selectors.DefaultSelector()
+
+    def run(self) -> ReplayStats:
+        conns: List[_ReplayConn] = []
+        for recorded in self.connections:
+            for _ in range(self.copies):
+                try:
+                    sock, addr = self.transport.connect()
+                except OSError as e:
+                    print(f"Replay: connection for {recorded.addr} failed: {repr(e)}")
+                    self.stats.errors += 1
+                    continue
+                conn = _ReplayConn(recorded, sock, addr)
+                self._sel.register(sock, selectors.EVENT_READ, data=conn)
+                conns.append(conn)
+        self.stats.connections = len(conns)
+
+        start = time.monotonic()
+        timers = [(self._due(c), i) for i, c in enumerate(conns)]
+        heapq.heapify(timers)
+        drain_deadline: Optional[float] = None
+        try:
+            while True:
+                now = time.monotonic() - start
+                while timers and timers[0][0] <= now:
+                    _, i = heapq.heappop(timers)
+                    conn = conns[i]
+                    if conn.closed:
+                        continue
+                    self._queue_frame(conn)
+                    if conn.next_frame < len(conn.recorded.frames):
+                        heapq.heappush(timers, (self._due(conn), i))
+
+                busy = [c for c in conns if not c.closed and c.out]
+                if not timers and not busy:
+                    if not any(c.awaiting for c in conns if not c.closed):
+                        break
+                    if drain_deadline is None:
+                        drain_deadline = now + self.drain_sec
+                    elif now >= drain_deadline:
+                        break
+                timeout = 0.05 if not timers else max(0.0, min(0.05, timers[0][0] - now))
+                for key, mask in self._sel.select(timeout):
+                    conn = key.data
+                    try:
+                        if mask & selectors.EVENT_WRITE:
+                            self._write(conn)
+                        if mask & selectors.EVENT_READ:
+                            self._read(conn)
+                    except OSError as e:
+                        print(f"Replay: error on {conn.addr}: {repr(e)}")
+                        self.stats.errors += 1
+                        self._close(conn)
+        finally:
+            self.stats.elapsed_sec = time.monotonic() - start
+            for conn in conns:
+                self._close(conn)
+            self._sel.close()
+        return self.stats
+
+    def _due(self, conn: _ReplayConn) -> float:
+        if self.speed <= 0:
+            return 0.0
+        return conn.recorded.frames[conn.next_frame][0] / self.speed
+
+    def _queue_frame(self, conn: _ReplayConn):
+        _, frame, answered = conn.recorded.frames[conn.next_frame]
+        conn.next_frame += 1
+        if not conn.out:
+            self._sel.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, data=conn)
+        conn.out.append((memoryview(frame), answered))
+
+    def _write(self, conn: _ReplayConn):
+        try:
+            sent = conn.sock.sendmsg([view for view, _ in list(conn.out)[:64]])
+        except BlockingIOError:
+            return
+        self.stats.sent_bytes += sent
+        now = time.monotonic()
+        while sent:
+            view, answered = conn.out[0]
+            if sent < len(view):
+                conn.out[0] = (view[sent:], answered)
+                break
+            sent -= len(view)
+            conn.out.popleft()
+            self.stats.sent_messages += 1
+            if answered:
+                conn.awaiting.append(now)
+        if not conn.out:
+            self._sel.modify(conn.sock, selectors.EVENT_READ, data=conn)
+
+    def _read(self, conn: _ReplayConn):
+        try:
+            data = conn.sock.recv(65536)
+        except BlockingIOError:
+            return
+        if not data:
+            self._close(conn)
+            return
+        buffer = conn.recv_buffer
+        buffer += data
+        now = time.monotonic()
+        while len(buffer) >= 2:
+            hdrlen = struct.unpack(">H", buffer[:2])[0]
+            if len(buffer) < 2 + hdrlen:
+                break
+            header = JSON_CODEC.decode(bytes(buffer[2:2 + hdrlen]), "utf-8")
+            total = 2 + hdrlen + header["content-length"]
+            if len(buffer) < total:
+                break
+            del buffer[:total]
+            self.stats.received_messages += 1
+            self.stats.received_bytes += total
+            if conn.awaiting:
+                self.stats.latencies.append(now - conn.awaiting.popleft())
+
+    def _close(self, conn: _ReplayConn):
+        if conn.closed:
+            return
+        conn.closed = True
+        try:
+            self._sel.unregister(conn.sock)
+        except Exception:
+            pass
+        conn.sock.close()
+
+
+def main():
+    """Replay a recording against a running server: speed 1 is real time, 0 as fast as possible."""
+    if len(sys.argv) not in (4, 5, 6):
+        print("usage:", sys.argv[0], "<recording> <host> <port> [speed] [copies]")
+        sys.exit(1)
+
+    path, host, port = sys.argv[1], sys.argv[2], int(sys.argv[3])
+    speed = float(sys.argv[4]) if len(sys.argv) > 4 else 1.0
+    copies = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+    replayer = SockReplayer(load_connections(path), transport_for(host, port), speed=speed, copies=copies)
+    print(replayer.run().print_data())
+
+
+if __name__ == "__main__":
+    main()
@@ -8,94 +8,207 @@ import socket
 import threading
 import traceback
 
-from typing import List
+from typing import List, Optional
 
 
 from sock_message import *
+from sock_transport import Transport, transport_for
+from sock_recorder import Recorder
+from loop_watchdog import LoopWatchdog
+from sock_spool import OutboundSpool, new_message_id
 
 
 class SockServer:
     """This class is the socket server that provides a communication link between select VMs running
     as part of a test iteration. It is designed to handle multiple connections from the client software.
-    It should be instantiated from the testbed. The event loop runs in a thread."""
-    def __init__(self, my_host: str, my_port: int, context: str = None):
+    It should be instantiated from the testbed. The event loop runs in a thread. The transport defaults to
+    TCP on my_host/my_port ('unix:/path' as my_host selects a Unix domain socket); pass a Transport from
+    sock_transport to use something else. Give a Recorder (see sock_recorder) to capture all traffic.
+
+    Every wakeup of the listening socket accepts all pending connections, up to the admission limit of
+    max_accepts_per_sec (None for no limit); connections over the limit wait in the kernel's listen queue
+    of backlog entries. TCP connections get TCP_NODELAY when nodelay is set, since our messages are small
+    and latency bound. loop_pause is the pause after every pass of the event loop.
+
+    A LoopWatchdog (see loop_watchdog) reports passes of the event loop and process_events() calls that
+    block the loop for too long, with a stack sample of where they were stuck. loop_thread is the event
+    loop thread, e.g. for a SamplingProfiler limited to it.
+
+    With an OutboundSpool (see sock_spool) every message sent with send_message() is made durable first and
+    resent to its client after a reconnect until the client acknowledges it."""
+    def __init__(self, my_host: str, my_port: int, context: str = None, accept: Optional[List[str]] = None,
+                 transport: Optional[Transport] = None, recorder: Optional[Recorder] = None,
+                 backlog: int = socket.SOMAXCONN, max_accepts_per_sec: Optional[float] = None,
+                 nodelay: bool = True, loop_pause: float = 1.0, watchdog: Optional[LoopWatchdog] = None,
+                 spool: Optional[OutboundSpool] = None):
         self._host: str = my_host
         self._port: int = my_port
+        self._transport: Transport = transport if transport is not None else transport_for(my_host, my_port)
         self._context: str = context
+        self._accept: Optional[List[str]] = accept   # content-types offered to clients, see sock_codec
+        self._recorder: Optional[Recorder] = recorder
+        self._backlog: int = backlog
+        self._max_accepts_per_sec: Optional[float] = max_accepts_per_sec
+        self._nodelay: bool = nodelay
+        self._loop_pause: float = loop_pause
+        # Token bucket for admission control, holding up to one second's worth of accepts.
+        self._accept_tokens: float = max_accepts_per_sec or 0.0
+        self._accept_tokens_time: float = time.monotonic()
+        self._accept_paused: bool = False
+        self._watchdog: Optional[LoopWatchdog] = watchdog
+        self._spool: Optional[OutboundSpool] = spool
         self._listen_sock = None
         self._sel: selectors = selectors.DefaultSelector()
+        self.loop_thread: Optional[threading.Thread] = None
 
         self.sock_objects: List[SockMessage] = []
 
     def setup_listen_socket(self):
         """This method sets up the listening socket. For each connection, the listening socket will be
         cloned by socket.accept()."""
-        self._listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        # Avoid bind() exception: OSError: [Errno 48] Address already in use.
-        self._listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-        self._listen_sock.bind((self._host, self._port))
-        self._listen_sock.listen()
-        self._listen_sock.setblocking(False)
-        print("Listening on", (self._host, self._port))
+        self._listen_sock = self._transport.listen(self._backlog)
+        print("Listening on", self._transport.address)
 
         # Register the socket with selectors API.
         self._sel.register(self._listen_sock, selectors.EVENT_READ, data=None)
 
         # Start the event loop in a thread.
-        threading.Thread(target=self.event_loop, daemon=True).start()
+        self.loop_thread = threading.Thread(target=self.event_loop, daemon=True)
+        self.loop_thread.start()
 
     def accept_wrapper(self, sock):
-        """This method is called from the event loop and establishes a connection in answer to a request
-        for a connection. It keeps a list of SockMessage instance references so messages can be sent to
-        clients with a specific iteration and context."""
-        conn, addr = sock.accept()  # Clones the listening socket for the server end on the connection.
+        """This method is called from the event loop and establishes connections in answer to requests for a
+        connection. It accepts every connection that is waiting, not just one, so a few hundred VMs booting
+        at once are taken in on the same wakeup. It keeps a list of SockMessage instance references so
+        messages can be sent to clients with a specific iteration and context."""
+        while self._admit():
+            try:
+                # Clones the listening socket for the server end on the connection.
+                conn, addr = self._transport.accept(sock)
+            except (BlockingIOError, InterruptedError):
+                return
+            self._accept_tokens -= 1
+            self._register_connection(conn, addr)
+        self._pause_accepting()
+
+    def _register_connection(self, conn, addr):
         print("Accepted connection from", addr)
         conn.setblocking(False)
+        if self._nodelay and conn.family in (socket.AF_INET, socket.AF_INET6):
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         """Keep in mind that the SockMessage instance that is created here is on the server side of the
         connection! The client connection has its own instance of SockMessage. Note setting of the
         server_instance flag."""
-        sock_message = SockMessage(self._sel, sock=conn, addr=addr, server_instance=True)
+        sock_message = SockMessage(self._sel, sock=conn, addr=addr, server_instance=True, accept=self._accept,
+                                   recorder=self._recorder)
+        sock_message.spool = self._spool
+        sock_message.on_close = self._forget_connection
         events = selectors.EVENT_READ | selectors.EVENT_WRITE
         self._sel.register(conn, events, data=sock_message)
         self.sock_objects.append(sock_message)
 
+    def _forget_connection(self, sock_message: SockMessage):
+        """Called when a connection closes. The list is replaced rather than changed in place, since
+        send_message() walks it from other threads."""
+        self.sock_objects = [s for s in self.sock_objects if s is not sock_message]
+
+    def _admit(self) -> bool:
+        """Refill the admission token bucket and say whether another connection may be accepted now."""
+        if self._max_accepts_per_sec is None:
+            self._accept_tokens = 1.0
+            return True
+        now = time.monotonic()
+        self._accept_tokens = min(self._max_accepts_per_sec, self._accept_tokens +
+                                  (now - self._accept_tokens_time) * self._max_accepts_per_sec)
+        self._accept_tokens_time = now
+        return self._accept_tokens >= 1.0
+
+    def _pause_accepting(self):
+        """Out of admission tokens: stop watching the listening socket so a full listen queue does not wake
+        the loop on every pass. _resume_accepting() puts it back once a token has been earned."""
+        if not self._accept_paused:
+            self._sel.unregister(self._listen_sock)
+            self._accept_paused = True
+
+    def _accept_wait(self) -> Optional[float]:
+        """Seconds until accepting resumes, or None when it is not paused."""
+        if not self._accept_paused:
+            return None
+        return max(0.0, (1.0 - self._accept_tokens) / self._max_accepts_per_sec -
+                   (time.monotonic() - self._accept_tokens_time))
+
+    def _resume_accepting(self):
+        if self._accept_paused and self._accept_wait() == 0.0:
+            self._sel.register(self._listen_sock, selectors.EVENT_READ, data=None)
+            self._accept_paused = False
+
     def close(self):
         """We make the assumption that the client on the other end is going to close itself up when through."""
         self._sel.close()
+        self._transport.close()
+        if self._recorder is not None:
+            self._recorder.close()
 
-    def send_message(self, action: str, iteration: int, context: str, message: str):
+    def send_message(self, action: str, iteration: int, context: str, message: str) -> Optional[str]:
         """When the server needs to send a message to a client, we need to find which client to send it
-        to based on the iteration number and the client context."""
-        for sock_object in self.sock_objects:       # Our list of SockMessage client connections.
-            if sock_object.iteration == iteration and sock_object.context == context:
-                sock_object.message_out = create_message(action=action, value=message, iteration=iteration)
+        to based on the iteration number and the client context. With a spool, a SOCK_COMMAND gets an ID,
+        which is returned, and is on disk before this returns; a client that is not connected yet gets it
+        when it connects. Only commands are spooled, since only they are acknowledged (by the
+        SOCK_COMMAND_RESPONSE carrying the ID); other actions are sent once, as without a spool. Closed
+        connections are dropped from sock_objects, and a client that reconnected before its old connection
+        was closed gets the message on its newest one."""
+        message_id = None
+        if self._spool is not None and action == SOCK_COMMAND:
+            message_id = new_message_id()
+            out = create_message(action=action, value=message, iteration=iteration, message_id=message_id)
+            self._spool.log_send(message_id, iteration, context, out)
+        else:
+            out = create_message(action=action, value=message, iteration=iteration)
+        for sock_object in reversed(self.sock_objects):     # Our list of SockMessage client connections.
+            if sock_object.iteration == iteration and sock_object.context == context and not sock_object.closed:
+                sock_object.post_message(out)
                 break
+        return message_id
 
     def event_loop(self):
         """This is the event loop for monitoring socket connections. We are using select() which returns a list
         of socket connections that are ready for I/O. key.fileobj is the socket. key.data is a reference to
         SockMessage. If key.data is None, then this is the listening socket and so we call accept_wrapper()
         otherwise, we call sock_obj.process_events() passing in the communication type mask."""
+        watchdog = self._watchdog
+        if watchdog is not None:
+            watchdog.attach()
         try:
             while True:
-                events = self._sel.select(timeout=None)
+                self._resume_accepting()
+                events = self._sel.select(timeout=self._accept_wait())
+                if watchdog is not None:
+                    watchdog.loop_started()
                 for key, mask in events:
                     if key.data is None:
                         self.accept_wrapper(key.fileobj)
                     else:
                         sock_object: SockMessage = key.data
+                        if watchdog is not None:
+                            watchdog.begin(f"process_events for {sock_object.addr} "
+                                           f"(iteration {sock_object.iteration})")
                         try:
                             sock_object.process_events(mask)
                         except Exception:
                             print("Server: error: exception for",
                                   f"{sock_object.addr}:\n{traceback.format_exc()}")
                             sock_object.close()
-                time.sleep(1)   # just pausing for a second to keep from breaking the speed limit ;)
+                        if watchdog is not None:
+                            watchdog.end()
+                if watchdog is not None:
+                    watchdog.loop_finished()
+                if self._loop_pause:
+                    time.sleep(self._loop_pause)   # pausing to keep from breaking the speed limit ;)
         except KeyboardInterrupt:
             print("Caught keyboard interrupt, exiting...")
         finally:
+            if watchdog is not None:
+                watchdog.stop()
             self._sel.close()
 
 
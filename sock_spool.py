@@ -0,0 +1,188 @@
+"""Durable spool of the commands SockServer sends. Every command is written to a write-ahead log before it is handed
+to the connection, and the client's SOCK_COMMAND_RESPONSE acknowledges it by message ID. After a controller
+restart the log is read back, and the commands that were never acknowledged are sent again when their client
+reconnects and repeats the SOCK_SET_ITERATION handshake. Clients recognise a replayed message ID and answer with
+the result they already have instead of running the command twice."""
+
+import os
+import uuid
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple
+
+from sock_codec import JSON_CODEC
+
+
+def new_message_id() -> str:
+    return uuid.uuid4().hex
+
+
+class OutboundSpool:
+    """This class is the write-ahead log of outbound commands, one JSON record per line: 'send' records
+    carry the complete message with its iteration and context, 'ack' records name an acknowledged
+    message ID.
+
+    Records are written by one writer thread. All records that arrive while an fsync is in progress are
+    written and synced together by the next one (group commit), so the cost of fsync is shared by every
+    command sent in the meantime instead of being paid per command. log_send() returns once the command
+    is on disk; acknowledgements are not waited for, since losing one only causes a duplicate that the
+    client suppresses.
+
+    On start the log is read back and rewritten with only the unacknowledged commands, which keeps it
+    from growing without bound across restarts.
+
+    If writing the log fails (a full or broken disk), the error is raised by log_send() to every caller
+    waiting on that write and by every later log_send(); the spool does not try to recover. ack() keeps
+    working in memory, since a lost acknowledgement only causes a duplicate."""
+    def __init__(self, path: str, fsync: bool = True):
+        self.path = path
+        self.fsync = fsync
+        self._pending: "OrderedDict[str, Tuple[int, str, dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._records: List[Tuple[bytes, Optional[Future]]] = []
+        self._condition = threading.Condition()
+        self._closed = False
+        self._error: Optional[BaseException] = None
+        self._recover()
+        self._file = open(path, "ab")
+        self._writer = threading.Thread(target=self._write_loop, daemon=True, name="sock-spool")
+        self._writer.start()
+
+    def log_send(self, message_id: str, iteration: int, context: str, message: dict):
+        """Make a command durable. Blocks until its record has been synced to disk and raises the error
+        if it could not be."""
+        done: Future = Future()
+        self._append({"op": "send", "id": message_id, "iteration": iteration, "context": context,
+                      "message": message}, done)
+        with self._lock:
+            self._pending[message_id] = (iteration, context, message)
+        try:
+            done.result()
+        except BaseException:
+            with self._lock:
+                self._pending.pop(message_id, None)
+            raise
+
+    def ack(self, message_id: str) -> bool:
+        """Record the acknowledgement of a command. Returns False for an ID that is unknown or already
+        acknowledged, i.e. a duplicate response."""
+        with self._lock:
+            if self._pending.pop(message_id, None) is None:
+                return False
+        try:
+            self._append({"op": "ack", "id": message_id}, None)
+        except RuntimeError as e:
+            print(f"OutboundSpool: acknowledgement of {message_id} not logged: {e}")
+        return True
+
+    def pending_for(self, iteration: int, context: str) -> List[dict]:
+        """The unacknowledged commands of a client, in the order they were sent."""
+        with self._lock:
+            return [message for it, ctx, message in self._pending.values() if it == iteration and ctx == context]
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._writer.join()
+        self._file.close()
+
+    def _append(self, record: dict, done: Optional[Future]):
+        line = JSON_CODEC.encode(record, "utf-8") + b"\n"
+        with self._condition:
+            if self._error is not None:
+                raise RuntimeError(f"OutboundSpool cannot write {self.path}: {repr(self._error)}") from self._error
+            if self._closed:
+                raise RuntimeError("OutboundSpool is closed.")
+            self._records.append((line, done))
+            self._condition.notify()
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                while not self._records and not self._closed:
+                    self._condition.wait()
+                batch, self._records = self._records, []
+                if not batch and self._closed:
+                    return
+            try:
+                self._file.write(b"".join(line for line, _ in batch))
+                self._file.flush()
+                if self.fsync:
+                    os.fsync(self._file.fileno())
+            except Exception as e:
+                print(f"OutboundSpool: writing {self.path} failed: {repr(e)}")
+                with self._condition:
+                    self._error = e
+                    batch += self._records
+                    self._records = []
+                for _, done in batch:
+                    if done is not None:
+                        done.set_exception(e)
+                return
+            for _, done in batch:
+                if done is not None:
+                    done.set_result(None)
+
+    def _recover(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    record = JSON_CODEC.decode(line, "utf-8")
+                except ValueError:
+                    break   # a record torn by a crash can only be the last one
+                if record["op"] == "send":
+                    self._pending[record["id"]] = (record["iteration"], record["context"], record["message"])
+                elif record["op"] == "ack":
+                    self._pending.pop(record["id"], None)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for message_id, (iteration, context, message) in self._pending.items():
+                f.write(JSON_CODEC.encode({"op": "send", "id": message_id, "iteration": iteration,
+                                           "context": context, "message": message}, "utf-8") + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class RecentResults:
+    """Client side duplicate suppression: the results of the last max_entries message IDs. run() executes
+    func for an ID only once; a duplicate that arrives while the first is still running waits for it,
+    and a later one gets the stored result."""
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._results: "OrderedDict[str, Future]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def run(self, message_id: Optional[str], func: Callable[[], object]):
+        if message_id is None:
+            return func()
+        with self._lock:
+            future = self._results.get(message_id)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._results[message_id] = future
+                while len(self._results) > self.max_entries:
+                    self._results.popitem(last=False)
+            else:
+                self._results.move_to_end(message_id)
+        if not owner:
+            return future.result()
+        try:
+            result = func()
+        except BaseException as e:
+            with self._lock:
+                self._results.pop(message_id, None)
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        return result
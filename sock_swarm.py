@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+"""Load generator for SockServer. Thousands of simulated SockClients run in one process on a single asyncio event
+loop. Each one connects, does the SOCK_SET_ITERATION handshake and answers every SOCK_COMMAND with synthetic output
+of a configurable size after a configurable delay. Connections are ramped up step by step on a schedule and every
+step reports how the server kept up, so the number of VMs one controller can serve can be measured."""
+
+import sys
+import time
+import struct
+import asyncio
+
+from typing import List, Optional, Tuple
+
+from sock_codec import CONTENT_TYPE_JSON, JSON_CODEC
+from sock_message import SOCK_COMMAND, SOCK_COMMAND_RESPONSE, SOCK_SET_ITERATION, create_message
+from sock_transport import UNIX_PREFIX
+
+
+def encode_frame(message: dict) -> bytes:
+    """Frame a message built by create_message() the way SockMessage does."""
+    content = JSON_CODEC.encode(message["content"], message["encoding"])
+    header = JSON_CODEC.encode({
+        "byteorder": sys.byteorder,
+        "content-type": message["type"],
+        "content-encoding": message["encoding"],
+        "content-length": len(content),
+    }, "utf-8")
+    return struct.pack(">H", len(header)) + header + content
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[dict, bytes]:
+    """Read one frame; returns the JSON header and the raw content."""
+    hdrlen = struct.unpack(">H", await reader.readexactly(2))[0]
+    header = JSON_CODEC.decode(await reader.readexactly(hdrlen), "utf-8")
+    return header, await reader.readexactly(header["content-length"])
+
+
+class StepReport:
+    """What happened during one step of the ramp."""
+    def __init__(self, target: int, hold_sec: float):
+        self.target: int = target
+        self.hold_sec: float = hold_sec
+        self.connected: int = 0
+        self.failed: int = 0
+        self.dropped: int = 0
+        self.connect_latencies: List[float] = []
+        self.commands: int = 0
+        self.response_bytes: int = 0
+
+    def percentile(self, p: float) -> float:
+        if not self.connect_latencies:
+            return 0.0
+        ordered = sorted(self.connect_latencies)
+        return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+
+    def print_data(self) -> str:
+        return (f"target {self.target:6d}  connected {self.connected:6d}  failed {self.failed:5d}  "
+                f"dropped {self.dropped:5d}  connect p50/p99 ms {self.percentile(50) * 1e3:8.1f} "
+                f"{self.percentile(99) * 1e3:8.1f}  commands {self.commands:6d} "
+                f"({self.commands / (self.hold_sec or 1e-9):.1f}/s)\n")
+
+
+class ClientSwarm:
+    """This class drives the swarm. schedule is a list of (target connections, hold seconds): during a step
+    the new connections are opened evenly spread over the hold time and then held. Iterations are numbered
+    from first_iteration, one per simulated client, all in the same context.
+
+    A step counts as handled when every connection of it was established, none of the connections it
+    opened was dropped by the server (even later, during another step) and the 99th percentile connect
+    time stayed under max_connect_ms; capacity() is the target of the last step in a row that was
+    handled."""
+    def __init__(self, host: str, port: int, context: str, schedule: List[Tuple[int, float]],
+                 output_size: int = 1024, delay_sec: float = 0.0, first_iteration: int = 1,
+                 connect_timeout: float = 10.0, max_connect_ms: float = 1000.0):
+        self.host = host
+        self.port = port
+        self.context = context
+        self.schedule = schedule
+        self.output_size = output_size
+        self.delay_sec = delay_sec
+        self.first_iteration = first_iteration
+        self.connect_timeout = connect_timeout
+        self.max_connect_ms = max_connect_ms
+        self.reports: List[StepReport] = []
+        self._output = "x" * output_size
+        self._live = 0
+        self._current: Optional[StepReport] = None
+        self._stopping = False
+
+    def run(self) -> List[StepReport]:
+        return asyncio.run(self.run_async())
+
+    async def run_async(self) -> List[StepReport]:
+        tasks: List[asyncio.Task] = []
+        for target, hold_sec in self.schedule:
+            report = StepReport(target, hold_sec)
+            self.reports.append(report)
+            self._current = report
+            step_start = time.monotonic()
+            new = max(0, target - len(tasks))
+            for i in range(new):
+                due = step_start + hold_sec * i / new
+                await asyncio.sleep(max(0.0, due - time.monotonic()))
+                iteration = self.first_iteration + len(tasks)
+                tasks.append(asyncio.ensure_future(self._client(iteration)))
+            await asyncio.sleep(max(0.0, step_start + hold_sec - time.monotonic()))
+            report.connected = self._live
+        self._stopping = True
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return self.reports
+
+    def capacity(self) -> int:
+        handled = 0
+        for report in self.reports:
+            if (report.connected < report.target or report.failed or report.dropped
+                    or report.percentile(99) * 1e3 > self.max_connect_ms):
+                break
+            handled = report.target
+        return handled
+
+    def print_report(self) -> str:
+        s = "ClientSwarm:\n"
+        for report in self.reports:
+            s += "\t" + report.print_data()
+        s += f"\tcapacity: {self.capacity()} connections\n"
+        return s
+
+    async def _open(self):
+        if self.host.startswith(UNIX_PREFIX):
+            return await asyncio.open_unix_connection(self.host[len(UNIX_PREFIX):], limit=1 << 24)
+        return await asyncio.open_connection(self.host, self.port, limit=1 << 24)
+
+    async def _client(self, iteration: int):
+        # Failures and drops belong to the step that opened the connection, not to whichever step is
+        # running when they happen; commands are throughput and count towards the current step.
+        step = self._current
+        start = time.monotonic()
+        try:
+            reader, writer = await asyncio.wait_for(self._open(), self.connect_timeout)
+        except (OSError, asyncio.TimeoutError):
+            step.failed += 1
+            return
+        step.connect_latencies.append(time.monotonic() - start)
+        self._live += 1
+        try:
+            writer.write(encode_frame(create_message(action=SOCK_SET_ITERATION, value="swarm",
+                                                     iteration=iteration, context=self.context)))
+            await writer.drain()
+            while True:
+                header, content = await read_frame(reader)
+                if header["content-type"] != CONTENT_TYPE_JSON:
+                    continue
+                message = JSON_CODEC.decode(content, header["content-encoding"])
+                if message.get("action") != SOCK_COMMAND:
+                    continue
+                if self.delay_sec:
+                    await asyncio.sleep(self.delay_sec)
+                frame = encode_frame(create_message(action=SOCK_COMMAND_RESPONSE, value=self._output,
+                                                    iteration=iteration, context=self.context))
+                writer.write(frame)
+                await writer.drain()
+                self._current.commands += 1
+                self._current.response_bytes += len(frame)
+        except (OSError, asyncio.IncompleteReadError):
+            if not self._stopping:
+                step.dropped += 1
+        finally:
+            self._live -= 1
+            writer.close()
+
+
+def parse_schedule(text: str) -> List[Tuple[int, float]]:
+    """'100:10,1000:30' is 100 connections held for 10 seconds, then 1000 held for 30 seconds."""
+    steps = []
+    for step in text.split(","):
+        target, hold = step.split(":")
+        steps.append((int(target), float(hold)))
+    return steps
+
+
+def main():
+    if len(sys.argv) not in (5, 6, 7):
+        print("usage:", sys.argv[0], "<host> <port> <context> <schedule e.g. 100:10,1000:30> "
+                                     "[output bytes] [delay sec]")
+        sys.exit(1)
+
+    host, port, context, schedule = sys.argv[1], int(sys.argv[2]), sys.argv[3], parse_schedule(sys.argv[4])
+    output_size = int(sys.argv[5]) if len(sys.argv) > 5 else 1024
+    delay_sec = float(sys.argv[6]) if len(sys.argv) > 6 else 0.0
+    swarm = ClientSwarm(host, port, context, schedule, output_size=output_size, delay_sec=delay_sec)
+    swarm.run()
+    print(swarm.print_report())
+
+
+if __name__ == "__main__":
+    main()
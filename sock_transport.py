@@ -0,0 +1,173 @@
+"""Transports for SockServer and SockClient. TCP is the default; agents on the same host as the controller can use a
+Unix domain socket instead, and in-process tests can connect through socketpair() without any address at all. All
+of them carry the same SockMessage framing, so nothing above the socket changes."""
+
+import os
+import stat
+import errno
+import socket
+import threading
+
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Any, Deque, Tuple
+
+UNIX_PREFIX = "unix:"
+
+
+class Transport(ABC):
+    """Creates the listening socket of a server and the connecting socket of a client. The listening
+    socket is registered with the server's selector; when it is readable, accept() is called."""
+    @abstractmethod
+    def listen(self, backlog: int) -> socket.socket:
+        pass
+
+    def accept(self, listen_sock: socket.socket) -> Tuple[socket.socket, Any]:
+        return listen_sock.accept()
+
+    @abstractmethod
+    def connect(self) -> Tuple[socket.socket, Any]:
+        """Start a non-blocking connection; returns the socket and the address to report."""
+
+    def close(self):
+        pass
+
+    @property
+    @abstractmethod
+    def address(self) -> Any:
+        pass
+
+
+class TcpTransport(Transport):
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.host, self.port
+
+    def listen(self, backlog: int) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Avoid bind() exception: OSError: [Errno 48] Address already in use.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(self.address)
+        sock.listen(backlog)
+        sock.setblocking(False)
+        return sock
+
+    def connect(self) -> Tuple[socket.socket, Any]:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.connect_ex(self.address)
+        return sock, self.address
+
+
+class UnixTransport(Transport):
+    """A Unix domain stream socket at path. A stale socket file left by an earlier server is removed
+    before binding, and the file is removed again on close(). A socket file that a running server still
+    accepts connections on is left alone and listen() fails with EADDRINUSE."""
+    def __init__(self, path: str):
+        self.path = path
+        self._bound = False
+
+    @property
+    def address(self) -> str:
+        return self.path
+
+    def listen(self, backlog: int) -> socket.socket:
+        if os.path.exists(self.path):
+            self._remove_stale()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(backlog)
+        sock.setblocking(False)
+        self._bound = True
+        return sock
+
+    def _remove_stale(self):
+        """Unlink the socket file only if nobody is listening on it (the connection is refused). Anything at
+        the path that is not a socket is left alone: connect() is refused by a regular file as well."""
+        try:
+            mode = os.lstat(self.path).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise OSError(errno.EEXIST, f"{self.path} exists and is not a socket", self.path)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except ConnectionRefusedError:
+            os.unlink(self.path)
+            return
+        except FileNotFoundError:
+            return
+        finally:
+            probe.close()
+        raise OSError(errno.EADDRINUSE, f"A server is already listening on {self.path}", self.path)
+
+    def accept(self, listen_sock: socket.socket) -> Tuple[socket.socket, Any]:
+        conn, _ = listen_sock.accept()
+        # Unix clients are unnamed; report the server path so log lines still say where they came in.
+        return conn, self.path
+
+    def connect(self) -> Tuple[socket.socket, Any]:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.connect_ex(self.path)
+        return sock, self.path
+
+    def close(self):
+        if self._bound and os.path.exists(self.path):
+            os.unlink(self.path)
+            self._bound = False
+
+
+class SocketPairTransport(Transport):
+    """Connections made with socket.socketpair() inside one process. connect() creates a pair, keeps one
+    end for the server and wakes the server's 'listening' socket, which is one end of an internal pair
+    that carries a byte per pending connection. Meant for tests and for running a client and the server
+    in the same process; one instance must be shared by the server and its clients."""
+    def __init__(self, name: str = "socketpair"):
+        self.name = name
+        self._pending: Deque[socket.socket] = deque()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def address(self) -> str:
+        return self.name
+
+    def listen(self, backlog: int) -> socket.socket:
+        return self._wake_r
+
+    def accept(self, listen_sock: socket.socket) -> Tuple[socket.socket, Any]:
+        listen_sock.recv(1)
+        with self._lock:
+            return self._pending.popleft(), self.name
+
+    def connect(self) -> Tuple[socket.socket, Any]:
+        client_end, server_end = socket.socketpair()
+        client_end.setblocking(False)
+        with self._lock:
+            self._count += 1
+            self._pending.append(server_end)
+            self._wake_w.send(b"\0")
+            return client_end, f"{self.name}-{self._count}"
+
+    def close(self):
+        with self._lock:
+            while self._pending:
+                self._pending.popleft().close()
+        self._wake_w.close()
+        self._wake_r.close()
+
+
+def transport_for(host: str, port: int) -> Transport:
+    """The transport for a host/port pair as given on the command line: 'unix:/path/to/socket' selects a
+    Unix domain socket (the port is ignored), anything else is TCP."""
+    if host.startswith(UNIX_PREFIX):
+        return UnixTransport(host[len(UNIX_PREFIX):])
+    return TcpTransport(host, port)
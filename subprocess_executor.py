@@ -0,0 +1,178 @@
+"""Execution engine for SubprocessItem. Commands run with bounded concurrency per for_node, their stdout and
+stderr are streamed into OutputItems while they run, timeouts kill the whole process group, and a fixed set of
+worker threads is started up front so a burst of short commands does not pay for thread start-up."""
+
+import os
+import time
+import signal
+import selectors
+import threading
+import subprocess
+
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Callable, Deque, Dict, Optional
+
+from items import OutputItem, SubprocessItem
+
+
+class _Job:
+    def __init__(self, item: SubprocessItem, timeout: Optional[float], iteration: int):
+        self.item = item
+        self.timeout = timeout
+        self.iteration = iteration
+        self.future: Future = Future()
+
+
+class SubprocessExecutor:
+    """This class runs SubprocessItems. At most max_per_node commands run at once for the same for_node,
+    and nodes take turns so one busy node cannot starve the others. The worker threads are started in
+    the constructor and live until shutdown().
+
+    Output is read line by line from both pipes with a selector and each line is passed to output_sink
+    as an OutputItem (stderr lines are prefixed with 'stderr: '), which is typically a put() onto the
+    output queue. The complete output is also left in item.output and the exit code in item.exit_code.
+    On timeout the process group gets SIGTERM, then SIGKILL after kill_grace_sec, and exit_code is the
+    negative signal number.
+
+    Processes are started without preexec_fn (start_new_session is used for the process group), which
+    lets CPython use vfork() instead of a full fork() of the controller process."""
+    def __init__(self, output_sink: Optional[Callable[[OutputItem], None]] = None, max_workers: int = 16,
+                 max_per_node: int = 4, kill_grace_sec: float = 2.0):
+        self.output_sink = output_sink
+        self.max_per_node = max_per_node
+        self.kill_grace_sec = kill_grace_sec
+        self._pending: "OrderedDict[str, Deque[_Job]]" = OrderedDict()
+        self._running: Dict[str, int] = {}
+        self._condition = threading.Condition()
+        self._shutdown = False
+        self._workers = [threading.Thread(target=self._worker, daemon=True, name=f"subprocess-{i}")
+                         for i in range(max_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, item: SubprocessItem, timeout: Optional[float] = None, iteration: int = -1) -> Future:
+        """Queue an item. The future resolves to the same SubprocessItem once it has finished."""
+        job = _Job(item, timeout, iteration)
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("SubprocessExecutor has been shut down.")
+            self._pending.setdefault(item.for_node, deque()).append(job)
+            self._condition.notify()
+        return job.future
+
+    def run(self, item: SubprocessItem, timeout: Optional[float] = None, iteration: int = -1) -> SubprocessItem:
+        return self.submit(item, timeout, iteration).result()
+
+    def shutdown(self, wait: bool = True):
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def _next_job(self) -> Optional[_Job]:
+        """Take the next job from the first node (in turn order) that is under its limit. Called with the
+        condition held."""
+        for node, jobs in self._pending.items():
+            if self._running.get(node, 0) < self.max_per_node:
+                job = jobs.popleft()
+                if jobs:
+                    self._pending.move_to_end(node)
+                else:
+                    del self._pending[node]
+                self._running[node] = self._running.get(node, 0) + 1
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None:
+                    if self._shutdown and not self._pending:
+                        return
+                    self._condition.wait()
+                    job = self._next_job()
+            try:
+                if job.future.set_running_or_notify_cancel():
+                    self._execute(job)
+                    job.future.set_result(job.item)
+            except BaseException as e:
+                job.future.set_exception(e)
+            finally:
+                with self._condition:
+                    self._running[job.item.for_node] -= 1
+                    self._condition.notify_all()
+
+    def _emit(self, job: _Job, text: str):
+        if self.output_sink is not None:
+            self.output_sink(OutputItem(new_output=text, iteration_output=job.iteration))
+
+    def _execute(self, job: _Job):
+        item = job.item
+        if item.shell:
+            args = item.command_str if item.command_str else " ".join(item.argument_list or [])
+        else:
+            args = item.argument_list if item.argument_list else item.command_str.split()
+        proc = subprocess.Popen(args, shell=item.shell, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, start_new_session=True)
+        deadline = None if job.timeout is None else time.monotonic() + job.timeout
+        buffers = {proc.stdout: b"", proc.stderr: b""}
+        prefixes = {proc.stdout: "", proc.stderr: "stderr: "}
+        output = []
+        timed_out = False
+
+        with selectors.DefaultSelector() as sel:
+            sel.register(proc.stdout, selectors.EVENT_READ)
+            sel.register(proc.stderr, selectors.EVENT_READ)
+            while sel.get_map():
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    timed_out = True
+                    self._kill(proc)
+                    break
+                for key, _ in sel.select(timeout):
+                    data = os.read(key.fd, 65536)
+                    if not data:
+                        sel.unregister(key.fileobj)
+                        data, buffers[key.fileobj] = buffers[key.fileobj], b""
+                        if data:
+                            self._line(job, output, prefixes[key.fileobj], data)
+                        continue
+                    lines = (buffers[key.fileobj] + data).split(b"\n")
+                    buffers[key.fileobj] = lines.pop()
+                    for line in lines:
+                        self._line(job, output, prefixes[key.fileobj], line + b"\n")
+
+        proc.stdout.close()
+        proc.stderr.close()
+        if not timed_out:
+            # The command can close its output and keep running, so the deadline still applies here.
+            try:
+                proc.wait(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                timed_out = True
+                self._kill(proc)
+        item.output = "".join(output)
+        if timed_out:
+            item.output += f"Command timed out after {job.timeout} seconds.\n"
+        item.exit_code = proc.returncode
+
+    def _line(self, job: _Job, output: list, prefix: str, data: bytes):
+        text = prefix + data.decode("utf-8", errors="replace")
+        output.append(text)
+        self._emit(job, text)
+
+    def _kill(self, proc: subprocess.Popen):
+        for sig, grace in ((signal.SIGTERM, self.kill_grace_sec), (signal.SIGKILL, None)):
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                return
+            try:
+                proc.wait(timeout=grace)
+                return
+            except subprocess.TimeoutExpired:
+                continue
@@ -0,0 +1,108 @@
+"""ActionGraph and ActionScheduler: dependency order, stage caps, delays, failures and the critical path."""
+
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from parsed_objects import ParsedAction, ParsedStageLimit
+from action_scheduler import (ACTION_DONE, ACTION_FAILED, ACTION_SKIPPED, ActionGraph, ActionScheduler,
+                              parse_action_ids)
+
+
+def action(action_id, stage=1, run_after="", run_before="", start_delay=0.0, end_delay=0.0):
+    return ParsedAction(action_id, "src", "dst", "subprocess", f"echo {action_id}", "", str(stage), "",
+                        str(start_delay), str(end_delay), run_before, run_after, 10, False, True, False)
+
+
+class RecordingRunner:
+    """A runner that records the start and end order of actions and can be told to fail some."""
+    def __init__(self, duration=0.01, fail=()):
+        self.duration = duration
+        self.fail = set(fail)
+        self.started = []
+        self.ended = []
+        self.concurrent = 0
+        self.max_concurrent = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, parsed_action):
+        with self._lock:
+            self.started.append(parsed_action.id)
+            self.concurrent += 1
+            self.max_concurrent = max(self.max_concurrent, self.concurrent)
+        time.sleep(self.duration)
+        with self._lock:
+            self.concurrent -= 1
+            self.ended.append(parsed_action.id)
+        if parsed_action.id in self.fail:
+            raise RuntimeError(f"{parsed_action.id} failed")
+        return parsed_action.id
+
+
+def test_parse_action_ids():
+    assert parse_action_ids("a, b c") == ["a", "b", "c"]
+    assert parse_action_ids("None") == []
+    assert parse_action_ids(None) == []
+
+
+def test_graph_rejects_unknown_ids_and_cycles():
+    for actions in ([action("a", run_after="missing")],
+                    [action("a", run_after="b"), action("b", run_after="a")]):
+        try:
+            ActionGraph(actions)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("an invalid graph must be rejected")
+
+
+def test_run_before_and_run_after_order_the_run():
+    graph = ActionGraph([action("c", run_after="b"), action("b"), action("a", run_before="b")])
+    runner = RecordingRunner()
+    runs = ActionScheduler(graph, runner).run()
+    assert runner.started.index("a") < runner.started.index("b") < runner.started.index("c")
+    assert all(run.state == ACTION_DONE for run in runs.values())
+    assert runs["c"].result == "c"
+
+
+def test_strict_stages_wait_for_the_previous_stage():
+    graph = ActionGraph([action("a1", stage=1), action("a2", stage=1), action("b1", stage=2)], strict_stages=True)
+    runner = RecordingRunner()
+    ActionScheduler(graph, runner).run()
+    assert runner.started[-1] == "b1"
+    assert set(runner.ended[:2]) == {"a1", "a2"}
+
+
+def test_stage_limit_caps_concurrency():
+    graph = ActionGraph([action(f"a{i}", stage=1) for i in range(6)])
+    runner = RecordingRunner(duration=0.02)
+    ActionScheduler(graph, runner, stage_limits=[ParsedStageLimit(1, 2)]).run()
+    assert len(runner.started) == 6
+    assert runner.max_concurrent == 2
+
+
+def test_delays_hold_back_successors():
+    graph = ActionGraph([action("a", end_delay=0.1), action("b", run_after="a", start_delay=0.1)])
+    scheduler = ActionScheduler(graph, RecordingRunner(duration=0.0))
+    runs = scheduler.run()
+    assert runs["b"].start_time - runs["a"].end_time >= 0.2 - 0.01
+
+
+def test_failure_skips_only_the_dependents():
+    graph = ActionGraph([action("a"), action("b", run_after="a"), action("c", run_after="b"), action("d")])
+    runner = RecordingRunner(fail={"a"})
+    runs = ActionScheduler(graph, runner).run()
+    assert runs["a"].state == ACTION_FAILED and isinstance(runs["a"].error, RuntimeError)
+    assert runs["b"].state == runs["c"].state == ACTION_SKIPPED
+    assert runs["d"].state == ACTION_DONE
+    assert sorted(runner.started) == ["a", "d"]
+
+
+def test_critical_path_follows_the_latest_predecessor():
+    graph = ActionGraph([action("fast"), action("slow", end_delay=0.1), action("join", run_after="fast, slow")])
+    scheduler = ActionScheduler(graph, RecordingRunner(duration=0.0))
+    scheduler.run()
+    assert scheduler.critical_path() == ["slow", "join"]
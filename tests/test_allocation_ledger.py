@@ -0,0 +1,90 @@
+"""AllocationLedger and ParsedHypervisor allocation counting: capacity limits, reservations and stale tokens."""
+
+import os
+import sys
+import time
+import pickle
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from parsed_objects import ParsedHypervisor
+from allocation_ledger import AllocationLedger
+
+
+def nodes(*slots):
+    return [ParsedHypervisor(f"n{i}", f"n{i}", max_iterations=count) for i, count in enumerate(slots)]
+
+
+def test_a_node_is_never_over_committed():
+    ledger = AllocationLedger(nodes(2))
+    tokens = [ledger.allocate("n0") for _ in range(3)]
+    assert tokens[0] is not None and tokens[1] is not None
+    assert tokens[2] is None
+    assert ledger.snapshot()["n0"] == {"allocated": 2, "reserved": 0, "free": 0, "max": 2}
+
+
+def test_release_frees_a_slot_once():
+    ledger = AllocationLedger(nodes(1))
+    token = ledger.allocate("n0")
+    assert ledger.release(token)
+    assert not ledger.release(token)
+    assert ledger.allocate("n0") is not None
+
+
+def test_expired_reservation_is_reclaimed_and_its_token_goes_stale():
+    ledger = AllocationLedger(nodes(1))
+    stale = ledger.reserve("n0", ttl_sec=0.01)
+    time.sleep(0.05)
+    fresh = ledger.reserve("n0")
+    assert fresh is not None and fresh != stale
+    assert not ledger.commit(stale)
+    assert not ledger.release(stale)
+    assert ledger.commit(fresh)
+    assert ledger.snapshot()["n0"]["allocated"] == 1
+
+
+def test_reserve_any_fills_every_node_then_gives_up():
+    ledger = AllocationLedger(nodes(1, 2))
+    placed = [ledger.reserve_any() for _ in range(3)]
+    assert sorted(alias for alias, _ in placed) == ["n0", "n1", "n1"]
+    assert ledger.reserve_any() is None
+
+
+def test_hypervisor_count_is_atomic_under_threads():
+    hv = nodes(3)[0]
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(hv.can_allocate_iteration())) for _ in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 3
+    assert hv.get_current_allocations() == 3
+
+
+def test_unmatched_release_raises():
+    hv = nodes(1)[0]
+    try:
+        hv.decrement_current_allocations()
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("a release without an allocation must not be absorbed")
+
+
+def test_copies_sharing_a_ledger_share_the_capacity():
+    hv = nodes(2)[0]
+    ledger = AllocationLedger([hv])
+    hv.attach_ledger(ledger)
+    copy = pickle.loads(pickle.dumps(hv))
+    assert copy._ledger is None
+    copy.attach_ledger(ledger)
+
+    assert hv.can_allocate_iteration()
+    assert copy.can_allocate_iteration()
+    assert not hv.can_allocate_iteration()
+    assert not copy.can_allocate_iteration()
+    copy.decrement_current_allocations()
+    assert ledger.snapshot()["n0"]["allocated"] == 1
+    assert hv.can_allocate_iteration()
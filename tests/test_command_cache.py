@@ -0,0 +1,107 @@
+"""CommandCache: prefix rules, expiry, eviction, sharing of a run in progress, and failed results."""
+
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from command_cache import CommandCache
+
+
+class FakeCommands:
+    """Stands in for _run_command: counts the runs of every command and fails the ones it is told to."""
+    def __init__(self, exit_codes=None):
+        self.exit_codes = exit_codes or {}
+        self.runs = []
+
+    def __call__(self, command):
+        self.runs.append(command)
+        return self.exit_codes.get(command, 0), f"{command} #{len(self.runs)}"
+
+
+def test_rules_match_whole_words_and_the_longest_prefix_wins():
+    cache = CommandCache({"ip addr": 5, "ip": 1, "systemctl is-active": 2})
+    assert cache.ttl_for("ip addr show") == 5
+    assert cache.ttl_for("ip route") == 1
+    assert cache.ttl_for("ipcalc") is None
+    assert cache.ttl_for("systemctl is-active sshd") == 2
+    assert cache.ttl_for("systemctl restart sshd") is None
+
+
+def test_cached_until_expiry_with_normalised_whitespace():
+    cache = CommandCache({"uname": 0.05})
+    run = FakeCommands()
+    first = cache.run("uname -a", run)
+    assert cache.run("uname   -a ", run) == first
+    assert (cache.hits, cache.misses) == (1, 1)
+    time.sleep(0.1)
+    assert cache.run("uname -a", run) != first
+    assert len(run.runs) == 2
+
+
+def test_commands_without_a_rule_always_run():
+    cache = CommandCache({"uname": 60})
+    run = FakeCommands()
+    cache.run("date", run)
+    cache.run("date", run)
+    assert len(run.runs) == 2
+    assert cache.hits == cache.misses == 0
+
+
+def test_failed_results_are_not_cached():
+    cache = CommandCache({"ip addr": 60})
+    run = FakeCommands({"ip addr": 1})
+    cache.run("ip addr", run)
+    cache.run("ip addr", run)
+    assert len(run.runs) == 2
+    run.exit_codes.clear()
+    cache.run("ip addr", run)
+    cache.run("ip addr", run)
+    assert len(run.runs) == 3
+
+
+def test_least_recently_used_result_is_evicted():
+    cache = CommandCache({"cat": 60}, max_entries=2)
+    run = FakeCommands()
+    for command in ("cat a", "cat b", "cat a", "cat c", "cat a", "cat b"):
+        cache.run(command, run)
+    assert run.runs == ["cat a", "cat b", "cat c", "cat b"]
+
+
+def test_concurrent_requests_share_one_run():
+    cache = CommandCache({"slow": 60})
+    started, release = threading.Event(), threading.Event()
+    runs, results = [], []
+
+    def slow(command):
+        runs.append(command)
+        started.set()
+        release.wait(5.0)
+        return 0, "done"
+
+    first = threading.Thread(target=lambda: results.append(cache.run("slow", slow)), daemon=True)
+    first.start()
+    started.wait(5.0)
+    second = threading.Thread(target=lambda: results.append(cache.run("slow", slow)), daemon=True)
+    second.start()
+    while cache.shared == 0 and second.is_alive():
+        time.sleep(0.001)
+    release.set()
+    first.join(5.0)
+    second.join(5.0)
+    assert results == ["done", "done"]
+    assert len(runs) == 1
+    assert cache.shared == 1
+
+
+def test_invalidate_by_prefix():
+    cache = CommandCache({"ip": 60, "uname": 60})
+    run = FakeCommands()
+    for command in ("ip addr", "ip route", "uname"):
+        cache.run(command, run)
+    cache.invalidate("ip")
+    for command in ("ip addr", "ip route", "uname"):
+        cache.run(command, run)
+    assert run.runs == ["ip addr", "ip route", "uname", "ip addr", "ip route"]
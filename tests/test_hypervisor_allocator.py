@@ -0,0 +1,91 @@
+"""HypervisorAllocator: placement strategies, atomic batches and the ParsedHypervisor bookkeeping it keeps."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from parsed_objects import ParsedHypervisor
+from hypervisor_allocator import (STRATEGY_BEST_FIT, STRATEGY_FIRST_FIT_DECREASING, STRATEGY_SPREAD,
+                                  HypervisorAllocator, IterationDemand)
+
+
+def cluster(*rams, max_iterations=4):
+    return [ParsedHypervisor(f"n{i}", f"n{i}", max_iterations=max_iterations, cores="8", ram=str(ram))
+            for i, ram in enumerate(rams)]
+
+
+def test_strategies_pick_different_nodes():
+    nodes = cluster(1000, 600, 2000)
+    assert HypervisorAllocator(nodes, STRATEGY_FIRST_FIT_DECREASING).allocate(1, IterationDemand(1, 500)) is nodes[0]
+    nodes = cluster(1000, 600, 2000)
+    assert HypervisorAllocator(nodes, STRATEGY_BEST_FIT).allocate(1, IterationDemand(1, 500)) is nodes[1]
+    nodes = cluster(1000, 600, 2000)
+    assert HypervisorAllocator(nodes, STRATEGY_SPREAD).allocate(1, IterationDemand(1, 500)) is nodes[2]
+
+
+def test_allocation_updates_the_node_and_release_gives_it_back():
+    nodes = cluster(1000)
+    allocator = HypervisorAllocator(nodes)
+    assert allocator.allocate(7, IterationDemand(2, 300, 0)) is nodes[0]
+    assert nodes[0].get_current_allocations() == 1
+    assert allocator.get_free_resources()["n0"]["ram"] == 700
+    assert allocator.get_node_for_iteration(7) is nodes[0]
+
+    assert allocator.release(7) is nodes[0]
+    assert nodes[0].get_current_allocations() == 0
+    assert allocator.get_free_resources()["n0"]["ram"] == 1000
+    assert allocator.release(7) is None
+
+
+def test_existing_allocations_are_not_free():
+    nodes = cluster(1000, 1000)
+    nodes[0].add_allocated_resources(0, 800, 0)
+    allocator = HypervisorAllocator(nodes, STRATEGY_FIRST_FIT_DECREASING)
+    assert allocator.allocate(1, IterationDemand(1, 500)) is nodes[1]
+
+
+def test_iteration_slots_limit_placement():
+    nodes = cluster(10000, max_iterations=2)
+    allocator = HypervisorAllocator(nodes)
+    assert allocator.allocate(1, IterationDemand(1, 10)) is not None
+    assert allocator.allocate(2, IterationDemand(1, 10)) is not None
+    assert allocator.allocate(3, IterationDemand(1, 10)) is None
+
+
+def test_batch_is_placed_whole_or_not_at_all():
+    nodes = cluster(1000, 1000)
+    allocator = HypervisorAllocator(nodes)
+    placed = allocator.place_batch({1: IterationDemand(1, 600), 2: IterationDemand(1, 600)})
+    assert {placed[1], placed[2]} == set(nodes)
+
+    failed = allocator.place_batch({3: IterationDemand(1, 300), 4: IterationDemand(1, 500)})
+    assert failed == {3: None, 4: None}
+    assert allocator.get_node_for_iteration(3) is None
+    assert [n.get_current_allocations() for n in nodes] == [1, 1]
+    assert {r["ram"] for r in allocator.get_free_resources().values()} == {400}
+
+
+def test_allocating_an_iteration_twice_raises():
+    allocator = HypervisorAllocator(cluster(1000))
+    allocator.allocate(1, IterationDemand(1, 10))
+    try:
+        allocator.allocate(1, IterationDemand(1, 10))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("an iteration can only hold one placement")
+
+
+def test_custom_strategy_sees_only_nodes_that_fit():
+    nodes = cluster(100, 1000, 1000)
+    allocator = HypervisorAllocator(nodes)
+    seen = []
+
+    def last(candidates, demand):
+        seen.append([n.node_alias for n in candidates])
+        return candidates[-1]
+
+    allocator.register_strategy("last", last)
+    assert allocator.allocate(1, IterationDemand(1, 500), strategy="last") is nodes[2]
+    assert seen == [["n1", "n2"]]
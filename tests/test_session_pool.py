@@ -0,0 +1,62 @@
+"""SessionPool against a stand-in server: the session factory hands out fake sessions, so no SSH is involved."""
+
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from session_pool import RemoteSession, SessionPool
+
+
+class FakeSession(RemoteSession):
+    def __init__(self, key, server):
+        super().__init__(key)
+        self.server = server
+        self.closed = False
+
+    def run(self, command, timeout=None):
+        return 0, f"{self.key[2]}: {command}"
+
+    def is_alive(self):
+        return not self.closed
+
+    def close(self):
+        self.closed = True
+        self.server.closed.append(self)
+
+
+class FakeServer:
+    def __init__(self):
+        self.opened = []
+        self.closed = []
+
+    def factory(self, key, password, key_file):
+        session = FakeSession(key, self)
+        self.opened.append(session)
+        return session
+
+
+def test_idle_session_of_other_user_is_closed_at_host_limit():
+    server = FakeServer()
+    pool = SessionPool(max_sessions_per_host=1, session_factory=server.factory)
+    assert pool.run("10.0.0.1", 22, "alice", "", "id") == (0, "alice: id")
+
+    result = []
+    worker = threading.Thread(target=lambda: result.append(pool.run("10.0.0.1", 22, "bob", "", "id")), daemon=True)
+    worker.start()
+    worker.join(5.0)
+
+    assert not worker.is_alive(), "run() waited for a session that was never going to be released"
+    assert result == [(0, "bob: id")]
+    assert [s.key[2] for s in server.closed] == ["alice"]
+    pool.close()
+
+
+def test_sessions_are_reused():
+    server = FakeServer()
+    pool = SessionPool(session_factory=server.factory)
+    for _ in range(3):
+        pool.run("10.0.0.1", 22, "alice", "", "id")
+    assert len(server.opened) == 1
+    pool.close()
@@ -0,0 +1,80 @@
+"""JsonCodec must accept and produce the same messages whether or not orjson is installed."""
+
+import os
+import sys
+import json
+import math
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sock_codec
+from sock_codec import JSON_CODEC
+
+
+def stdlib(obj):
+    return json.loads(json.dumps(obj, ensure_ascii=False))
+
+
+def roundtrip(obj):
+    return JSON_CODEC.decode(JSON_CODEC.encode(obj, "utf-8"), "utf-8")
+
+
+def test_non_str_keys_encode_like_json():
+    assert roundtrip({1: "a", "b": {2: 3}}) == stdlib({1: "a", "b": {2: 3}})
+
+
+def test_big_integers_encode():
+    assert roundtrip({"value": 2 ** 70}) == {"value": 2 ** 70}
+
+
+def test_nan_and_infinity_survive():
+    decoded = roundtrip({"value": [float("nan"), float("inf"), -float("inf")]})
+    assert math.isnan(decoded["value"][0])
+    assert decoded["value"][1:] == [math.inf, -math.inf]
+
+
+def test_plain_message_and_other_encodings():
+    message = {"action": "command", "iteration": 5, "value": "naïve ✓"}
+    assert roundtrip(message) == message
+    assert JSON_CODEC.decode(JSON_CODEC.encode(message, "utf-16"), "utf-16") == message
+
+
+def test_invalid_json_still_raises_value_error():
+    try:
+        JSON_CODEC.decode(b'{"torn": ', "utf-8")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("a torn record must not decode")
+
+
+def test_same_result_without_orjson(monkeypatch):
+    obj = {1: "a", "n": 2 ** 70, "f": 1.5}
+    with_orjson = roundtrip(obj)
+    monkeypatch.setattr(sock_codec, "orjson", None)
+    assert roundtrip(obj) == with_orjson == stdlib(obj)
+
+
+def test_negotiation_picks_our_first_type_the_peer_accepts(monkeypatch):
+    monkeypatch.setattr(sock_codec, "_codecs", dict(sock_codec._codecs))
+    sock_codec.enable_pickle_codec()
+    pickle_type = sock_codec.CONTENT_TYPE_PICKLE
+    json_type = sock_codec.CONTENT_TYPE_JSON
+    assert sock_codec.negotiate([pickle_type, json_type], [json_type, pickle_type], json_type) == pickle_type
+    assert sock_codec.negotiate([pickle_type, json_type], [json_type], json_type) == json_type
+
+
+def test_negotiation_keeps_the_requested_type_without_agreement():
+    json_type = sock_codec.CONTENT_TYPE_JSON
+    assert sock_codec.negotiate(["application/x-unknown"], ["application/x-unknown"], json_type) == json_type
+    assert sock_codec.negotiate(None, [json_type], json_type) == json_type
+    assert sock_codec.negotiate([json_type], None, json_type) == json_type
+
+
+def test_pickle_codec_is_opt_in(monkeypatch):
+    monkeypatch.setattr(sock_codec, "_codecs", dict(sock_codec._codecs))
+    assert sock_codec.get_codec(sock_codec.CONTENT_TYPE_PICKLE) is None
+    sock_codec.enable_pickle_codec()
+    codec = sock_codec.get_codec(sock_codec.CONTENT_TYPE_PICKLE)
+    assert codec.decode(codec.encode({"value": {1, 2}}, "utf-8"), "utf-8") == {"value": {1, 2}}
+    assert sock_codec.CONTENT_TYPE_PICKLE in sock_codec.registered_content_types()
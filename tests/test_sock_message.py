@@ -0,0 +1,56 @@
+"""SockMessage framing: several messages arriving in one recv(), and a message split across reads."""
+
+import os
+import sys
+import socket
+import selectors
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sock_codec import JSON_CODEC
+from sock_handlers import MODE_INLINE, ROLE_SERVER, HandlerRegistry
+from sock_message import SockMessage, create_message
+
+
+def _receiver():
+    received = []
+    handlers = HandlerRegistry()
+    handlers.register(ROLE_SERVER, "probe", lambda sock_message, content: received.append(content["value"]),
+                      MODE_INLINE)
+    ours, theirs = socket.socketpair()
+    ours.setblocking(False)
+    message = SockMessage(selectors.DefaultSelector(), ours, "peer", server_instance=True, handlers=handlers)
+    return message, theirs, received
+
+
+def _frame(message: SockMessage, value: str) -> bytes:
+    content = JSON_CODEC.encode(create_message("probe", value)["content"], "utf-8")
+    return b"".join(message._create_message_out(content_bytes=content, content_type="text/json",
+                                                content_encoding="utf-8"))
+
+
+def test_every_message_of_a_single_recv_is_dispatched():
+    message, peer, received = _receiver()
+    try:
+        peer.sendall(b"".join(_frame(message, f"m{i}") for i in range(5)))
+        message.read()
+        assert received == ["m0", "m1", "m2", "m3", "m4"]
+        assert message._recv_buffer == b""
+    finally:
+        peer.close()
+        message._sock.close()
+
+
+def test_a_trailing_partial_message_waits_for_the_rest():
+    message, peer, received = _receiver()
+    try:
+        last = _frame(message, "last")
+        peer.sendall(_frame(message, "first") + last[:7])
+        message.read()
+        assert received == ["first"]
+        peer.sendall(last[7:])
+        message.read()
+        assert received == ["first", "last"]
+    finally:
+        peer.close()
+        message._sock.close()
@@ -0,0 +1,149 @@
+"""OutboundSpool and RecentResults: durability, recovery after a restart, and duplicate suppression."""
+
+import os
+import sys
+import errno
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sock_spool import OutboundSpool, RecentResults
+
+
+class FullDisk:
+    """Stands in for the log file on a disk that has run out of space."""
+    def write(self, data):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def flush(self):
+        pass
+
+    def fileno(self):
+        return -1
+
+    def close(self):
+        pass
+
+
+def test_write_error_is_raised_to_the_sender_and_later_sends_fail_fast(tmp_path):
+    spool = OutboundSpool(str(tmp_path / "spool.wal"), fsync=False)
+    spool._file = FullDisk()
+
+    errors = []
+
+    def send():
+        try:
+            spool.log_send("a", 1, "attack", {"m": 1})
+        except OSError as e:
+            errors.append(e)
+
+    sender = threading.Thread(target=send, daemon=True)
+    sender.start()
+    sender.join(5.0)
+    assert not sender.is_alive(), "log_send() blocked after the writer failed"
+    assert errors and errors[0].errno == errno.ENOSPC
+    assert spool.pending_count() == 0
+
+    try:
+        spool.log_send("b", 1, "attack", {"m": 2})
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("log_send() on a failed spool must raise")
+    spool.close()
+
+
+def test_unacknowledged_commands_are_replayed_after_a_restart(tmp_path):
+    path = str(tmp_path / "spool.wal")
+    spool = OutboundSpool(path, fsync=False)
+    spool.log_send("a", 1, "attack", {"value": "echo a"})
+    spool.log_send("b", 1, "attack", {"value": "echo b"})
+    spool.log_send("c", 2, "attack", {"value": "echo c"})
+    assert spool.ack("a")
+    spool.close()
+
+    restarted = OutboundSpool(path, fsync=False)
+    assert restarted.pending_count() == 2
+    assert restarted.pending_for(1, "attack") == [{"value": "echo b"}]
+    assert restarted.pending_for(1, "measurements") == []
+    restarted.close()
+
+
+def test_a_torn_last_record_is_ignored_and_the_log_is_compacted(tmp_path):
+    path = str(tmp_path / "spool.wal")
+    spool = OutboundSpool(path, fsync=False)
+    spool.log_send("a", 1, "attack", {"value": "echo a"})
+    spool.log_send("b", 1, "attack", {"value": "echo b"})
+    spool.ack("b")
+    spool.close()
+    with open(path, "ab") as f:
+        f.write(b'{"op": "ack", "id": "a')
+
+    restarted = OutboundSpool(path, fsync=False)
+    assert restarted.pending_for(1, "attack") == [{"value": "echo a"}]
+    restarted.close()
+    with open(path, "rb") as f:
+        assert len(f.read().splitlines()) == 1
+
+
+def test_duplicate_acknowledgements_are_reported(tmp_path):
+    spool = OutboundSpool(str(tmp_path / "spool.wal"), fsync=False)
+    spool.log_send("a", 1, "attack", {"value": "echo a"})
+    assert spool.ack("a")
+    assert not spool.ack("a")
+    assert not spool.ack("never-sent")
+    spool.close()
+
+
+def test_recent_results_run_a_message_id_once():
+    recent = RecentResults()
+    runs = []
+
+    def run():
+        runs.append(1)
+        return f"run {len(runs)}"
+
+    assert recent.run("a", run) == "run 1"
+    assert recent.run("a", run) == "run 1"
+    assert recent.run(None, run) == "run 2"
+    assert recent.run(None, run) == "run 3"
+    assert len(runs) == 3
+
+
+def test_recent_results_share_a_run_in_progress():
+    recent = RecentResults()
+    started, release = threading.Event(), threading.Event()
+    runs, results = [], []
+
+    def slow():
+        runs.append(1)
+        started.set()
+        release.wait(5.0)
+        return "done"
+
+    first = threading.Thread(target=lambda: results.append(recent.run("a", slow)), daemon=True)
+    first.start()
+    started.wait(5.0)
+    second = threading.Thread(target=lambda: results.append(recent.run("a", slow)), daemon=True)
+    second.start()
+    release.set()
+    first.join(5.0)
+    second.join(5.0)
+    assert results == ["done", "done"]
+    assert len(runs) == 1
+
+
+def test_recent_results_forget_failures_and_old_entries():
+    recent = RecentResults(max_entries=2)
+
+    def fail():
+        raise OSError("boom")
+
+    try:
+        recent.run("a", fail)
+    except OSError:
+        pass
+    assert recent.run("a", lambda: "retried") == "retried"
+    recent.run("b", lambda: "b")
+    recent.run("c", lambda: "c")
+    assert recent.run("a", lambda: "run again") == "run again"